@@ -1,8 +1,13 @@
+from astropy import units as u
+
 from starkit.base.operations import (DoubleSpectrum, SpectrographOperationModel,
                                      StellarOperationModel)
 
-from starkit.base.operations.spectrograph import Interpolate, Normalize
+from starkit.base.operations.spectrograph import (Interpolate, Normalize,
+                                                  NormalizeParts,
+                                                  convert_observed)
 from starkit.base.operations.imager import Photometry
+from starkit.base.compiled_model import CompiledModel
 
 
 def fit_parameters_property(self):
@@ -11,7 +16,8 @@ def fit_parameters_property(self):
 
 def assemble_model(spectral_grid, spectrum=None,
                    normalize_npol=None, filter_set=None, mag_type='vega',
-                   **kwargs):
+                   interpolate_mode='interpolate', normalize_parts=None,
+                   compiled=False, **kwargs):
     """
 
     Parameters
@@ -27,6 +33,23 @@ def assemble_model(spectral_grid, spectrum=None,
         degree of polynomial to be used for interpolation, only if not None and
         spectrum is not None will the normalization plugin be used [default None]
 
+    interpolate_mode: str
+        'interpolate' samples the model at the observed wavelengths, 'rebin'
+        integrates it over the observed pixels conserving flux
+        [default 'interpolate']
+
+    normalize_parts: list of slices, index arrays, or boolean arrays
+        parts of the spectrum (e.g. echelle orders) that are normalized
+        separately with polynomials of degree normalize_npol (single int or
+        one per part) [default None]
+
+    compiled: bool
+        return a `CompiledModel` that evaluates the operations directly
+        instead of through the astropy compound model (which it keeps as
+        `model`). Only compiled models provide the analytic derivatives
+        (`jacobian` and `evaluate_jacobian`) - `Optimizer` uses finite
+        differences for uncompiled models [default False]
+
     plugin_names: ~list of ~str
         select between the following available plugin choices:
         {stellar_operations}
@@ -37,14 +60,21 @@ def assemble_model(spectral_grid, spectrum=None,
         : ~Model
         Model with the requested operations
 
+    Units are resolved here: the observed spectrum is converted to the
+    wavelength unit of the grid and the operations are set up for the
+    units of the grid, so evaluating the model only passes plain arrays.
 
     """
 
     ObservationModel = spectral_grid
     parameters = kwargs.copy()
 
+    wavelength_unit = getattr(spectral_grid, 'wavelength_unit', None)
+    if spectrum is not None and wavelength_unit is not None:
+        spectrum = convert_observed(spectrum, wavelength_unit)
+
     def assemble_model_part(operations):
-        observation_model = None
+        assembled_operations = []
         for operation in operations:
             param_values = {}
             for param_name in operation.param_names:
@@ -60,12 +90,17 @@ def assemble_model(spectral_grid, spectrum=None,
                                                                     **param_values)
                 else:
                     current_stellar_operation = operation(**param_values)
-                if observation_model is None:
-                    observation_model = current_stellar_operation
-                else:
-                    observation_model = (observation_model |
-                                         current_stellar_operation)
+                assembled_operations.append(current_stellar_operation)
+
+        return assembled_operations
 
+    def chain(operations):
+        observation_model = None
+        for operation in operations:
+            if observation_model is None:
+                observation_model = operation
+            else:
+                observation_model = observation_model | operation
         return observation_model
 
 
@@ -80,32 +115,38 @@ def assemble_model(spectral_grid, spectrum=None,
             ','.join(parameters.keys.join())))
 
     if spectrum is not None:
-        if spectrograph_operations is None:
-            spectrograph_operations = Interpolate(spectrum)
-        else:
-            spectrograph_operations = (spectrograph_operations |
-                                       Interpolate(spectrum))
+        spectrograph_operations.append(Interpolate(spectrum,
+                                                   mode=interpolate_mode))
         if normalize_npol is not None:
-            spectrograph_operations = (spectrograph_operations |
-                                       Normalize(spectrum, normalize_npol))
+            if normalize_parts is None:
+                normalize = Normalize(spectrum, normalize_npol)
+            else:
+                normalize = NormalizeParts(spectrum, normalize_parts,
+                                           normalize_npol)
+            spectrograph_operations.append(normalize)
 
     if filter_set is not None:
-        imager_operations = Photometry(filter_set, mag_type=mag_type)
+        imager_operations = [Photometry(
+            filter_set, mag_type=mag_type,
+            wavelength_unit=wavelength_unit or u.angstrom,
+            flux_unit=getattr(spectral_grid, 'flux_unit', None))]
     else:
-        imager_operations = None
+        imager_operations = []
 
-    if imager_operations is not None and spectrograph_operations is not None:
-        starkit_model = spectral_grid | stellar_operations
+    starkit_model = chain([spectral_grid] + stellar_operations)
+    if imager_operations and spectrograph_operations:
         starkit_model = starkit_model | DoubleSpectrum()
-        starkit_model = starkit_model | (spectrograph_operations &
-                                         imager_operations)
-    elif imager_operations is not None:
-        starkit_model = spectral_grid | stellar_operations | imager_operations
-    elif spectrograph_operations is not None:
-        starkit_model = (spectral_grid | stellar_operations
-                         | spectrograph_operations)
+        starkit_model = starkit_model | (chain(spectrograph_operations) &
+                                         chain(imager_operations))
     else:
-        starkit_model = spectral_grid | stellar_operations
+        starkit_model = chain([starkit_model] + spectrograph_operations +
+                              imager_operations)
+
+    if compiled:
+        return CompiledModel(starkit_model, spectral_grid,
+                             stellar_operations=stellar_operations,
+                             spectrograph_operations=spectrograph_operations,
+                             imager_operations=imager_operations)
 
     return starkit_model
 
@@ -0,0 +1,285 @@
+import numpy as np
+
+
+class CompiledModel(object):
+    """
+    Flat evaluation plan of a model assembled by `assemble_model`
+
+    The operations are called directly through their `evaluate` methods
+    with parameters sliced from a single parameter vector (ordered like
+    `model.param_names`). This bypasses the input validation and parameter
+    handling of astropy compound models in the hot loop. The compound
+    model is kept as `model` for introspection and attributes that are not
+    part of the plan (e.g. `param_names`, `fixed` or single parameters) are
+    looked up on it.
+
+    Parameters are either single values or (for stacked evaluation) arrays
+    with one value per spectrum.
+
+    `jacobian` calculates the derivatives of the outputs with respect to
+    the free parameters by propagating them through the operations
+    (analytically for operations with `evaluate_derivative`, with finite
+    differences of the single operation otherwise). The astropy compound
+    model returned by `assemble_model` without ``compiled=True`` has no
+    `jacobian`.
+
+    Parameters
+    ----------
+
+    model: ~astropy.modeling.Model
+        compound model equivalent to the plan
+
+    grid: ~BaseSpectralGrid
+        spectral grid at the start of the chain
+
+    stellar_operations: list
+        operations applied to the grid spectrum [default none]
+
+    spectrograph_operations: list
+        operations producing the observed spectrum [default none]
+
+    imager_operations: list
+        operations producing photometry - applied to the same stellar
+        spectrum as the spectrograph operations [default none]
+
+    likelihood: ~astropy.modeling.Model
+        model consuming all outputs of the operations, e.g. a likelihood
+        [default None]
+    """
+
+    def __init__(self, model, grid, stellar_operations=(),
+                 spectrograph_operations=(), imager_operations=(),
+                 likelihood=None):
+        self.model = model
+        self.grid = grid
+        self.stellar_operations = list(stellar_operations)
+        self.spectrograph_operations = list(spectrograph_operations)
+        self.imager_operations = list(imager_operations)
+        self.likelihood = likelihood
+
+        # parameters are laid out in the order of the leaves of the
+        # compound model
+        n_parameters = len(grid.param_names)
+        self._grid_stop = n_parameters
+        self._grid_stage = (grid.evaluate, 0, n_parameters, False)
+        self._stellar_stages, n_parameters = self._make_stages(
+            self.stellar_operations, n_parameters)
+        self._spectrograph_stages, n_parameters = self._make_stages(
+            self.spectrograph_operations, n_parameters)
+        self._imager_stages, n_parameters = self._make_stages(
+            self.imager_operations, n_parameters)
+        if likelihood is None:
+            self._likelihood_stages = []
+        else:
+            self._likelihood_stages, n_parameters = self._make_stages(
+                [likelihood], n_parameters)
+
+        if n_parameters != len(model.param_names):
+            raise ValueError('Operations have {0} parameters but the model '
+                             'has {1}'.format(n_parameters,
+                                              len(model.param_names)))
+
+    @staticmethod
+    def _make_stages(operations, start):
+        """
+        Build stages (evaluate, parameter start, parameter stop,
+        single output) for a chain of operations
+        """
+        stages = []
+        for operation in operations:
+            stop = start + len(operation.param_names)
+            stages.append((operation.evaluate, start, stop,
+                           len(operation.outputs) == 1))
+            start = stop
+        return stages, start
+
+    @staticmethod
+    def _run_stages(stages, parameters, inputs):
+        for evaluate, start, stop, single_output in stages:
+            inputs = evaluate(*(inputs + parameters[start:stop]))
+            if single_output:
+                inputs = (inputs, )
+        return inputs
+
+    def evaluate(self, *parameters):
+        """
+        Evaluate the model for the given parameters (in the order of
+        `param_names`)
+        """
+        outputs = self.grid.evaluate(*parameters[:self._grid_stop])
+        outputs = self._run_stages(self._stellar_stages, parameters, outputs)
+
+        if self._spectrograph_stages and self._imager_stages:
+            outputs = (
+                self._run_stages(self._spectrograph_stages, parameters,
+                                 outputs) +
+                self._run_stages(self._imager_stages, parameters, outputs))
+        else:
+            outputs = self._run_stages(self._spectrograph_stages, parameters,
+                                       outputs)
+            outputs = self._run_stages(self._imager_stages, parameters,
+                                       outputs)
+
+        outputs = self._run_stages(self._likelihood_stages, parameters,
+                                   outputs)
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def _fixed_mask(self):
+        return np.array([getattr(self.model, param_name).fixed
+                         for param_name in self.model.param_names],
+                        dtype=bool)
+
+    @staticmethod
+    def _finite_difference_derivative(evaluate, single_output, parameters,
+                                      parameter_directions, steps, inputs,
+                                      d_inputs):
+        """
+        Outputs and derivatives of a stage without `evaluate_derivative`
+        from forward differences along each direction
+        """
+        def evaluate_stage(inputs, parameters):
+            outputs = evaluate(*(inputs + parameters))
+            if single_output:
+                outputs = (outputs, )
+            # operations may reuse their output arrays
+            return [np.array(output, dtype=np.float64) for output in outputs]
+
+        outputs = evaluate_stage(inputs, parameters)
+        d_outputs = [np.zeros((len(steps), ) + output.shape)
+                     for output in outputs]
+        derivatives = d_inputs + tuple(parameter_directions)
+        for i, step in enumerate(steps):
+            if not any(derivative is not None and np.any(derivative[i])
+                       for derivative in derivatives):
+                continue
+            perturbed_inputs = tuple(
+                value if derivative is None else value + step * derivative[i]
+                for value, derivative in zip(inputs, d_inputs))
+            perturbed_parameters = tuple(
+                value if direction is None else value + step * direction[i]
+                for value, direction in zip(parameters, parameter_directions))
+            perturbed_outputs = evaluate_stage(perturbed_inputs,
+                                               perturbed_parameters)
+            for d_output, output, perturbed_output in zip(
+                    d_outputs, outputs, perturbed_outputs):
+                d_output[i] = (perturbed_output - output) / step
+
+        return tuple(outputs) + tuple(d_outputs)
+
+    def _run_derivative_stages(self, operations, stages, parameters,
+                               parameter_directions, steps, inputs, d_inputs):
+        for operation, (evaluate, start, stop, single_output) in zip(
+                operations, stages):
+            stage_parameters = parameters[start:stop]
+            stage_directions = parameter_directions[start:stop]
+            if hasattr(operation, 'evaluate_derivative'):
+                results = operation.evaluate_derivative(
+                    *(inputs + d_inputs + (stage_directions, ) +
+                      stage_parameters))
+            else:
+                results = self._finite_difference_derivative(
+                    evaluate, single_output, stage_parameters,
+                    stage_directions, steps, inputs, d_inputs)
+            n_outputs = len(results) // 2
+            inputs = tuple(results[:n_outputs])
+            d_inputs = tuple(results[n_outputs:])
+        return inputs, d_inputs
+
+    def evaluate_jacobian(self, *parameters):
+        """
+        Evaluate the model for a single parameter vector together with the
+        derivatives with respect to the free parameters
+
+        Returns
+        -------
+            : ~np.ndarray or tuple
+            outputs of `evaluate`
+            : ~np.ndarray or tuple
+            derivatives of each output (n_free_parameters, ) + output shape
+        """
+        parameters = tuple(float(np.ravel(parameter)[0])
+                           for parameter in parameters)
+        free_index = np.flatnonzero(~self._fixed_mask())
+        parameter_directions = [None] * len(parameters)
+        for i, parameter_index in enumerate(free_index):
+            parameter_directions[parameter_index] = np.zeros(len(free_index))
+            parameter_directions[parameter_index][i] = 1.
+        # steps for operations without derivatives
+        steps = 1e-6 * np.maximum(np.abs(np.array(parameters)[free_index]),
+                                  1.)
+
+        def run(operations, stages, inputs, d_inputs):
+            return self._run_derivative_stages(
+                operations, stages, parameters, parameter_directions, steps,
+                inputs, d_inputs)
+
+        outputs, d_outputs = run([self.grid], [self._grid_stage], (), ())
+        outputs, d_outputs = run(self.stellar_operations,
+                                 self._stellar_stages, outputs, d_outputs)
+
+        if self._spectrograph_stages and self._imager_stages:
+            spectrograph_outputs, spectrograph_d_outputs = run(
+                self.spectrograph_operations, self._spectrograph_stages,
+                outputs, d_outputs)
+            imager_outputs, imager_d_outputs = run(
+                self.imager_operations, self._imager_stages, outputs,
+                d_outputs)
+            outputs = spectrograph_outputs + imager_outputs
+            d_outputs = spectrograph_d_outputs + imager_d_outputs
+        else:
+            outputs, d_outputs = run(self.spectrograph_operations,
+                                     self._spectrograph_stages, outputs,
+                                     d_outputs)
+            outputs, d_outputs = run(self.imager_operations,
+                                     self._imager_stages, outputs, d_outputs)
+
+        if self.likelihood is not None:
+            outputs, d_outputs = run([self.likelihood],
+                                     self._likelihood_stages, outputs,
+                                     d_outputs)
+
+        d_outputs = tuple(
+            np.zeros((len(free_index), ) + np.shape(output))
+            if d_output is None else d_output
+            for output, d_output in zip(outputs, d_outputs))
+        if len(outputs) == 1:
+            return outputs[0], d_outputs[0]
+        return outputs, d_outputs
+
+    def jacobian(self, *parameters):
+        """
+        Derivatives of the outputs with respect to the free parameters for
+        a single parameter vector (see `evaluate_jacobian`)
+        """
+        return self.evaluate_jacobian(*parameters)[1]
+
+    def __call__(self, *parameters):
+        if len(parameters) == 0:
+            parameters = tuple(self.model.parameters)
+        return self.evaluate(*parameters)
+
+    def __or__(self, other):
+        if self.likelihood is not None:
+            raise ValueError('Model already ends in {0}'.format(
+                self.likelihood))
+        return CompiledModel(
+            self.model | other, self.grid,
+            stellar_operations=self.stellar_operations,
+            spectrograph_operations=self.spectrograph_operations,
+            imager_operations=self.imager_operations, likelihood=other)
+
+    def __getattr__(self, item):
+        if item == 'model':
+            raise AttributeError(item)
+        return getattr(self.model, item)
+
+    def __setattr__(self, item, value):
+        model = self.__dict__.get('model', None)
+        if model is not None and (item == 'parameters' or
+                                  item in model.param_names):
+            setattr(model, item, value)
+        else:
+            super(CompiledModel, self).__setattr__(item, value)
+
+    def __repr__(self):
+        return 'Compiled {0}'.format(repr(self.model))
@@ -2,12 +2,120 @@ from astropy import modeling
 from collections import OrderedDict
 from itertools import chain
 
+import numpy as np
+
+from starkit.utils.resample import LogLambdaResampler
+
+
+def stacked_parameter(parameter, flux):
+    """
+    Shape a parameter so that it broadcasts against single or stacked spectra
+
+    Parameters
+    ----------
+
+    parameter: float or ~np.ndarray
+        a single value or one value per spectrum
+
+    flux: ~np.ndarray
+        single spectrum (n_wavelength, ) or stacked spectra
+        (n_spectra, n_wavelength)
+
+    Returns
+    -------
+        : float or ~np.ndarray
+        float for a single value, otherwise an (n_spectra, 1) array
+    """
+    parameter = np.asarray(parameter, dtype=np.float64)
+    if parameter.size == 1:
+        return parameter.item()
+
+    if np.ndim(flux) != 2 or len(flux) != parameter.size:
+        raise ValueError('Got {0} parameter values for flux of shape '
+                         '{1}'.format(parameter.size, np.shape(flux)))
+    return parameter.reshape(-1, 1)
+
+
+def add_derivatives(*derivatives):
+    """
+    Sum derivatives where None stands for zero
+
+    Returns
+    -------
+        : ~np.ndarray or None
+        None if all derivatives are None
+    """
+    result = None
+    for derivative in derivatives:
+        if derivative is not None:
+            result = derivative if result is None else result + derivative
+    return result
+
+
+def parameter_derivative(direction, derivative):
+    """
+    Contribution of a parameter to the derivatives along the directions
+
+    Parameters
+    ----------
+
+    direction: ~np.ndarray or None
+        derivative of the parameter along each direction (n_directions, ) -
+        None for a fixed parameter
+
+    derivative: ~np.ndarray
+        derivative of the output with respect to the parameter
+
+    Returns
+    -------
+        : ~np.ndarray or None
+        (n_directions, ) + shape of derivative
+    """
+    if direction is None:
+        return None
+    return np.multiply.outer(direction, derivative)
+
 
 class SpectralOperationModel(modeling.FittableModel):
+    """
+    Base class for operations on spectra
+
+    Operations accept a single spectrum (flux of shape (n_wavelength, )) or
+    stacked spectra (flux of shape (n_spectra, n_wavelength)). For stacked
+    spectra the wavelength is either shared (n_wavelength, ) or given per
+    spectrum and parameters are either single values or one value per
+    spectrum.
+
+    Operations can provide derivatives for a single spectrum through
+    `evaluate_derivative(wavelength, flux, d_wavelength, d_flux,
+    parameter_directions, *parameters)`. d_wavelength and d_flux are the
+    derivatives of the inputs along a number of directions (e.g. the free
+    parameters of a model) with shape (n_directions, n_wavelength), and
+    parameter_directions holds the derivative of each parameter along these
+    directions ((n_directions, ) arrays). None stands for zero (e.g. fixed
+    parameters). The method returns the outputs followed by their
+    derivatives.
+    """
 
     inputs = ('wavelength', 'flux')
     outputs = ('wavelength', 'flux')
 
+    def _get_log_resampler(self, wavelength):
+        """
+        Resampler between the given wavelength grid and a log-lambda grid
+
+        The resampler is created once and reused as long as the wavelength
+        grid stays the same (up to a doppler shift).
+        """
+        if np.ndim(wavelength) > 1:
+            # stacked wavelengths only differ by doppler shifts
+            wavelength = wavelength[0]
+        resampler = getattr(self, '_log_resampler', None)
+        if resampler is None or not resampler.matches(wavelength):
+            resampler = LogLambdaResampler(wavelength)
+            self._log_resampler = resampler
+        return resampler
+
 class InstrumentOperationModel(SpectralOperationModel):
     pass
 
@@ -20,3 +128,8 @@ class DoubleSpectrum(SpectralOperationModel):
     def evaluate(self, wavelength, flux):
         return wavelength, flux, wavelength, flux
 
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions):
+        return (wavelength, flux, wavelength, flux,
+                d_wavelength, d_flux, d_wavelength, d_flux)
+
@@ -1,17 +1,54 @@
 import numpy as np
+from scipy import sparse
 
 from astropy import units as u
 from starkit.fix_spectrum1d import Spectrum1D
-from starkit.base.operations.base import InstrumentOperationModel
+from starkit.base.operations.base import (InstrumentOperationModel,
+                                          add_derivatives)
+from starkit.utils.resample import same_array
 
 class ImagerInstrumentOperation(InstrumentOperationModel):
     pass
 
 class Photometry(ImagerInstrumentOperation):
+    """
+    Synthetic photometry of a spectrum
+
+    For each model wavelength grid a sparse (n_filters, n_wavelength) matrix
+    of trapezoidal integration weights (transmission * wavelength * d
+    wavelength) is computed once, so the magnitudes are a matrix-vector
+    product plus a logarithm. For doppler-shifted versions of the grid only
+    the transmission of the covered pixels is interpolated again. The zero
+    points are calibrated once against wsynphot's magnitudes of a flat
+    reference spectrum sampled on the filter curves. The units of the model
+    spectra are resolved at construction, so the evaluation only sees plain
+    arrays.
+
+    Parameters
+    ----------
+
+    filter_set: ~wsynphot.FilterSet or list of str
+        filters to use
+
+    mag_type: str
+        magnitude system - 'vega' or 'ab' [default 'vega']
+
+    wavelength_unit: ~astropy.units.Unit
+        wavelength unit of the model spectra [default Angstrom]
+
+    flux_unit: ~astropy.units.Unit
+        flux density (per wavelength) unit of the model spectra - None for
+        erg / (s cm2 Angstrom) [default None]
+    """
     inputs = ('wavelength', 'flux')
     outputs = ('photometry',)
 
-    def __init__(self, filter_set, mag_type='vega'):
+    # largest ln(doppler factor) for which a shifted grid reuses the
+    # structure of the integration matrix (~3000 km/s)
+    max_log_shift = 1e-2
+
+    def __init__(self, filter_set, mag_type='vega', wavelength_unit=u.angstrom,
+                 flux_unit=None):
         super(Photometry, self).__init__()
         try:
             from wsynphot import FilterSet
@@ -26,10 +63,191 @@ class Photometry(ImagerInstrumentOperation):
         self.calculate_magnitudes = getattr(
             self.filter_set, 'calculate_{0}_magnitudes'.format(mag_type))
 
+        filters = getattr(self.filter_set, 'filter_set', self.filter_set)
+        self._filter_curves = [
+            (u.Quantity(filter_curve.wavelength, u.angstrom).value,
+             np.asarray(filter_curve.transmission_lambda, dtype=np.float64))
+            for filter_curve in filters]
+
+        # factors converting the model spectra to Angstrom and
+        # erg / (s cm2 Angstrom)
+        try:
+            self._wavelength_factor = u.Unit(wavelength_unit).to(u.angstrom)
+            if flux_unit is None:
+                self._flux_factor = 1.
+            else:
+                self._flux_factor = u.Unit(flux_unit).to(
+                    u.erg / u.s / u.cm**2 / u.angstrom)
+        except u.UnitsError:
+            raise ValueError('Photometry needs wavelengths and flux densities '
+                             'per wavelength (got {0} and {1})'.format(
+                wavelength_unit, flux_unit))
+
+        self._wavelength = None
+        self._integration_matrix = None
+        self._reference_wavelength = None
+        self._reference_matrix = None
+        self.zero_points = self._calibrate_zero_points()
+
+    def _calculate_integration_matrix(self, wavelength):
+        wavelength = (np.asarray(wavelength, dtype=np.float64) *
+                      self._wavelength_factor)
+        # trapezoidal weights of the wavelength grid
+        delta_wavelength = np.diff(wavelength)
+        trapezoid_weights = 0.5 * (np.hstack((delta_wavelength, 0)) +
+                                   np.hstack((0, delta_wavelength)))
+
+        rows, columns, values = [], [], []
+        for i, (filter_wavelength, transmission) in enumerate(
+                self._filter_curves):
+            filter_transmission = np.interp(wavelength, filter_wavelength,
+                                            transmission, left=0, right=0)
+            nonzero = np.nonzero(filter_transmission)[0]
+            rows.append(np.ones_like(nonzero) * i)
+            columns.append(nonzero)
+            values.append(filter_transmission[nonzero] * wavelength[nonzero] *
+                          trapezoid_weights[nonzero] * self._flux_factor)
+
+        return sparse.csr_matrix(
+            (np.concatenate(values),
+             (np.concatenate(rows), np.concatenate(columns))),
+            shape=(len(self._filter_curves), len(wavelength)))
+
+    def _calibrate_zero_points(self):
+        calibration_wavelength = np.unique(np.concatenate(
+            [filter_wavelength
+             for filter_wavelength, _ in self._filter_curves]))
+        calibration_flux = np.ones_like(calibration_wavelength)
+        spec = Spectrum1D.from_array(
+            calibration_wavelength * u.angstrom,
+            calibration_flux * u.erg/u.s/u.cm**2/u.angstrom)
+        magnitudes = np.array(
+            u.Quantity(self.calculate_magnitudes(spec)).value)
+        # in model units
+        filter_fluxes = self._calculate_integration_matrix(
+            calibration_wavelength / self._wavelength_factor).dot(
+            calibration_flux / self._flux_factor)
+        return magnitudes + 2.5 * np.log10(filter_fluxes)
+
+    def _set_reference_wavelength(self, wavelength):
+        # columns of the pixels each filter can cover for doppler shifts up
+        # to max_log_shift and their wavelength * trapezoidal weights
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        angstrom_wavelength = wavelength * self._wavelength_factor
+        delta_wavelength = np.diff(angstrom_wavelength)
+        trapezoid_weights = 0.5 * (np.hstack((delta_wavelength, 0)) +
+                                   np.hstack((0, delta_wavelength)))
+        margin = np.exp(self.max_log_shift)
+
+        columns = []
+        for filter_wavelength, _ in self._filter_curves:
+            columns.append(np.flatnonzero(
+                (angstrom_wavelength * margin >= filter_wavelength.min()) &
+                (angstrom_wavelength / margin <= filter_wavelength.max())))
+        self._columns = np.concatenate(columns)
+        self._indptr = np.hstack((0, np.cumsum(
+            [len(filter_columns) for filter_columns in columns])))
+        self._column_wavelength = angstrom_wavelength[self._columns]
+        self._column_weights = (angstrom_wavelength * trapezoid_weights *
+                                self._flux_factor)[self._columns]
+        self._reference_wavelength = wavelength
+        self._reference_matrix = self._shifted_integration_matrix(1.)
+
+    def _shifted_integration_matrix(self, scale):
+        """
+        Integration matrix for the cached wavelength grid multiplied by
+        scale - the weights of a shifted grid scale by scale**2 and only the
+        transmission needs to be interpolated again
+        """
+        shifted_wavelength = self._column_wavelength * scale
+        data = np.empty_like(shifted_wavelength)
+        for i, (filter_wavelength, transmission) in enumerate(
+                self._filter_curves):
+            part = slice(self._indptr[i], self._indptr[i + 1])
+            data[part] = np.interp(shifted_wavelength[part], filter_wavelength,
+                                   transmission, left=0, right=0)
+        data *= self._column_weights * scale ** 2
+        return sparse.csr_matrix(
+            (data, self._columns, self._indptr),
+            shape=(len(self._filter_curves), len(self._reference_wavelength)))
+
+    def _wavelength_scale(self, wavelength):
+        """
+        Factor between the wavelength and the cached grid - None if the
+        wavelength is not a scaled version of the cached grid
+        """
+        reference = self._reference_wavelength
+        if reference is None or np.shape(wavelength) != reference.shape:
+            return None
+        scale = wavelength / reference
+        if (scale.max() - scale.min() > 1e-12 or
+                abs(np.log(scale[0])) > self.max_log_shift):
+            return None
+        return scale[0]
+
+    def get_integration_matrix(self, wavelength):
+        """
+        Sparse integration matrix for the given model wavelength
+
+        The matrix of the last wavelength is cached. Doppler-shifted
+        versions of the cached grid reuse its structure and weights.
+        """
+        if same_array(wavelength, self._wavelength):
+            return self._integration_matrix
+
+        scale = self._wavelength_scale(wavelength)
+        if scale is None:
+            self._set_reference_wavelength(wavelength)
+            integration_matrix = self._reference_matrix
+        elif scale == 1:
+            integration_matrix = self._reference_matrix
+        else:
+            integration_matrix = self._shifted_integration_matrix(scale)
+
+        self._wavelength = wavelength
+        self._integration_matrix = integration_matrix
+        return integration_matrix
 
     def evaluate(self, wavelength, flux):
-        spec = Spectrum1D.from_array(wavelength * u.angstrom,
-                                     flux * u.erg/u.s/u.cm**2/u.angstrom)
-        return np.array(u.Quantity(self.calculate_magnitudes(spec)).value)
+        if np.ndim(wavelength) == 1:
+            filter_fluxes = np.asarray(
+                self.get_integration_matrix(wavelength).dot(flux.T)).T
+        else:
+            filter_fluxes = np.array(
+                [self.get_integration_matrix(wavelength[i]).dot(flux[i])
+                 for i in range(len(flux))])
+
+        return -2.5 * np.log10(filter_fluxes) + self.zero_points
+
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions):
+        integration_matrix = self.get_integration_matrix(wavelength)
+        filter_fluxes = integration_matrix.dot(flux)
+        magnitudes = -2.5 * np.log10(filter_fluxes) + self.zero_points
+
+        d_filter_fluxes = None
+        if d_flux is not None:
+            d_filter_fluxes = np.asarray(integration_matrix.dot(d_flux.T)).T
 
+        if d_wavelength is not None:
+            # central differences of the integration weights
+            wavelength_d_filter_fluxes = np.zeros((len(d_wavelength),
+                                                   len(filter_fluxes)))
+            for i, current_d_wavelength in enumerate(d_wavelength):
+                max_d_wavelength = np.max(np.abs(current_d_wavelength))
+                if max_d_wavelength == 0:
+                    continue
+                step = 1e-6 * np.mean(wavelength) / max_d_wavelength
+                wavelength_d_filter_fluxes[i] = (
+                    self._calculate_integration_matrix(
+                        wavelength + step * current_d_wavelength).dot(flux) -
+                    self._calculate_integration_matrix(
+                        wavelength - step * current_d_wavelength).dot(flux)
+                ) / (2 * step)
+            d_filter_fluxes = add_derivatives(d_filter_fluxes,
+                                              wavelength_d_filter_fluxes)
 
+        if d_filter_fluxes is None:
+            return magnitudes, None
+        return magnitudes, (-2.5 / np.log(10) * d_filter_fluxes /
+                            filter_fluxes)
@@ -4,12 +4,17 @@ import numpy as np
 from numpy.polynomial import Polynomial
 
 from scipy import ndimage as nd
+from scipy import sparse
 from astropy import modeling
 from astropy import units as u, constants as const
 
 from starkit.base.operations.base import (SpectralOperationModel,
-                                          InstrumentOperationModel)
+                                          InstrumentOperationModel,
+                                          add_derivatives,
+                                          parameter_derivative)
 from starkit.fix_spectrum1d import Spectrum1D
+from starkit.utils.resample import (same_array, linear_interpolation_weights,
+                                    apply_interpolation_weights)
 
 def prepare_observed(observed):
     """
@@ -38,7 +43,38 @@ def prepare_observed(observed):
     return spec
 
 
+def convert_observed(observed, wavelength_unit):
+    """
+    Express the wavelength of an observed spectrum in a given unit
+
+    The pixel order is kept. Done once when a model is assembled, so that
+    the evaluation only sees plain arrays in the units of the grid.
+
+    Parameters
+    ----------
+    observed: Spectrum1D object
 
+    wavelength_unit: ~astropy.units.Unit
+        target wavelength unit, e.g. the one of the grid
+
+    Returns
+    -------
+        : Spectrum1D object
+    """
+    wavelength = observed.wavelength
+    if wavelength.unit == wavelength_unit:
+        return observed
+
+    try:
+        wavelength = wavelength.to(wavelength_unit)
+    except u.UnitsError:
+        raise ValueError('Observed wavelength unit {0} can not be converted '
+                         'to {1}'.format(wavelength.unit, wavelength_unit))
+
+    spec = Spectrum1D.from_array(wavelength, observed.flux)
+    uncertainty = getattr(observed, 'uncertainty', None)
+    spec.uncertainty = getattr(uncertainty, 'array', uncertainty)
+    return spec
 
 
 class SpectrographOperationModel(InstrumentOperationModel):
@@ -61,7 +97,7 @@ class InstrumentConvolve(SpectrographOperationModel):
 
     operation_name = 'resolution'
 
-    R = modeling.Parameter()
+    R = modeling.Parameter(bounds=(0, None))
     requires_observed = False
 
 
@@ -75,20 +111,70 @@ class InstrumentConvolve(SpectrographOperationModel):
         super(InstrumentConvolve, self).__init__(R=R)
         self.grid_sampling = grid_sampling
         self.grid_R = grid_R
+        self.c_in_kms = const.c.to(u.km / u.s).value
 
     def evaluate(self, wavelength, flux, R):
+        R = np.ravel(R)
+        if self.grid_R is not None or np.all(np.isinf(R)):
+            return wavelength, self._convolve_stacked(flux, R)
+
+        # resolution of the grid not known (e.g. linearly sampled) - treat
+        # it as unresolved and convolve on an internal log-lambda grid
+        resampler = self._get_log_resampler(wavelength)
+        convolved_flux = self._convolve_stacked(
+            resampler.to_log(flux), R, resampler.velocity_per_pix)
+        return wavelength, resampler.from_log(convolved_flux)
+
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions, R):
+        R = float(np.ravel(R)[0])
+        if self.grid_R is not None or np.isinf(R):
+            convolve = self._convolve
+        else:
+            resampler = self._get_log_resampler(wavelength)
+
+            def convolve(flux, R):
+                return resampler.from_log(self._convolve(
+                    resampler.to_log(flux), R, resampler.velocity_per_pix))
+
+        convolved_flux = convolve(flux, R)
+        # linear in flux - the derivatives are convolved with the same kernel
+        if d_flux is not None:
+            d_flux = convolve(d_flux, R)
+
+        if parameter_directions[0] is not None and not np.isinf(R):
+            step = 1e-4 * R
+            d_flux = add_derivatives(d_flux, parameter_derivative(
+                parameter_directions[0],
+                (convolve(flux, R + step) - convolve(flux, R - step)) /
+                (2 * step)))
+
+        return wavelength, convolved_flux, d_wavelength, d_flux
+
+    def _convolve_stacked(self, flux, R, velocity_per_pix=None):
+        if R.size == 1:
+            return self._convolve(flux, R[0], velocity_per_pix)
+
+        convolved_flux = np.empty_like(flux)
+        for i in range(len(flux)):
+            convolved_flux[i] = self._convolve(flux[i], R[i],
+                                               velocity_per_pix)
+        return convolved_flux
+
+    def _convolve(self, flux, R, velocity_per_pix=None):
         if np.isinf(R):
-            return wavelength, flux
+            return flux
 
-        if self.grid_R is None:
-            raise NotImplementedError('grid_R not given - this mode is not '
-                                      'implemented yet')
-        rescaled_R = 1 / np.sqrt((1/R)**2 - (1 / self.grid_R)**2 )
+        if velocity_per_pix is None:
+            rescaled_R = 1 / np.sqrt((1/R)**2 - (1 / self.grid_R)**2 )
 
-        sigma = ((self.grid_R / rescaled_R) * self.grid_sampling /
+            sigma = ((self.grid_R / rescaled_R) * self.grid_sampling /
+                         (2 * np.sqrt(2 * np.log(2))))
+        else:
+            sigma = (self.c_in_kms / R / velocity_per_pix /
                      (2 * np.sqrt(2 * np.log(2))))
 
-        return wavelength, nd.gaussian_filter1d(flux, sigma)
+        return nd.gaussian_filter1d(flux, sigma, axis=-1)
 
 class Interpolate(SpectrographOperationModel):
 
@@ -97,31 +183,266 @@ class Interpolate(SpectrographOperationModel):
     You must initialize it with the observed spectrum. The output will be a
     Spectrum1D object.
 
+    Single spectra are resampled with `np.interp`, as their wavelength
+    usually changes with every call (doppler shift). For stacked spectra on
+    a common wavelength grid the interpolation indices and weights are
+    calculated once per call and cached until the wavelength changes.
+
     Parameters
     ----------
     observed: Spectrum1D object
         This is the observed spectrum which you want to interpolate your
         (model) spectrum to.
+
+    mode: str
+        'interpolate' samples the model linearly at the observed wavelengths,
+        'rebin' integrates the model over the observed pixels (conserving
+        flux), which allows the model to be sampled more coarsely. Observed
+        pixels that are not fully covered by the model pixels are nan in
+        'rebin' mode [default 'interpolate']
     """
 
     requires_observed = True
     operation_name = 'interpolate'
 
-    def __init__(self, observed):
+    def __init__(self, observed, mode='interpolate'):
         super(SpectralOperationModel, self).__init__()
+        if mode not in ('interpolate', 'rebin'):
+            raise ValueError('mode {0} not understood - use interpolate or '
+                             'rebin'.format(mode))
+        self.mode = mode
         self._update_observed_spectrum(observed)
 
     def _update_observed_spectrum(self, observed):
         self.observed = prepare_observed(observed)
+        self._observed_wavelength = self.observed.wavelength.value
+        self._observed_edges = self._pixel_edges(self._observed_wavelength)
+        self._observed_widths = np.diff(self._observed_edges)
+        self._model_wavelength = None
+        self._interpolation_weights = None
+
+    @staticmethod
+    def _pixel_edges(wavelength):
+        midpoints = 0.5 * (wavelength[1:] + wavelength[:-1])
+        return np.hstack(([2 * wavelength[0] - midpoints[0]], midpoints,
+                          [2 * wavelength[-1] - midpoints[-1]]))
+
+    def _calculate_weights(self, wavelength):
+        if self.mode == 'interpolate':
+            return linear_interpolation_weights(self._observed_wavelength,
+                                                wavelength)
+        else:
+            model_edges = self._pixel_edges(wavelength)
+            index, weight = linear_interpolation_weights(self._observed_edges,
+                                                         model_edges)
+            return (index, weight, np.diff(model_edges),
+                    self._uncovered_pixels(model_edges))
+
+    def _uncovered_pixels(self, model_edges):
+        # the cumulative flux is constant beyond the model edges, which
+        # would silently bias the rebinned flux of these pixels
+        return ((self._observed_edges[:-1] < model_edges[0]) |
+                (self._observed_edges[1:] > model_edges[-1]))
+
+    def _get_interpolation_weights(self, wavelength):
+        if not same_array(wavelength, self._model_wavelength):
+            self._interpolation_weights = self._calculate_weights(wavelength)
+            self._model_wavelength = wavelength
+        return self._interpolation_weights
+
+    @staticmethod
+    def _cumulative_flux(flux, model_widths):
+        # integrated flux at the model pixel edges - interpolating it
+        # linearly treats the flux as constant within each model pixel
+        cumulative_flux = np.zeros(flux.shape[:-1] + (flux.shape[-1] + 1,))
+        np.cumsum(flux * model_widths, axis=-1, out=cumulative_flux[..., 1:])
+        return cumulative_flux
+
+    def _resample(self, flux, weights):
+        if self.mode == 'interpolate':
+            return apply_interpolation_weights(flux, *weights)
+
+        index, weight, model_widths, uncovered = weights
+        observed_cumulative_flux = apply_interpolation_weights(
+            self._cumulative_flux(flux, model_widths), index, weight)
+        resampled_flux = (np.diff(observed_cumulative_flux, axis=-1) /
+                          self._observed_widths)
+        resampled_flux[..., uncovered] = np.nan
+        return resampled_flux
+
+    def _interp(self, wavelength, flux):
+        """
+        Resample a single spectrum with `np.interp`
+        """
+        if self.mode == 'interpolate':
+            return np.interp(self._observed_wavelength, wavelength, flux)
+
+        model_edges = self._pixel_edges(wavelength)
+        resampled_flux = (np.diff(np.interp(
+            self._observed_edges, model_edges,
+            self._cumulative_flux(flux, np.diff(model_edges)))) /
+                          self._observed_widths)
+        resampled_flux[self._uncovered_pixels(model_edges)] = np.nan
+        return resampled_flux
 
     def evaluate(self, wavelength, flux):
-        return self.observed.wavelength.value, np.interp(self.observed.wavelength.value,
-                                      wavelength, flux)
+        observed_wavelength = self._observed_wavelength
+        if np.ndim(wavelength) == 1 and np.ndim(flux) == 1:
+            # the model wavelength changes with every doppler shift, where
+            # np.interp is faster than calculating (and applying) weights
+            return observed_wavelength, self._interp(wavelength, flux)
+        elif np.ndim(wavelength) == 1:
+            # the weights are shared by the stacked spectra
+            return observed_wavelength, self._resample(
+                flux, self._get_interpolation_weights(wavelength))
+
+        resampled_flux = np.empty((len(flux), len(observed_wavelength)))
+        for i in range(len(flux)):
+            resampled_flux[i] = self._interp(wavelength[i], flux[i])
+        return observed_wavelength, resampled_flux
+
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions):
+        weights = self._get_interpolation_weights(wavelength)
+        resampled_flux = self._resample(flux, weights)
+        # linear in flux
+        if d_flux is not None:
+            d_flux = self._resample(d_flux, weights)
+
+        if d_wavelength is None:
+            return self._observed_wavelength, resampled_flux, None, d_flux
+
+        if self.mode == 'interpolate':
+            # moving the model pixels by d_wavelength changes the
+            # interpolated flux by -slope * d_wavelength
+            index, weight = weights
+            slope = ((flux[index + 1] - flux[index]) /
+                     (wavelength[index + 1] - wavelength[index]))
+            inside = ((self._observed_wavelength >= wavelength[0]) &
+                      (self._observed_wavelength <= wavelength[-1]))
+            d_resampled_flux = (-np.where(inside, slope, 0.) *
+                                apply_interpolation_weights(d_wavelength,
+                                                            index, weight))
+        else:
+            # central differences of the rebinning along each direction
+            d_resampled_flux = np.zeros((len(d_wavelength),
+                                         len(resampled_flux)))
+            pixel_size = np.median(np.diff(wavelength))
+            for i, current_d_wavelength in enumerate(d_wavelength):
+                max_d_wavelength = np.max(np.abs(current_d_wavelength))
+                if max_d_wavelength == 0:
+                    continue
+                step = 1e-3 * pixel_size / max_d_wavelength
+                d_resampled_flux[i] = (
+                    self._resample(flux, self._calculate_weights(
+                        wavelength + step * current_d_wavelength)) -
+                    self._resample(flux, self._calculate_weights(
+                        wavelength - step * current_d_wavelength))) / (2 * step)
+
+        return (self._observed_wavelength, resampled_flux, None,
+                add_derivatives(d_flux, d_resampled_flux))
+
+
+def solve_normal_equations(gram, rhs, max_condition=1e12):
+    """
+    Solve (stacked) normal equations via Cholesky decomposition
+
+    Parameters
+    ----------
+
+    gram: ~np.ndarray
+        symmetric matrices V^T V (..., k, k)
+
+    rhs: ~np.ndarray
+        right hand sides V^T y (..., k)
+
+    max_condition: float
+        rough upper limit for the condition number of the (scaled) gram
+        matrices [default 1e12]
+
+    Returns
+    -------
+        : ~np.ndarray or None
+        solutions (..., k) or None if the matrices are not positive definite
+        or are poorly conditioned
+    """
+    diagonal = np.diagonal(gram, axis1=-2, axis2=-1)
+    if not np.all(np.isfinite(gram)) or np.any(diagonal <= 0):
+        return None
+
+    # scale to unit diagonal to make the decomposition well behaved
+    scale = np.sqrt(diagonal)
+    scaled_gram = gram / (scale[..., :, np.newaxis] * scale[..., np.newaxis, :])
+    try:
+        lower = np.linalg.cholesky(scaled_gram)
+    except np.linalg.LinAlgError:
+        return None
+
+    lower_diagonal = np.diagonal(lower, axis1=-2, axis2=-1)
+    if np.any((lower_diagonal.max(-1) / lower_diagonal.min(-1)) ** 2
+              > max_condition):
+        return None
+
+    scaled_rhs = (rhs / scale)[..., np.newaxis]
+    solution = np.linalg.solve(
+        np.swapaxes(lower, -1, -2),
+        np.linalg.solve(lower, scaled_rhs))[..., 0]
+    return solution / scale
+
+
+def lstsq_polynomial(vander, flux, uncertainty, observed_flux, rcond=None):
+    """
+    Fit the polynomial continuum of a single model spectrum by weighted
+    least squares on the design matrix V = vander * flux / uncertainty -
+    slow fallback for `solve_normal_equations`, whose normal equations
+    square the condition number of V. Non-finite systems give nan
+    solutions.
+
+    Parameters
+    ----------
+
+    vander: ~np.ndarray
+        Vandermonde matrix of the (reduced) wavelengths (n_pixel, k)
+
+    flux: ~np.ndarray
+        model flux (n_pixel, )
+
+    uncertainty: ~np.ndarray
+        observed uncertainty (n_pixel, )
+
+    observed_flux: ~np.ndarray
+        observed flux (n_pixel, )
+
+    rcond: float
+        cut-off ratio for small singular values [default None]
+
+    Returns
+    -------
+        : ~np.ndarray
+        polynomial coefficients (k, )
+    """
+    V = vander * (flux / uncertainty)[:, np.newaxis]
+    if not np.all(np.isfinite(V)):
+        return np.ones(vander.shape[1]) * np.nan
+
+    # normalizes different powers
+    scale = np.sqrt((V * V).sum(0))
+    scale[scale == 0] = 1.
+    solution, residuals, rank, singular_values = np.linalg.lstsq(
+        V / scale, observed_flux / uncertainty, rcond)
+    if rank < vander.shape[1]:
+        warnings.warn("The fit may be poorly conditioned")
+    return solution / scale
 
 
 class Normalize(SpectrographOperationModel):
     """Normalize a model spectrum to an observed one using a polynomial
 
+    The polynomial is fitted by solving the (npol+1)-square normal
+    equations with a Cholesky decomposition, built from weighted powers of
+    the wavelength that are precomputed for the observed spectrum. Poorly
+    conditioned fits fall back to a least-squares solution.
+
     Parameters
     ----------
     observed : Spectrum1D object
@@ -142,47 +463,134 @@ class Normalize(SpectrographOperationModel):
     def _update_observed_spectrum(self, observed):
         self.observed = prepare_observed(observed)
 
-        self.signal_to_noise = (self.observed.flux.value /
-                                self.observed.uncertainty.value)
+        wavelength = self.observed.wavelength.value
+        observed_flux = self.observed.flux.value
+        self._uncertainty = self.observed.uncertainty.value
+        self.signal_to_noise = observed_flux / self._uncertainty
         self.flux_unit = observed.unit
-        self._rcond = (len(observed.flux.value) *
-                       np.finfo(observed.flux.dtype).eps)
-        self._Vp = np.polynomial.polynomial.polyvander(
-            observed.wavelength.value/observed.wavelength.mean().value - 1., self.npol)
-        self.domain = u.Quantity([observed.wavelength.min().value,
-                                  observed.wavelength.max().value])
-        self.window = self.domain/observed.wavelength.mean().value - 1.
-
+        self._rcond = (len(observed_flux) *
+                       np.finfo(observed_flux.dtype).eps)
+
+        # the observed spectrum is sorted by prepare_observed (as is the
+        # output of Interpolate)
+        reduced_wavelength = wavelength / wavelength.mean() - 1.
+        self._Vp = np.polynomial.polynomial.polyvander(reduced_wavelength,
+                                                       self.npol)
+
+        # V = Vp * flux/sigma, y = observed flux/sigma
+        # V^T V[j, k] = sum(flux**2 * x**(j+k) / sigma**2)
+        # V^T y[j] = sum(flux * observed flux * x**j / sigma**2)
+        self._weighted_powers = (np.polynomial.polynomial.polyvander(
+            reduced_wavelength, 2 * self.npol) /
+                                 self._uncertainty[:, np.newaxis] ** 2)
+        self._observed_weighted_powers = (
+            self._weighted_powers[:, :self.npol + 1] *
+            observed_flux[:, np.newaxis])
+        self._gram_index = np.add.outer(np.arange(self.npol + 1),
+                                        np.arange(self.npol + 1))
+
+        self.domain = u.Quantity([wavelength.min(), wavelength.max()])
+        self.window = self.domain / wavelength.mean() - 1.
+
+    def _normal_equations(self, flux):
+        """
+        Calculate the normal equations of the polynomial fit for (stacked)
+        model fluxes
+
+        Returns
+        -------
+            : ~np.ndarray
+            gram matrices V^T V (..., npol+1, npol+1)
+            : ~np.ndarray
+            right hand sides V^T y (..., npol+1)
+        """
+        moments = np.dot(flux ** 2, self._weighted_powers)
+        gram = moments[..., self._gram_index]
+        rhs = np.dot(flux, self._observed_weighted_powers)
+        return gram, rhs
+
+    def _normal_equations_derivative(self, flux, d_flux):
+        """
+        Derivatives of the normal equations of a single model flux along
+        the directions of d_flux (n_directions, n_wavelength)
+        """
+        d_moments = np.dot(2 * flux * d_flux, self._weighted_powers)
+        d_gram = d_moments[..., self._gram_index]
+        d_rhs = np.dot(d_flux, self._observed_weighted_powers)
+        return d_gram, d_rhs
 
     def evaluate(self, wavelength, flux):
-        # V[:,0]=mfi/e, Vp[:,1]=mfi/e*w, .., Vp[:,npol]=mfi/e*w**npol
-
-        V = self._Vp * (flux / self.observed.uncertainty.value)[:, np.newaxis]
-        # normalizes different powers
-        scl = np.sqrt((V*V).sum(0))
-        if np.isfinite(scl[0]):  # check for validity before evaluating
-            sol, resids, rank, s = np.linalg.lstsq(V/scl, self.signal_to_noise,
-                                                   self._rcond)
-            sol = (sol.T / scl).T
-            if rank != self._Vp.shape[-1] - 1:
-                msg = "The fit may be poorly conditioned"
-                warnings.warn(msg)
-
-            fit = np.dot(V, sol) * self.observed.uncertainty.value
+        gram, rhs = self._normal_equations(flux)
+        solution = solve_normal_equations(gram, rhs)
+        if solution is None:
+            if np.ndim(flux) == 1:
+                return wavelength, self._normalize_lstsq(flux)
+
+            normalized_flux = np.empty_like(flux)
+            for i in range(len(flux)):
+                normalized_flux[i] = self.evaluate(wavelength, flux[i])[1]
+            return wavelength, normalized_flux
+
+        if np.ndim(flux) == 1:
             # keep coefficients in case the outside wants to look at it
-            self.polynomial = Polynomial(sol, domain=self.domain.value,
+            self.polynomial = Polynomial(solution, domain=self.domain.value,
                                          window=self.window.value)
-            return wavelength, fit
-        else:
-            return wavelength, flux
-
 
-class NormalizeParts(object):
+        return wavelength, flux * np.dot(solution, self._Vp.T)
+
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions):
+        gram, rhs = self._normal_equations(flux)
+        solution = solve_normal_equations(gram, rhs)
+        if solution is None:
+            solution = self._lstsq_solution(flux)
+        continuum = np.dot(solution, self._Vp.T)
+
+        if d_flux is None:
+            return wavelength, flux * continuum, d_wavelength, None
+
+        # solution = gram^-1 rhs
+        d_gram, d_rhs = self._normal_equations_derivative(flux, d_flux)
+        d_solution = np.dot(d_rhs - np.dot(d_gram, solution),
+                            np.linalg.pinv(gram))
+        d_normalized_flux = (d_flux * continuum +
+                             flux * np.dot(d_solution, self._Vp.T))
+        return wavelength, flux * continuum, d_wavelength, d_normalized_flux
+
+    def _lstsq_solution(self, flux):
+        """
+        Least-squares solutions (..., npol+1) of the polynomial fit for
+        (stacked) model fluxes (see `lstsq_polynomial`)
+        """
+        solution = np.empty(flux.shape[:-1] + (self.npol + 1,))
+        for index in np.ndindex(flux.shape[:-1]):
+            solution[index] = lstsq_polynomial(
+                self._Vp, flux[index], self._uncertainty,
+                self.observed.flux.value, self._rcond)
+        return solution
+
+    def _normalize_lstsq(self, flux):
+        solution = self._lstsq_solution(flux)
+        if not np.all(np.isfinite(solution)):
+            return flux
+
+        # keep coefficients in case the outside wants to look at it
+        self.polynomial = Polynomial(solution, domain=self.domain.value,
+                                     window=self.window.value)
+        return flux * np.dot(self._Vp, solution)
+
+
+class NormalizeParts(SpectrographOperationModel):
     """Normalize a model spectrum to an observed one in multiple parts
 
     Here, different parts could, e.g., be different echelle orders or
     different chips for GMOS spectra.
 
+    The weighted Vandermonde matrices of all parts are stored as sparse
+    block matrices, so the normal equations of all parts are built with one
+    sparse product and solved together. Pixels outside all parts are set
+    to zero.
+
     Parameters
     ----------
     observed : Spectrum1D object
@@ -194,49 +602,188 @@ class NormalizeParts(object):
         Polynomial degrees for the different parts
     """
 
-
     requires_observed = True
 
+    operation_name = 'normalize_parts'
+
     def __init__(self, observed, parts, npol):
+        super(NormalizeParts, self).__init__()
         self.npol = npol
 
         self._update_observed_spectrum(observed, parts)
 
-    def _update_observed_spectrum(self, observed_spectrum, parts):
+    def _update_observed_spectrum(self, observed_spectrum, parts=None):
+        if parts is None:
+            parts = self.parts
         self.parts = parts
-        self.normalizers = []
         try:
             if len(parts) != len(self.npol):
                 raise ValueError("List of parts should match in length to "
                                  "list of degrees")
         except TypeError:  # npol is single number
-            npol = [self.npol]*len(parts)
+            npol = np.array([self.npol]*len(parts))
         else:
-            npol = self.npol
+            npol = np.array(self.npol)
+
+        self.observed = prepare_observed(observed_spectrum)
+        wavelength = self.observed.wavelength.value
+        observed_flux = self.observed.flux.value
+        inverse_variance = self.observed.uncertainty.value ** -2
+        n_pixel = len(wavelength)
+
+        # parts refer to the observed spectrum as given, while the model
+        # arrives sorted by wavelength (see prepare_observed)
+        wavelength_order = np.argsort(observed_spectrum.wavelength)
+        sorted_position = np.empty(n_pixel, dtype=np.int64)
+        sorted_position[wavelength_order] = np.arange(n_pixel)
+
+        n_parts = len(parts)
+        n_coefficients = npol.max() + 1
+        n_powers = 2 * n_coefficients - 1
+
+        vander_blocks = []
+        weighted_power_blocks = []
+        self._part_index = []
+        self._part_vander = []
+        for i, part in enumerate(parts):
+            part_index = np.sort(sorted_position[np.arange(n_pixel)[part]])
+            part_wavelength = wavelength[part_index]
+            reduced_wavelength = (part_wavelength / part_wavelength.mean()
+                                  - 1.)
+            self._part_index.append(part_index)
+            self._part_vander.append(np.polynomial.polynomial.polyvander(
+                reduced_wavelength, npol[i]))
+            vander_blocks.append(self._block(
+                part_index, i * n_coefficients,
+                np.polynomial.polynomial.polyvander(reduced_wavelength,
+                                                    n_coefficients - 1)))
+            weighted_power_blocks.append(self._block(
+                part_index, i * n_powers,
+                np.polynomial.polynomial.polyvander(reduced_wavelength,
+                                                    n_powers - 1) *
+                inverse_variance[part_index, np.newaxis]))
+
+        self._vander = self._stack_blocks(
+            vander_blocks, (n_pixel, n_parts * n_coefficients))
+        weighted_powers = self._stack_blocks(
+            weighted_power_blocks, (n_pixel, n_parts * n_powers))
+        self._weighted_powers_t = weighted_powers.T.tocsr()
+        self._observed_weighted_powers_t = self._stack_blocks(
+            [(rows, columns,
+              values * observed_flux[rows] * inverse_variance[rows])
+             for rows, columns, values in vander_blocks],
+            (n_pixel, n_parts * n_coefficients)).T.tocsr()
+
+        self._n_coefficients = n_coefficients
+        self._n_powers = n_powers
+        self._gram_index = np.add.outer(np.arange(n_coefficients),
+                                        np.arange(n_coefficients))
+        # coefficients above the degree of a part are pinned to zero
+        self._unused_coefficients = (np.arange(n_coefficients)[np.newaxis, :]
+                                     > npol[:, np.newaxis])
 
-        for part, _npol in zip(parts, npol):
-            self.normalizers.append(
-                Normalize(self.spectrum_1d_getitem(observed_spectrum, part), _npol))
+    @staticmethod
+    def _block(rows, column_offset, values):
+        n_rows, n_columns = values.shape
+        return (np.repeat(rows, n_columns),
+                np.tile(np.arange(n_columns) + column_offset, n_rows),
+                values.ravel())
 
+    @staticmethod
+    def _stack_blocks(blocks, shape):
+        rows, columns, values = [np.concatenate(item) for item in zip(*blocks)]
+        return sparse.coo_matrix((values, (rows, columns)),
+                                 shape=shape).tocsr()
 
     @staticmethod
-    def spectrum_1d_getitem(observed, part):
-        observed_part = Spectrum1D.from_array(
-            observed.wavelength[part],
-            observed.flux[part])
-        if getattr(observed, 'uncertainty', None) is not None:
-            observed_part.uncertainty = getattr(observed.uncertainty, 'array',
-                                                observed.uncertainty)[part]
-        return observed_part
-
-    def __call__(self, model):
-        fit = np.zeros_like(model.wavelength.value)
-        for part, normalizer in zip(self.parts, self.normalizers):
-            fit[part] = normalizer(self.spectrum_1d_getitem(model, part)).flux
-
-        return Spectrum1D.from_array(
-            model.wavelength.value,
-            fit, unit=self.normalizers[0].flux_unit,
-            dispersion_unit=model.wavelength.unit)
+    def _sparse_dot(matrix, flux):
+        return np.asarray(matrix.dot(flux.T)).T
+
+    def _normal_equations(self, flux):
+        n_parts = len(self.parts)
+        moments = self._sparse_dot(self._weighted_powers_t, flux ** 2)
+        moments = moments.reshape(flux.shape[:-1] +
+                                  (n_parts, self._n_powers))
+        gram = moments[..., self._gram_index]
+        rhs = self._sparse_dot(self._observed_weighted_powers_t, flux)
+        rhs = rhs.reshape(flux.shape[:-1] +
+                          (n_parts, self._n_coefficients))
+
+        unused = self._unused_coefficients
+        unused_pair = unused[:, :, np.newaxis] | unused[:, np.newaxis, :]
+        gram = np.where(unused_pair, np.eye(self._n_coefficients), gram)
+        rhs = np.where(unused, 0., rhs)
+        return gram, rhs
+
+    def _normal_equations_derivative(self, flux, d_flux):
+        """
+        Derivatives of the normal equations of a single model flux along
+        the directions of d_flux (n_directions, n_wavelength)
+        """
+        n_parts = len(self.parts)
+        n_directions = len(d_flux)
+        d_moments = self._sparse_dot(self._weighted_powers_t,
+                                     2 * flux * d_flux)
+        d_moments = d_moments.reshape(n_directions, n_parts, self._n_powers)
+        d_gram = d_moments[..., self._gram_index]
+        d_rhs = self._sparse_dot(self._observed_weighted_powers_t, d_flux)
+        d_rhs = d_rhs.reshape(n_directions, n_parts, self._n_coefficients)
+
+        unused = self._unused_coefficients
+        unused_pair = unused[:, :, np.newaxis] | unused[:, np.newaxis, :]
+        d_gram = np.where(unused_pair, 0., d_gram)
+        d_rhs = np.where(unused, 0., d_rhs)
+        return d_gram, d_rhs
+
+    def _lstsq_solution(self, flux):
+        """
+        Least-squares solutions (..., n_parts, n_coefficients) of the
+        polynomial fits for (stacked) model fluxes (see `lstsq_polynomial`)
+        """
+        observed_flux = self.observed.flux.value
+        uncertainty = self.observed.uncertainty.value
+        solution = np.zeros(flux.shape[:-1] + (len(self.parts),
+                                               self._n_coefficients))
+        for index in np.ndindex(flux.shape[:-1]):
+            for i, (part_index, vander) in enumerate(zip(self._part_index,
+                                                         self._part_vander)):
+                solution[index + (i, slice(0, vander.shape[1]))] = (
+                    lstsq_polynomial(vander, flux[index][part_index],
+                                     uncertainty[part_index],
+                                     observed_flux[part_index]))
+        return solution
 
+    def evaluate(self, wavelength, flux):
+        gram, rhs = self._normal_equations(flux)
+        solution = solve_normal_equations(gram, rhs)
+        if solution is None:
+            solution = self._lstsq_solution(flux)
+
+        continuum = self._sparse_dot(
+            self._vander, solution.reshape(flux.shape[:-1] + (-1,)))
 
+        if np.ndim(flux) == 1:
+            # keep coefficients in case the outside wants to look at it
+            self.coefficients = solution
+        return wavelength, flux * continuum
+
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions):
+        gram, rhs = self._normal_equations(flux)
+        solution = solve_normal_equations(gram, rhs)
+        if solution is None:
+            solution = self._lstsq_solution(flux)
+        continuum = self._sparse_dot(self._vander, solution.ravel())
+
+        if d_flux is None:
+            return wavelength, flux * continuum, d_wavelength, None
+
+        # solution = gram^-1 rhs for each part
+        d_gram, d_rhs = self._normal_equations_derivative(flux, d_flux)
+        d_solution = np.einsum('pij,dpj->dpi', np.linalg.pinv(gram),
+                               d_rhs - np.einsum('dpij,pj->dpi', d_gram,
+                                                 solution))
+        d_continuum = self._sparse_dot(self._vander,
+                                       d_solution.reshape(len(d_flux), -1))
+        return (wavelength, flux * continuum, d_wavelength,
+                d_flux * continuum + flux * d_continuum)
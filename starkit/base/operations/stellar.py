@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from astropy import constants as const, units as u
 from astropy import modeling
 import scipy.ndimage as nd
@@ -5,19 +7,50 @@ import scipy.ndimage as nd
 
 import numpy as np
 
-from starkit.base.operations.base import SpectralOperationModel
+from starkit.base.operations.base import (SpectralOperationModel,
+                                          stacked_parameter, add_derivatives,
+                                          parameter_derivative)
+from starkit.utils.resample import same_array
 
 class StellarOperationModel(SpectralOperationModel):
     pass
 
 class RotationalBroadening(StellarOperationModel):
+    """
+    Broaden a spectrum with a rotational profile
+
+    Kernels longer than `fft_threshold` pixels are applied by FFT
+    convolution. Callers that broaden the same spectrum with several kernels
+    (`evaluate_derivative`, `write_broadened_grid`) pass a dictionary to
+    `_broaden` that holds the flux transforms for the duration of the call,
+    so the spectrum is only transformed once.
+
+    Kernels are kept in a least-recently-used cache of `kernel_cache_size`
+    entries, computed on a lattice of vrot with 1/`kernel_subpixel_steps` of
+    a pixel spacing and limb darkening quantized to
+    `limb_darkening_resolution`. The kernel for a given vrot is interpolated
+    linearly between the two neighbouring lattice kernels, so the broadened
+    spectrum changes continuously with vrot. `kernel_cache_hits` and
+    `kernel_cache_misses` count the lookups of lattice kernels.
+    """
     operation_name = 'rotation'
-    vrot = modeling.Parameter()
-    limb_darkening = modeling.Parameter(fixed=True, default=0.6)
+    # the broadening only depends on |vrot|
+    vrot = modeling.Parameter(bounds=(0, None))
+    limb_darkening = modeling.Parameter(fixed=True, default=0.6,
+                                        bounds=(0, 1))
+
+    fft_threshold = 128
+    kernel_cache_size = 128
+    kernel_subpixel_steps = 1000
+    limb_darkening_resolution = 1e-4
 
     @classmethod
     def from_grid(cls, grid, vrot=0):
-        velocity_per_pix = getattr(grid, 'velocity_per_pix', None)
+        try:
+            velocity_per_pix = grid.velocity_per_pix
+        except (AttributeError, ValueError):
+            # not log-sampled - will be regridded internally
+            velocity_per_pix = None
 
         return cls(velocity_per_pix=velocity_per_pix, vrot=vrot)
 
@@ -35,13 +68,59 @@ class RotationalBroadening(StellarOperationModel):
             self.log_sampling = False
             self.velocity_per_pix = None
 
+        self.clear_kernel_cache()
+
+    def clear_kernel_cache(self):
+        self._kernel_cache = OrderedDict()
+        self.kernel_cache_hits = 0
+        self.kernel_cache_misses = 0
+
     def rotational_profile(self, vrot, limb_darkening):
-        vrot = float(vrot)
-        limb_darkening = float(limb_darkening)
+        vrot_steps = (np.abs(float(vrot)) / self.velocity_per_pix *
+                      self.kernel_subpixel_steps)
+        lower_steps = int(np.floor(vrot_steps))
+        fraction = vrot_steps - lower_steps
+        limb_darkening_steps = int(np.round(float(limb_darkening) /
+                                            self.limb_darkening_resolution))
+
+        profile = self._cached_profile(lower_steps, limb_darkening_steps)
+        if fraction == 0:
+            return profile
+
+        upper_profile = self._cached_profile(lower_steps + 1,
+                                             limb_darkening_steps)
+        # the upper kernel is at most one pixel wider on each side
+        pad = (len(upper_profile) - len(profile)) // 2
+        return ((1. - fraction) * np.pad(profile, pad, mode='constant') +
+                fraction * upper_profile)
+
+    def _cached_profile(self, vrot_steps, limb_darkening_steps):
+        key = (vrot_steps, limb_darkening_steps, self.velocity_per_pix)
+
+        profile = self._kernel_cache.pop(key, None)
+        if profile is None:
+            self.kernel_cache_misses += 1
+            profile = self._calculate_rotational_profile(vrot_steps,
+                                                         limb_darkening_steps)
+            if len(self._kernel_cache) >= self.kernel_cache_size:
+                self._kernel_cache.popitem(last=False)
+        else:
+            self.kernel_cache_hits += 1
+
+        self._kernel_cache[key] = profile
+        return profile
+
+    def _calculate_rotational_profile(self, vrot_steps, limb_darkening_steps):
+        if vrot_steps == 0:
+            return np.ones(1)
+
+        vrot = vrot_steps * self.velocity_per_pix / self.kernel_subpixel_steps
+        limb_darkening = limb_darkening_steps * self.limb_darkening_resolution
         vrot_by_c = np.maximum(0.0001, np.abs(vrot)) / self.c_in_kms
 
-        half_width_pix = np.round((vrot /
-                                   self.velocity_per_pix)).astype(int)
+        # the profile is zero beyond vrot - exact integer arithmetic keeps
+        # the kernel length stable when vrot jitters
+        half_width_pix = vrot_steps // self.kernel_subpixel_steps
         profile_velocity = (np.linspace(-half_width_pix, half_width_pix,
                                        2 * half_width_pix + 1)
                             * self.velocity_per_pix)
@@ -55,18 +134,143 @@ class RotationalBroadening(StellarOperationModel):
 
 
     def evaluate(self, wavelength, flux, v_rot, limb_darkening):
-        v_rot = np.asscalar(v_rot)
-        limb_darkening = np.asscalar(limb_darkening)
+        v_rot, limb_darkening = np.broadcast_arrays(np.ravel(v_rot),
+                                                    np.ravel(limb_darkening))
+        if self.log_sampling:
+            return wavelength, self._broaden_stacked(flux, v_rot,
+                                                     limb_darkening)
+
+        if np.all(np.abs(v_rot) < 1e-5):
+            return wavelength, flux
 
-        if self.velocity_per_pix is None:
-            raise NotImplementedError('Regridding not implemented yet')
+        # not log-sampled - broaden on an internal log-lambda grid
+        resampler = self._get_log_resampler(wavelength)
+        self.velocity_per_pix = resampler.velocity_per_pix
+        broadened_flux = self._broaden_stacked(resampler.to_log(flux), v_rot,
+                                               limb_darkening)
+        return wavelength, resampler.from_log(broadened_flux)
 
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions, v_rot, limb_darkening):
+        v_rot = float(np.ravel(v_rot)[0])
+        limb_darkening = float(np.ravel(limb_darkening)[0])
+
+        if self.log_sampling:
+            broaden = self._broaden
+        else:
+            resampler = self._get_log_resampler(wavelength)
+            self.velocity_per_pix = resampler.velocity_per_pix
+
+            def broaden(flux, v_rot, limb_darkening, flux_transforms=None):
+                return resampler.from_log(self._broaden(
+                    resampler.to_log(flux), v_rot, limb_darkening,
+                    flux_transforms))
+
+        # flux is broadened with up to five kernels - transform it only once
+        flux_transforms = {}
+        broadened_flux = broaden(flux, v_rot, limb_darkening, flux_transforms)
+        # linear in flux - the derivatives are broadened with the same kernel
+        if d_flux is not None:
+            d_flux = broaden(d_flux, v_rot, limb_darkening)
+
+        # central differences for the kernel parameters, with steps well
+        # above the quantization of the kernel cache
+        vrot_direction, limb_darkening_direction = parameter_directions
+        if vrot_direction is not None:
+            step = max(1e-2 * np.abs(v_rot), 0.1 * self.velocity_per_pix)
+            d_flux = add_derivatives(d_flux, parameter_derivative(
+                vrot_direction,
+                (broaden(flux, v_rot + step, limb_darkening, flux_transforms) -
+                 broaden(flux, v_rot - step, limb_darkening, flux_transforms))
+                / (2 * step)))
+        if limb_darkening_direction is not None:
+            step = 1e-2
+            d_flux = add_derivatives(d_flux, parameter_derivative(
+                limb_darkening_direction,
+                (broaden(flux, v_rot, limb_darkening + step, flux_transforms) -
+                 broaden(flux, v_rot, limb_darkening - step, flux_transforms))
+                / (2 * step)))
+
+        return wavelength, broadened_flux, d_wavelength, d_flux
+
+    def _broaden_stacked(self, flux, v_rot, limb_darkening):
+        if v_rot.size == 1:
+            return self._broaden(flux, v_rot[0], limb_darkening[0])
+
+        broadened_flux = np.empty_like(flux)
+        for i in range(len(flux)):
+            broadened_flux[i] = self._broaden(flux[i], v_rot[i],
+                                              limb_darkening[i])
+        return broadened_flux
+
+    def _broaden(self, flux, v_rot, limb_darkening, flux_transforms=None):
+        """
+        Broaden single or stacked spectra with the rotational profile
+
+        Parameters
+        ----------
+
+        flux: ~np.ndarray
+            single or stacked spectra
+
+        v_rot: float
+            rotational velocity (km/s)
+
+        limb_darkening: float
+            limb darkening coefficient
+
+        flux_transforms: dict
+            transforms of `flux` from earlier calls with the same (unmodified)
+            `flux`, filled in by this call; None to not reuse transforms
+            [default None]
+        """
         if np.abs(v_rot) < 1e-5:
-            return wavelength, flux
+            return flux
 
         profile = self.rotational_profile(v_rot, limb_darkening)
 
-        return wavelength, nd.convolve1d(flux, profile)
+        if len(profile) < self.fft_threshold:
+            return nd.convolve1d(flux, profile, axis=-1)
+        else:
+            return self._fft_convolve(flux, profile, flux_transforms)
+
+    def _fft_convolve(self, flux, profile, flux_transforms=None):
+        """
+        Convolve with a symmetric profile using FFTs - same result as
+        `scipy.ndimage.convolve1d` with reflecting boundaries
+
+        Parameters
+        ----------
+
+        flux: ~np.ndarray
+            single or stacked spectra
+
+        profile: ~np.ndarray
+            symmetric kernel with an odd number of pixels
+
+        flux_transforms: dict
+            transforms of `flux` keyed by (padding, transform length), filled
+            in by this call; None to not reuse transforms [default None]
+        """
+        half_width = len(profile) // 2
+        n_pix = flux.shape[-1]
+        # round the padding up so similar kernels share the flux transform
+        pad = 2 ** int(np.ceil(np.log2(max(half_width, 1))))
+        n_fft = 2 ** int(np.ceil(np.log2(n_pix + 4 * pad)))
+
+        if flux_transforms is None:
+            flux_transforms = {}
+        flux_fft = flux_transforms.get((pad, n_fft))
+        if flux_fft is None:
+            pad_width = [(0, 0)] * (flux.ndim - 1) + [(pad, pad)]
+            padded_flux = np.pad(flux, pad_width, mode='symmetric')
+            flux_fft = np.fft.rfft(padded_flux, n_fft, axis=-1)
+            flux_transforms[pad, n_fft] = flux_fft
+
+        convolved = np.fft.irfft(flux_fft * np.fft.rfft(profile, n_fft),
+                                 n_fft, axis=-1)
+        start = pad + half_width
+        return convolved[..., start:start + n_pix]
 
 class DopplerShift(StellarOperationModel):
 
@@ -81,34 +285,195 @@ class DopplerShift(StellarOperationModel):
 
     def evaluate(self, wavelength, flux, vrad):
 
-        beta = vrad / self.c_in_kms
+        beta = stacked_parameter(vrad, flux) / self.c_in_kms
         doppler_factor = np.sqrt((1+beta) / (1-beta))
         return wavelength * doppler_factor, flux
 
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions, vrad):
+        beta = float(np.ravel(vrad)[0]) / self.c_in_kms
+        doppler_factor = np.sqrt((1+beta) / (1-beta))
+        # d doppler_factor / d beta = doppler_factor / (1 - beta**2)
+        d_doppler_factor = doppler_factor / (1 - beta**2) / self.c_in_kms
+
+        if d_wavelength is not None:
+            d_wavelength = d_wavelength * doppler_factor
+        d_wavelength = add_derivatives(d_wavelength, parameter_derivative(
+            parameter_directions[0], wavelength * d_doppler_factor))
+        return wavelength * doppler_factor, flux, d_wavelength, d_flux
+
+
+
+def ccm89_coefficients(wavelength):
+    """
+    Coefficients a(x) and b(x) of the Cardelli, Clayton & Mathis (1989)
+    extinction curve A_lambda / A_V = a(x) + b(x) / R_V
+
+    Parameters
+    ----------
+
+    wavelength: ~np.ndarray
+        wavelength in Angstrom - outside 910 - 33333 Angstrom the
+        coefficients are zero (no extinction)
+
+    Returns
+    -------
+        : ~np.ndarray
+        a(x)
+        : ~np.ndarray
+        b(x)
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    a = np.zeros_like(wavelength)
+    b = np.zeros_like(wavelength)
+    valid_wavelength = ((wavelength > 910) & (wavelength < 33333))
+    x = np.where(valid_wavelength, 1e4 / wavelength, 1.)
+
+    infrared = valid_wavelength & (x < 1.1)
+    a[infrared] = 0.574 * x[infrared] ** 1.61
+    b[infrared] = -0.527 * x[infrared] ** 1.61
+
+    optical = valid_wavelength & (x >= 1.1) & (x < 3.3)
+    y = x[optical] - 1.82
+    a[optical] = np.polyval([0.32999, -0.77530, 0.01979, 0.72085, -0.02427,
+                             -0.50447, 0.17699, 1.], y)
+    b[optical] = np.polyval([-2.09002, 5.30260, -0.62251, -5.38434, 1.07233,
+                             2.28305, 1.41338, 0.], y)
+
+    ultraviolet = valid_wavelength & (x >= 3.3) & (x < 8.)
+    x_uv = x[ultraviolet]
+    y = np.maximum(x_uv - 5.9, 0.)
+    a[ultraviolet] = (1.752 - 0.316 * x_uv - 0.104 / ((x_uv - 4.67) ** 2 + 0.341)
+                      - 0.04473 * y ** 2 - 0.009779 * y ** 3)
+    b[ultraviolet] = (-3.090 + 1.825 * x_uv + 1.206 / ((x_uv - 4.62) ** 2 + 0.263)
+                      + 0.2130 * y ** 2 + 0.1207 * y ** 3)
+
+    far_ultraviolet = valid_wavelength & (x >= 8.)
+    y = x[far_ultraviolet] - 8.
+    a[far_ultraviolet] = np.polyval([-0.070, 0.137, -0.628, -1.073], y)
+    b[far_ultraviolet] = np.polyval([0.374, -0.420, 4.257, 13.670], y)
+
+    return a, b
 
 
 class CCM89Extinction(StellarOperationModel):
+    """
+    Apply extinction following Cardelli, Clayton & Mathis (1989)
+
+    The curve coefficients a(x) and b(x) are computed once per wavelength
+    grid (and their derivatives with respect to ln(wavelength) once per grid
+    when the derivative with respect to the wavelength is needed), so an
+    evaluation on the same grid only combines them with R_V and
+    exponentiates.
+
+    Parameters
+    ----------
+
+    a_v: float
+        extinction in V [default 0.0]
+
+    r_v: float
+        ratio of total to selective extinction [default 3.1]
+
+    wavelength_unit: ~astropy.units.Unit
+        wavelength unit of the model spectra [default Angstrom]
+    """
 
     operation_name = 'ccm89_extinction'
 
-    a_v = modeling.Parameter(default=0.0)
+    a_v = modeling.Parameter(default=0.0, bounds=(0, None))
     r_v = modeling.Parameter(default=3.1, fixed=True)
 
     @property
     def ebv(self):
         return self.a_v / self.r_v
 
-    def __init__(self, a_v=0.0, r_v=3.1):
-        super(CCM89Extinction, self).__init__(a_v=a_v, r_v=r_v)
+    @classmethod
+    def from_grid(cls, grid, a_v=0.0, r_v=3.1):
+        wavelength_unit = getattr(grid, 'wavelength_unit', None)
+        if wavelength_unit is None:
+            wavelength_unit = u.angstrom
+        return cls(a_v=a_v, r_v=r_v, wavelength_unit=wavelength_unit)
 
+    def __init__(self, a_v=0.0, r_v=3.1, wavelength_unit=u.angstrom):
+        super(CCM89Extinction, self).__init__(a_v=a_v, r_v=r_v)
+        self._wavelength_factor = u.Unit(wavelength_unit).to(u.angstrom)
+        self._wavelength = None
+        self._coefficients = None
+        self._coefficient_derivatives = None
+
+    def _get_coefficients(self, wavelength):
+        """
+        a(x) and b(x) for the given (stacked) wavelength
+        """
+        if not same_array(wavelength, self._wavelength):
+            self._coefficients = ccm89_coefficients(
+                np.asarray(wavelength) * self._wavelength_factor)
+            self._coefficient_derivatives = None
+            self._wavelength = wavelength
+        return self._coefficients
+
+    def _get_coefficient_derivatives(self, wavelength):
+        """
+        Derivatives of a(x) and b(x) with respect to ln(wavelength) from
+        central differences
+        """
+        self._get_coefficients(wavelength)
+        if self._coefficient_derivatives is None:
+            step = 1e-6
+            rest_wavelength = (np.asarray(wavelength) *
+                               self._wavelength_factor)
+            upper = ccm89_coefficients(rest_wavelength * np.exp(step))
+            lower = ccm89_coefficients(rest_wavelength * np.exp(-step))
+            self._coefficient_derivatives = [
+                (upper_coefficient - lower_coefficient) / (2 * step)
+                for upper_coefficient, lower_coefficient in zip(upper, lower)]
+        return self._coefficient_derivatives
+
+    def extinction_curve(self, wavelength, r_v):
+        """
+        A_lambda / A_V for the given wavelength and R_V
+        """
+        a, b = self._get_coefficients(wavelength)
+        return a + b / np.abs(r_v)
 
     def evaluate(self, wavelength, flux, a_v, r_v):
-        from specutils import extinction
-        extinction_factor = np.ones_like(wavelength)
-        valid_wavelength = ((wavelength > 910) & (wavelength < 33333))
-
-        extinction_factor[valid_wavelength] = 10 ** (-0.4 * extinction.extinction_ccm89(
-            wavelength[valid_wavelength] * u.angstrom, a_v=np.abs(a_v),
-            r_v=np.abs(r_v)))
-
-        return wavelength, extinction_factor * flux
\ No newline at end of file
+        a_v = stacked_parameter(a_v, flux)
+        r_v = stacked_parameter(r_v, flux)
+        extinction_factor = np.exp(-0.4 * np.log(10) * np.abs(a_v) *
+                                   self.extinction_curve(wavelength, r_v))
+        return wavelength, extinction_factor * flux
+
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions, a_v, r_v):
+        a_v = float(np.ravel(a_v)[0])
+        r_v = float(np.ravel(r_v)[0])
+        optical_depth_factor = 0.4 * np.log(10)
+        a, b = self._get_coefficients(wavelength)
+        curve = a + b / np.abs(r_v)
+        extinction_factor = np.exp(-optical_depth_factor * np.abs(a_v) *
+                                   curve)
+        extincted_flux = extinction_factor * flux
+
+        if d_flux is not None:
+            d_flux = extinction_factor * d_flux
+
+        a_v_direction, r_v_direction = parameter_directions
+        d_flux = add_derivatives(d_flux, parameter_derivative(
+            a_v_direction,
+            -optical_depth_factor * np.sign(a_v) * curve * extincted_flux))
+
+        if r_v_direction is not None:
+            # d curve / d r_v = -b(x) sign(r_v) / r_v^2
+            d_flux = add_derivatives(d_flux, parameter_derivative(
+                r_v_direction, optical_depth_factor * np.abs(a_v) * b *
+                np.sign(r_v) / r_v ** 2 * extincted_flux))
+
+        if d_wavelength is not None:
+            d_a, d_b = self._get_coefficient_derivatives(wavelength)
+            d_curve = (d_a + d_b / np.abs(r_v)) / wavelength
+            d_flux = add_derivatives(
+                d_flux, -optical_depth_factor * np.abs(a_v) * d_curve *
+                extincted_flux * d_wavelength)
+
+        return wavelength, extincted_flux, d_wavelength, d_flux
@@ -0,0 +1,236 @@
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from starkit.base.assemble_model import assemble_model
+from starkit.base.operations.spectrograph import convert_observed
+from starkit.fitkit.likelihoods import Chi2Likelihood
+from starkit.fitkit.optimizers.base import Optimizer
+from starkit.gridkit import load_grid
+
+logger = getLogger(__name__)
+
+# batch fitter of a worker process - set once when the worker starts
+_worker_fitter = None
+
+
+def _initialize_worker(batch_fitter):
+    global _worker_fitter
+    _worker_fitter = batch_fitter
+
+
+def _fit_item(item):
+    name, spectrum, output_dir = item
+    return name, _worker_fitter.fit_spectrum(name, spectrum, output_dir)
+
+
+def optimize(model, likelihood, **kwargs):
+    """
+    Default fit of `BatchFitter` - maximum likelihood with `Optimizer`
+    (kwargs are passed to `Optimizer.fit`)
+    """
+    return Optimizer(model, likelihood).fit(**kwargs)
+
+
+def write_result(result, fname):
+    """
+    Write the result of a fit to an HDF5 file
+
+    Sampler results store their `posterior_data` (key 'posterior',
+    readable with `SamplerResult.from_hdf5`), optimizer results a single
+    row with the best fit and the log-likelihood (key 'best_fit').
+    """
+    posterior_data = getattr(result, 'posterior_data', None)
+    if posterior_data is not None:
+        posterior_data.to_hdf(fname, key='posterior')
+    else:
+        best_fit = OrderedDict(result.best_fit)
+        best_fit['loglikelihood'] = result.loglikelihood
+        pd.DataFrame([best_fit]).to_hdf(fname, key='best_fit')
+
+
+class BatchFitter(object):
+    """
+    Fit many observed spectra with the same grid and model
+
+    The grid is loaded and the model is assembled once (compiled, see
+    `assemble_model`). For each spectrum the operations that depend on the
+    observed spectrum (`Interpolate`, `Normalize`, `NormalizeParts`) and
+    the likelihood are rebound to it through their
+    `_update_observed_spectrum` methods. `run` distributes the spectra over
+    forked worker processes that share the grid in their copy-on-write
+    memory and writes one result file per spectrum.
+
+    The grid should be held in memory or memory-mapped (`flux_storage`
+    'memory' or 'mmap') when running with several processes.
+
+    Parameters
+    ----------
+
+    grid: ~BaseSpectralGrid or str
+        spectral grid or filename of a grid (read with `load_grid`)
+
+    spectrum: ~specutils.Spectrum1D
+        spectrum used to assemble the model, e.g. the first of the batch
+
+    fitter: callable
+        fit function called with the (compiled) model and the likelihood,
+        returning a result with `posterior_data` (samplers) or `best_fit`
+        and `loglikelihood` (`OptimizerResult`) [default `optimize`]
+
+    likelihood: ~Chi2Likelihood
+        likelihood of the observed spectrum [default Chi2Likelihood(spectrum)]
+
+    grid_kwargs: dict
+        passed to `load_grid` if grid is a filename [default None]
+
+    model_kwargs:
+        passed to `assemble_model`, e.g. parameters of the operations and
+        normalize_npol
+    """
+
+    def __init__(self, grid, spectrum, fitter=None, likelihood=None,
+                 grid_kwargs=None, **model_kwargs):
+        if not hasattr(grid, 'evaluate'):
+            grid = load_grid(grid, **(grid_kwargs or {}))
+        self.grid = grid
+        self.fitter = fitter or optimize
+
+        self.model = assemble_model(grid, spectrum=spectrum, compiled=True,
+                                    **model_kwargs)
+        # fits start from the same parameters
+        self.initial_parameters = np.array(self.model.parameters)
+
+        if likelihood is None:
+            likelihood = Chi2Likelihood(self._convert_observed(spectrum))
+        self.likelihood = likelihood
+
+    def _convert_observed(self, spectrum):
+        wavelength_unit = getattr(self.grid, 'wavelength_unit', None)
+        if wavelength_unit is None:
+            return spectrum
+        return convert_observed(spectrum, wavelength_unit)
+
+    def update_observed_spectrum(self, spectrum):
+        """
+        Rebind the model and the likelihood to a new observed spectrum
+        """
+        spectrum = self._convert_observed(spectrum)
+        for operation in self.model.spectrograph_operations:
+            if hasattr(operation, '_update_observed_spectrum'):
+                operation._update_observed_spectrum(spectrum)
+        self.likelihood._update_observed_spectrum(spectrum)
+
+    def fit(self, spectrum):
+        """
+        Fit a single observed spectrum
+
+        Returns
+        -------
+            : result of the fitter
+        """
+        self.update_observed_spectrum(spectrum)
+        self.model.parameters = self.initial_parameters.copy()
+        return self.fitter(self.model, self.likelihood)
+
+    @staticmethod
+    def result_fname(output_dir, name):
+        return os.path.join(output_dir, '{0}.h5'.format(name))
+
+    def fit_spectrum(self, name, spectrum, output_dir):
+        """
+        Fit a spectrum and write the result to `output_dir`/name.h5
+
+        Failed fits are logged and skipped.
+
+        Returns
+        -------
+            : str
+            filename of the result - None if the fit failed
+        """
+        fname = self.result_fname(output_dir, name)
+        start_time = time.time()
+        try:
+            result = self.fit(spectrum)
+            write_result(result, fname)
+        except Exception:
+            logger.exception('Fit of {0} failed'.format(name))
+            return None
+        logger.info('Fit of {0} finished - took {1:.2f} s'.format(
+            name, time.time() - start_time))
+        return fname
+
+    def run(self, spectra, output_dir, processes=None, overwrite=False):
+        """
+        Fit a batch of spectra
+
+        Parameters
+        ----------
+
+        spectra: dict or iterable
+            observed spectra by name (or (name, spectrum) pairs) - the names
+            are used for the result files
+
+        output_dir: str
+            directory of the result files
+
+        processes: int
+            number of worker processes, 1 fits in this process
+            [default number of CPUs]
+
+        overwrite: bool
+            refit spectra that already have a result file [default False]
+
+        Returns
+        -------
+            : ~OrderedDict
+            result filename for each spectrum (None for failed fits)
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        if hasattr(spectra, 'items'):
+            spectra = spectra.items()
+
+        result_fnames = OrderedDict()
+        items = []
+        for name, spectrum in spectra:
+            fname = self.result_fname(output_dir, name)
+            if not overwrite and os.path.exists(fname):
+                logger.info('Skipping {0} - result exists'.format(name))
+                result_fnames[name] = fname
+            else:
+                result_fnames[name] = None
+                items.append((name, spectrum, output_dir))
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(items))
+
+        start_time = time.time()
+        if processes <= 1:
+            for item in items:
+                result_fnames[item[0]] = self.fit_spectrum(*item)
+        else:
+            try:
+                # fork shares the grid and model with the workers
+                context = multiprocessing.get_context('fork')
+            except (AttributeError, ValueError):
+                context = multiprocessing
+            pool = context.Pool(processes, initializer=_initialize_worker,
+                                initargs=(self, ))
+            try:
+                for name, fname in pool.imap_unordered(_fit_item, items):
+                    result_fnames[name] = fname
+            finally:
+                pool.close()
+                pool.join()
+
+        logger.info('Fitted {0} spectra - took {1:.2f} s'.format(
+            len(items), time.time() - start_time))
+        return result_fnames
@@ -2,12 +2,39 @@ from astropy import units as u, constants as const
 from astropy import modeling
 import numpy as np
 
+from starkit.base.operations.spectrograph import (Normalize,
+                                                  solve_normal_equations)
+
 class Chi2Likelihood(modeling.Model):
+    """
+    Gaussian likelihood of an observed spectrum
+
+    Parameters
+    ----------
+
+    observed: ~Spectrum1D
+        observed spectrum
+
+    normalize: int or ~Normalize or ~NormalizeParts
+        if given, the likelihood is analytically marginalised over the linear
+        continuum polynomial coefficients (with a flat prior) of this
+        normalization (an int is the degree of a `Normalize` polynomial).
+        The model should then not contain a normalization operation itself.
+        The returned value is the marginal log-likelihood including the
+        log-determinant term [default None]
+    """
     inputs = ('wavelength', 'flux')
     outputs = ('loglikelihood', )
 
-    def __init__(self, observed):
+    def __init__(self, observed, normalize=None):
         super(Chi2Likelihood, self).__init__()
+        if normalize is not None and not hasattr(normalize,
+                                                 '_normal_equations'):
+            normalize = Normalize(observed, normalize)
+        self.normalize = normalize
+        self._set_observed_spectrum(observed)
+
+    def _set_observed_spectrum(self, observed):
         self.observed_wavelength = observed.wavelength.to(u.angstrom).value
         self.observed_flux = observed.flux.value
         self.observed_uncertainty = getattr(observed, 'uncertainty', None)
@@ -16,12 +43,121 @@ class Chi2Likelihood(modeling.Model):
         else:
             self.observed_uncertainty = np.ones_like(self.observed_wavelength)
 
+        if self.normalize is not None:
+            self._observed_chi2 = np.sum(
+                (self.observed_flux / self.observed_uncertainty) ** 2)
+            unused_coefficients = getattr(self.normalize,
+                                          '_unused_coefficients', None)
+            if unused_coefficients is None:
+                n_coefficients = self.normalize.npol + 1
+            else:
+                n_coefficients = np.sum(~unused_coefficients)
+            self._log_normalization = 0.5 * n_coefficients * np.log(2 * np.pi)
+
+    def _update_observed_spectrum(self, observed):
+        """
+        Use a new observed spectrum (including the marginalised
+        normalization) without building a new likelihood
+        """
+        if self.normalize is not None:
+            self.normalize._update_observed_spectrum(observed)
+        self._set_observed_spectrum(observed)
+
 
     def evaluate(self, wavelength, flux):
+        if self.normalize is not None:
+            return self._marginal_loglikelihood(flux)
+
         loglikelihood =  -0.5 * np.sum(
-            ((self.observed_flux - flux) / self.observed_uncertainty)**2)
+            ((self.observed_flux - flux) / self.observed_uncertainty)**2,
+            axis=-1)
         return loglikelihood
 
+    def evaluate_derivative(self, wavelength, flux, d_wavelength, d_flux,
+                            parameter_directions):
+        """
+        Log-likelihood and its derivatives along the directions of d_flux
+        (n_directions, n_wavelength) for a single model flux
+        """
+        loglikelihood = self.evaluate(wavelength, flux)
+        if d_flux is None:
+            return loglikelihood, None
+
+        if self.normalize is None:
+            return loglikelihood, np.dot(
+                d_flux, (self.observed_flux - flux) /
+                self.observed_uncertainty ** 2)
+
+        if not np.isfinite(loglikelihood):
+            return loglikelihood, np.zeros(len(d_flux))
+
+        gram, rhs = self.normalize._normal_equations(flux)
+        solution = solve_normal_equations(gram, rhs)
+        if solution is None:
+            solution = self.normalize._lstsq_solution(flux)
+        d_gram, d_rhs = self.normalize._normal_equations_derivative(flux,
+                                                                    d_flux)
+        n_directions = len(d_flux)
+
+        # d (rhs^T gram^-1 rhs) = 2 d_rhs^T solution - solution^T d_gram
+        # solution and d log(det(gram)) = trace(gram^-1 d_gram)
+        d_rhs_solution = np.sum((d_rhs * solution).reshape(n_directions, -1),
+                                axis=1)
+        d_gram_solution = np.sum(
+            (d_gram * solution[..., :, np.newaxis] *
+             solution[..., np.newaxis, :]).reshape(n_directions, -1), axis=1)
+        d_log_determinant = np.sum(
+            (d_gram * np.swapaxes(np.linalg.pinv(gram), -1, -2)).reshape(
+                n_directions, -1), axis=1)
+
+        return loglikelihood, (0.5 * (2 * d_rhs_solution - d_gram_solution)
+                               - 0.5 * d_log_determinant)
+
+    def residuals(self, wavelength, flux):
+        """
+        Normalized residuals (observed - model) / uncertainty
+
+        With a normalization the model is multiplied by its best-fitting
+        continuum polynomial, so the sum of squares is the profile (not the
+        marginal) chi2.
+        """
+        if self.normalize is not None:
+            flux = self.normalize.evaluate(wavelength, flux)[1]
+        return (self.observed_flux - flux) / self.observed_uncertainty
+
+    def residuals_derivative(self, wavelength, flux, d_wavelength, d_flux):
+        """
+        Derivatives of `residuals` along the directions of d_flux
+        (n_directions, n_wavelength) - None if d_flux is None
+        """
+        if d_flux is None:
+            return None
+        if self.normalize is not None:
+            d_flux = self.normalize.evaluate_derivative(
+                wavelength, flux, d_wavelength, d_flux, [])[3]
+        return -d_flux / self.observed_uncertainty
+
+    def _marginal_loglikelihood(self, flux):
+        gram, rhs = self.normalize._normal_equations(flux)
+        solution = solve_normal_equations(gram, rhs)
+        if solution is None:
+            solution = self.normalize._lstsq_solution(flux)
+
+        # sum over coefficients (and parts for NormalizeParts)
+        coefficient_axes = tuple(range(np.ndim(flux) - 1, rhs.ndim))
+        # chi2 at the best-fit coefficients: y^T y - (V^T y)^T c
+        chi2 = self._observed_chi2 - np.sum(rhs * solution,
+                                            axis=coefficient_axes)
+        # a singular gram (e.g. no model flux in a part) makes the integral
+        # over the coefficients diverge - reject the model with -inf rather
+        # than the +inf of a zero determinant
+        sign, log_determinant = np.linalg.slogdet(gram)
+        log_determinant = np.where(sign > 0, log_determinant, np.inf)
+        log_determinant = np.sum(log_determinant,
+                                 axis=coefficient_axes[:-1])
+
+        return -0.5 * chi2 - 0.5 * log_determinant + self._log_normalization
+
 class PhotometryColorLikelihood(modeling.Model):
     inputs = ('photometry',)
     outputs = ('loglikelihood',)
@@ -34,11 +170,22 @@ class PhotometryColorLikelihood(modeling.Model):
                                            magnitude_set.magnitudes[1:]**2)
 
     def evaluate(self, photometry):
-        synth_colors = photometry[:-1] - photometry[1:]
+        synth_colors = photometry[..., :-1] - photometry[..., 1:]
         loglikelihood = -0.5 * np.sum(((self.colors - synth_colors)
-                                       / self.color_uncertainties)**2)
+                                       / self.color_uncertainties)**2, axis=-1)
         return loglikelihood
 
+    def evaluate_derivative(self, photometry, d_photometry,
+                            parameter_directions):
+        loglikelihood = self.evaluate(photometry)
+        if d_photometry is None:
+            return loglikelihood, None
+        synth_colors = photometry[:-1] - photometry[1:]
+        d_synth_colors = d_photometry[:, :-1] - d_photometry[:, 1:]
+        return loglikelihood, np.dot(
+            d_synth_colors, (self.colors - synth_colors) /
+            self.color_uncertainties ** 2)
+
 class Addition(modeling.Model):
 
     inputs = ('a', 'b')
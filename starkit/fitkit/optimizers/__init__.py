@@ -1 +1,3 @@
 __author__ = 'wkerzend'
+
+from starkit.fitkit.optimizers.base import Optimizer
@@ -0,0 +1,327 @@
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+from scipy import optimize
+
+from starkit.fitkit.samplers.base import BatchLikelihood
+
+logger = getLogger(__name__)
+
+
+def latin_hypercube(n_points, n_dim, random_state):
+    """
+    Latin hypercube sample in the unit cube - every dimension has exactly
+    one point in each of n_points equal intervals
+
+    Returns
+    -------
+        : ~np.ndarray
+        points (n_points, n_dim)
+    """
+    intervals = np.array([random_state.permutation(n_points)
+                          for i in range(n_dim)]).T
+    return (intervals + random_state.uniform(size=(n_points, n_dim))) / n_points
+
+
+class OptimizerResult(object):
+    """
+    Result of an optimization
+
+    Parameters
+    ----------
+
+    best_fit: ~OrderedDict
+        best values of the free parameters
+
+    loglikelihood: float
+        log-likelihood at the best fit
+
+    scipy_results: list
+        results of the scipy optimizer for each start
+    """
+
+    def __init__(self, best_fit, loglikelihood, scipy_results):
+        self.best_fit = best_fit
+        self.loglikelihood = loglikelihood
+        self.scipy_results = scipy_results
+
+    def __repr__(self):
+        return "Best fit (log-likelihood {0:.2f}):\n{1}".format(
+            self.loglikelihood, '\n'.join(
+                '{0} = {1}'.format(key, value)
+                for key, value in self.best_fit.items()))
+
+
+class Optimizer(object):
+    """
+    Find the maximum-likelihood parameters with `scipy.optimize`
+
+    Fixed parameters stay at their values. The grid parameters are bounded
+    by the extent of the grid (`get_grid_extent`), other parameters by the
+    bounds of the model parameters (the physical ranges of e.g. vrot, R and
+    a_v) or the bounds given here.
+
+    Parameters
+    ----------
+
+    model: ~astropy.modeling.Model or ~CompiledModel
+        model from `assemble_model`
+
+    likelihood: ~astropy.modeling.Model
+        likelihood of the model outputs, e.g. `Chi2Likelihood`
+
+    bounds: dict
+        lower and upper bounds for parameters of the combined model, e.g.
+        {'vrad_3': (-500, 500)} - None for no bound [default None]
+
+    If the model is compiled (`assemble_model(..., compiled=True)`) the
+    optimizers are given the analytic derivatives of `evaluate_jacobian`.
+    Otherwise the gradient is calculated with central differences with
+    steps of `finite_difference_step` relative to the parameter values
+    (scipy's default absolute step is far too small for e.g. teff).
+    """
+
+    finite_difference_step = 1e-6
+    gradient_free_methods = ('nelder-mead', 'powell', 'cobyla')
+
+    def __init__(self, model, likelihood, bounds=None):
+        self.model = model
+        self.likelihood = likelihood
+        self.fit_model = model | likelihood
+        self.batch_likelihood = BatchLikelihood(self.fit_model)
+        self.bounds = self._get_bounds(bounds or {})
+
+    @property
+    def free_param_names(self):
+        return self.batch_likelihood.free_param_names
+
+    @staticmethod
+    def _find_grid(model):
+        grid = getattr(model, 'grid', None)
+        if grid is None:
+            try:
+                grid = model[0]
+            except (TypeError, IndexError):
+                grid = model
+        if hasattr(grid, 'get_grid_extent'):
+            return grid
+        else:
+            return None
+
+    def _get_bounds(self, bounds):
+        """
+        Bounds of the free parameters (n_params, 2)
+        """
+        param_names = self.fit_model.param_names
+        all_bounds = []
+        for param_name in param_names:
+            lower, upper = getattr(getattr(self.fit_model, param_name),
+                                   'bounds', (None, None))
+            all_bounds.append([lower, upper])
+
+        # the grid parameters come first in the model
+        grid = self._find_grid(self.model)
+        if grid is not None:
+            for i, extent in enumerate(grid.get_grid_extent()):
+                all_bounds[i] = list(extent)
+
+        for param_name, (lower, upper) in bounds.items():
+            if param_name not in param_names:
+                raise ValueError('Parameter {0} not in model (available '
+                                 '{1})'.format(param_name,
+                                               ', '.join(param_names)))
+            all_bounds[param_names.index(param_name)] = [lower, upper]
+
+        all_bounds = np.array(all_bounds, dtype=np.float64)
+        all_bounds[np.isnan(all_bounds[:, 0]), 0] = -np.inf
+        all_bounds[np.isnan(all_bounds[:, 1]), 1] = np.inf
+        return all_bounds[self.batch_likelihood.free_index]
+
+    def negative_loglikelihood(self, free_parameters):
+        loglikelihood = self.batch_likelihood(free_parameters)[0]
+        if not np.isfinite(loglikelihood):
+            return np.inf
+        return -loglikelihood
+
+    @property
+    def has_jacobian(self):
+        return hasattr(self.fit_model, 'evaluate_jacobian')
+
+    def _all_parameters(self, free_parameters):
+        parameters = self.batch_likelihood.parameters.copy()
+        parameters[self.batch_likelihood.free_index] = free_parameters
+        return parameters
+
+    def negative_loglikelihood_finite_difference(self, free_parameters):
+        """
+        Negative log-likelihood and its gradient with respect to the free
+        parameters from finite differences
+
+        The steps are scaled to the parameter values and are one-sided at
+        the bounds. All points are evaluated in one (stacked) call of the
+        model.
+        """
+        free_parameters = np.asarray(free_parameters, dtype=np.float64)
+        steps = self.finite_difference_step * np.maximum(
+            np.abs(free_parameters), 1.)
+        lower, upper = self.bounds.T
+        forward = free_parameters - steps < lower
+        backward = ~forward & (free_parameters + steps > upper)
+
+        offsets = np.diag(steps)
+        points = np.vstack((free_parameters[np.newaxis],
+                            free_parameters + offsets,
+                            free_parameters - offsets))
+        loglikelihoods = self.batch_likelihood(points)
+        loglikelihood = loglikelihoods[0]
+        if not np.isfinite(loglikelihood):
+            return np.inf, np.zeros(len(free_parameters))
+
+        n_params = len(free_parameters)
+        upper_loglikelihoods = np.where(backward, loglikelihood,
+                                        loglikelihoods[1:n_params + 1])
+        lower_loglikelihoods = np.where(forward, loglikelihood,
+                                        loglikelihoods[n_params + 1:])
+        gradient = ((upper_loglikelihoods - lower_loglikelihoods) /
+                    np.where(forward | backward, 1., 2.) / steps)
+        return -loglikelihood, -gradient
+
+    def negative_loglikelihood_gradient(self, free_parameters):
+        """
+        Negative log-likelihood and its gradient with respect to the free
+        parameters
+        """
+        loglikelihood, d_loglikelihood = self.fit_model.evaluate_jacobian(
+            *self._all_parameters(free_parameters))
+        loglikelihood = float(np.ravel(loglikelihood)[0])
+        if not np.isfinite(loglikelihood):
+            return np.inf, np.zeros(len(free_parameters))
+        return -loglikelihood, -np.ravel(d_loglikelihood)
+
+    def residuals(self, free_parameters):
+        model_parameters = self._all_parameters(
+            free_parameters)[:len(self.model.param_names)]
+        return self.likelihood.residuals(
+            *self.model.evaluate(*model_parameters))
+
+    def residuals_jacobian(self, free_parameters):
+        """
+        Derivatives of the residuals with respect to the free parameters
+        (n_residuals, n_free_parameters)
+        """
+        model_parameters = self._all_parameters(
+            free_parameters)[:len(self.model.param_names)]
+        # the likelihood parameters are not part of the model
+        model_free = self.batch_likelihood.free_index < len(model_parameters)
+        outputs, d_outputs = self.model.evaluate_jacobian(*model_parameters)
+        d_residuals = self.likelihood.residuals_derivative(
+            *(tuple(outputs) + tuple(d_outputs)))
+        jacobian = np.zeros((len(free_parameters),
+                             len(self.likelihood.residuals(*outputs))))
+        if d_residuals is not None:
+            jacobian[model_free] = d_residuals
+        return jacobian.T
+
+    def _starting_points(self, x0, n_starts, random_state):
+        if x0 is None:
+            x0 = self.batch_likelihood.parameters[
+                self.batch_likelihood.free_index]
+        starting_points = [np.asarray(x0, dtype=np.float64)]
+
+        if n_starts > 1:
+            lower, upper = self.bounds.T
+            bounded = np.isfinite(lower) & np.isfinite(upper)
+            cube = latin_hypercube(n_starts - 1, len(lower), random_state)
+            for point in cube:
+                starting_points.append(np.where(
+                    bounded, lower + point * (upper - lower),
+                    starting_points[0]))
+
+        # starting points need to be within the bounds
+        return [np.clip(point, self.bounds[:, 0], self.bounds[:, 1])
+                for point in starting_points]
+
+    def fit(self, method='L-BFGS-B', x0=None, n_starts=1, random_state=None,
+            analytic_jacobian=True, **kwargs):
+        """
+        Fit the model
+
+        Parameters
+        ----------
+
+        method: str
+            'least_squares' uses `scipy.optimize.least_squares` on the
+            residuals of the likelihood (needs a `residuals` method), other
+            values are passed to `scipy.optimize.minimize`
+            [default 'L-BFGS-B']
+
+        x0: ~np.ndarray
+            starting values of the free parameters [default current values]
+
+        n_starts: int
+            number of starts - the additional starting points form a Latin
+            hypercube over the bounds (e.g. the grid) [default 1]
+
+        random_state: int or ~np.random.RandomState
+            seed or random state for the starting points [default None]
+
+        analytic_jacobian: bool
+            use the derivatives of compiled models (see `has_jacobian`),
+            finite differences otherwise [default True]
+
+        kwargs:
+            passed to the scipy optimizer
+
+        Returns
+        -------
+            : ~OptimizerResult
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+
+        use_jacobian = analytic_jacobian and self.has_jacobian
+
+        start_time = time.time()
+        scipy_results = []
+        for starting_point in self._starting_points(x0, n_starts,
+                                                    random_state):
+            if method == 'least_squares':
+                if use_jacobian:
+                    kwargs.setdefault('jac', self.residuals_jacobian)
+                scipy_result = optimize.least_squares(
+                    self.residuals, starting_point,
+                    bounds=(self.bounds[:, 0], self.bounds[:, 1]), **kwargs)
+            else:
+                bounds = [(lower if np.isfinite(lower) else None,
+                           upper if np.isfinite(upper) else None)
+                          for lower, upper in self.bounds]
+                if method.lower() in self.gradient_free_methods:
+                    scipy_result = optimize.minimize(
+                        self.negative_loglikelihood, starting_point,
+                        method=method, bounds=bounds, **kwargs)
+                else:
+                    if use_jacobian:
+                        objective = self.negative_loglikelihood_gradient
+                    else:
+                        objective = (
+                            self.negative_loglikelihood_finite_difference)
+                    scipy_result = optimize.minimize(
+                        objective, starting_point, method=method,
+                        bounds=bounds, jac=True, **kwargs)
+            scipy_results.append(scipy_result)
+
+        best_points = np.array([scipy_result.x
+                                for scipy_result in scipy_results])
+        loglikelihoods = self.batch_likelihood(best_points)
+        loglikelihoods[~np.isfinite(loglikelihoods)] = -np.inf
+        best = np.argmax(loglikelihoods)
+
+        logger.info("Optimization finished - took {0:.2f} s".format(
+            time.time() - start_time))
+
+        best_fit = OrderedDict(zip(self.free_param_names, best_points[best]))
+        self.result = OptimizerResult(best_fit, loglikelihoods[best],
+                                      scipy_results)
+        return self.result
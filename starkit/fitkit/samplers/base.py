@@ -0,0 +1,186 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def cube_as_array(cube, n_values):
+    """
+    View the first values of a sampler cube as a numpy array
+
+    MultiNest passes the cube as a ctypes pointer to doubles, which is
+    wrapped without copying, so writing into the returned array changes
+    the cube. Lists and arrays are accepted as well.
+
+    Parameters
+    ----------
+
+    cube: ctypes pointer, ~np.ndarray or list
+        parameter cube
+
+    n_values: int
+        number of values to use
+
+    Returns
+    -------
+        : ~np.ndarray
+    """
+    if isinstance(cube, (np.ndarray, list, tuple)):
+        return np.asarray(cube, dtype=np.float64)[:n_values]
+    try:
+        return np.ctypeslib.as_array(cube, shape=(n_values, ))
+    except (TypeError, ValueError, AttributeError):
+        return np.array([cube[i] for i in range(n_values)], dtype=np.float64)
+
+
+class BatchLikelihood(object):
+    """
+    Evaluate a likelihood model for many free-parameter vectors at once
+
+    The fixed parameters are taken from the model when this object is
+    created. All vectors are passed to the model in one call (as one array
+    per parameter), which the grid and operations evaluate as stacked
+    spectra. Models that can't be evaluated like this are called once per
+    vector.
+
+    Parameters
+    ----------
+
+    likelihood: ~astropy.modeling.Model or ~CompiledModel
+        model returning the log-likelihood
+
+    vectorized: bool
+        evaluate all vectors in one call [default True]
+    """
+
+    def __init__(self, likelihood, vectorized=True):
+        self.likelihood = likelihood
+        self.vectorized = vectorized
+
+        fixed = np.array([getattr(likelihood, param_name).fixed
+                          for param_name in likelihood.param_names])
+        self.free_index = np.flatnonzero(~fixed)
+        self.free_param_names = [likelihood.param_names[i]
+                                 for i in self.free_index]
+        self.parameters = np.array(likelihood.parameters, dtype=np.float64)
+
+    @property
+    def n_params(self):
+        return len(self.free_index)
+
+    def __call__(self, free_parameters):
+        """
+        Parameters
+        ----------
+
+        free_parameters: ~np.ndarray
+            values of the free parameters (n_points, n_params)
+
+        Returns
+        -------
+            : ~np.ndarray
+            log-likelihoods (n_points, )
+        """
+        free_parameters = np.atleast_2d(free_parameters)
+        parameters = np.empty((len(free_parameters), len(self.parameters)))
+        parameters[:] = self.parameters
+        parameters[:, self.free_index] = free_parameters
+
+        if self.vectorized:
+            try:
+                loglikelihood = np.asarray(
+                    self.likelihood.evaluate(*parameters.T),
+                    dtype=np.float64).reshape(-1)
+            except ValueError:
+                loglikelihood = None
+            if loglikelihood is not None and (loglikelihood.size ==
+                                              len(parameters)):
+                return loglikelihood
+            # remember for the next calls
+            self.vectorized = False
+
+        return np.array([float(self.likelihood.evaluate(*current_parameters))
+                         for current_parameters in parameters])
+
+
+class SamplerResult(object):
+    """
+    Posterior samples of a sampler run
+
+    Parameters
+    ----------
+
+    posterior_data: ~pd.DataFrame
+        weights of the samples ('posterior'), -2 log-likelihood ('x') and
+        the parameter values
+    """
+
+    @classmethod
+    def from_hdf5(cls, h5_fname, key):
+        """
+        Reading a sampler result from its generated HDF5 file
+
+        Parameters
+        ----------
+
+        h5_fname: ~str
+            HDF5 filename
+
+        key: ~str
+            group identifier in the store
+        """
+
+        posterior_data = pd.read_hdf(h5_fname, key)
+
+        return cls(posterior_data)
+
+
+
+    def __init__(self, posterior_data):
+        self.posterior_data = posterior_data
+        self.parameter_names = [col_name for col_name in posterior_data.columns
+                                if col_name not in ['x', 'posterior']]
+
+    def calculate_sigmas(self, sigma):
+        sigmas = OrderedDict()
+        for parameter_name in self.parameter_names:
+            posterior_data = self.posterior_data.sort_values(parameter_name)
+            parameter_values, posterior_values = (posterior_data[parameter_name],
+                                                  posterior_data['posterior'])
+            posterior_cumsum = posterior_values.cumsum()
+
+            norm_distr = stats.norm(loc=0.0, scale=1.)
+
+            sigma_low = np.interp(norm_distr.cdf(-sigma), posterior_cumsum,
+                                  parameter_values)
+
+            sigma_high = np.interp(norm_distr.cdf(sigma), posterior_cumsum,
+                                  parameter_values)
+
+
+            sigmas[parameter_name] = (sigma_low, sigma_high)
+
+        return sigmas
+
+    @property
+    def mean(self):
+        if not hasattr(self, '_mean'):
+            _mean = OrderedDict([(param_name,
+                                  np.average(self.posterior_data[param_name],
+                                             weights=
+                                             self.posterior_data['posterior']))
+                                 for param_name in self.parameter_names])
+            self._mean = _mean
+
+        return self._mean
+
+
+    def plot_triangle(self, **kwargs):
+        try:
+            from triangle import corner
+        except ImportError:
+            raise ImportError('Plotting requires trianglepy')
+        data_columns = self.posterior_data.columns[2:]
+        corner(self.posterior_data[data_columns],
+               weights=self.posterior_data.posterior, **kwargs)
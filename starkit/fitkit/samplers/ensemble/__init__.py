@@ -0,0 +1 @@
+from starkit.fitkit.samplers.ensemble.base import EnsembleSampler
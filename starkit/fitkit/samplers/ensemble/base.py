@@ -0,0 +1,237 @@
+import time
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from starkit.fitkit.samplers.priors import PriorCollection
+from starkit.fitkit.samplers.base import BatchLikelihood, SamplerResult
+
+logger = getLogger(__name__)
+
+
+class EnsembleResult(SamplerResult):
+    """
+    Samples of an ensemble sampler run - all samples have the same weight
+
+    Parameters
+    ----------
+
+    posterior_data: ~pd.DataFrame
+        weights of the samples ('posterior'), -2 log-likelihood ('x') and
+        the parameter values
+
+    acceptance_fraction: ~np.ndarray
+        fraction of accepted proposals for each walker [default None]
+    """
+
+    def __init__(self, posterior_data, acceptance_fraction=None):
+        super(EnsembleResult, self).__init__(posterior_data)
+        self.acceptance_fraction = acceptance_fraction
+
+
+class EnsembleSampler(object):
+    """
+    Affine-invariant ensemble sampler using the stretch move of Goodman &
+    Weare (2010)
+
+    The walkers move in the unit cube of the priors, where the posterior
+    is the likelihood of the transformed parameters. Each half of the
+    ensemble is updated with one batched likelihood evaluation, so the
+    grid and the operations work on stacked spectra.
+
+    Parameters
+    ----------
+
+    likelihood: ~astropy.modeling.Model or ~CompiledModel
+        model returning the log-likelihood - fixed parameters are not
+        sampled
+
+    priors: ~PriorCollection or list
+        priors for the free parameters
+
+    n_walkers: int
+        number of walkers - at least twice the number of free parameters
+        [default four times the number of free parameters]
+
+    stretch_scale: float
+        scale parameter a of the stretch move [default 2.]
+
+    random_state: int or ~np.random.RandomState
+        seed or random state [default None]
+
+    pool: callable
+        evaluates the log-likelihood for (n_points, n_params) free
+        parameters, e.g. a `PoolLikelihood` - None evaluates in this process
+        [default None]
+    """
+
+    def __init__(self, likelihood, priors, n_walkers=None, stretch_scale=2.,
+                 random_state=None, pool=None):
+        self.likelihood = likelihood
+        self.batch_likelihood = BatchLikelihood(likelihood)
+        if not hasattr(priors, 'transform'):
+            self.priors = PriorCollection(priors)
+        else:
+            self.priors = priors
+
+        if len(self.priors.priors) != self.n_params:
+            raise ValueError('Got {0} priors for {1} free parameters'.format(
+                len(self.priors.priors), self.n_params))
+
+        if n_walkers is None:
+            n_walkers = 4 * self.n_params
+        if n_walkers < 2 * self.n_params:
+            raise ValueError('Need at least {0} walkers for {1} free '
+                             'parameters'.format(2 * self.n_params,
+                                                 self.n_params))
+        self.n_walkers = n_walkers
+        self.stretch_scale = stretch_scale
+
+        if isinstance(random_state, np.random.RandomState):
+            self.random_state = random_state
+        else:
+            self.random_state = np.random.RandomState(random_state)
+
+        self.pool = pool
+
+    @property
+    def n_params(self):
+        return self.batch_likelihood.n_params
+
+    def log_probability(self, cube):
+        """
+        Log-posterior of walkers in the unit cube
+
+        Parameters
+        ----------
+
+        cube: ~np.ndarray
+            walker positions (n_points, n_params)
+
+        Returns
+        -------
+            : ~np.ndarray
+            log-likelihood of the transformed positions - -inf outside the
+            cube or where the model can't be evaluated
+        """
+        log_probability = np.empty(len(cube))
+        log_probability.fill(-np.inf)
+        inside = np.all((cube > 0) & (cube < 1), axis=1)
+        if np.any(inside):
+            parameters = self.priors.transform(cube[inside])
+            if self.pool is None:
+                loglikelihood = self.batch_likelihood(parameters)
+            else:
+                loglikelihood = self.pool(parameters)
+            log_probability[inside] = np.where(np.isfinite(loglikelihood),
+                                               loglikelihood, -np.inf)
+        return log_probability
+
+    def _initial_walkers(self, max_tries=100):
+        walkers = self.random_state.uniform(size=(self.n_walkers,
+                                                  self.n_params))
+        log_probability = self.log_probability(walkers)
+        for i in range(max_tries):
+            invalid = ~np.isfinite(log_probability)
+            if not np.any(invalid):
+                return walkers, log_probability
+            # e.g. holes in the grid
+            walkers[invalid] = self.random_state.uniform(
+                size=(invalid.sum(), self.n_params))
+            log_probability[invalid] = self.log_probability(walkers[invalid])
+
+        raise ValueError('Could not find valid starting positions for all '
+                         'walkers')
+
+    def _stretch_move(self, walkers, log_probability, active, others):
+        n_active = len(active)
+        z = ((self.stretch_scale - 1.) *
+             self.random_state.uniform(size=n_active) + 1) ** 2 / \
+            self.stretch_scale
+        partners = walkers[others[self.random_state.randint(len(others),
+                                                            size=n_active)]]
+        proposal = partners + z[:, np.newaxis] * (walkers[active] - partners)
+        proposal_log_probability = self.log_probability(proposal)
+
+        log_acceptance = ((self.n_params - 1) * np.log(z) +
+                          proposal_log_probability - log_probability[active])
+        accepted = (np.log(self.random_state.uniform(size=n_active)) <
+                    log_acceptance)
+        walkers[active[accepted]] = proposal[accepted]
+        log_probability[active[accepted]] = proposal_log_probability[accepted]
+        return accepted
+
+    def run(self, n_steps=1000, n_burn=None, thin=1, initial_cube=None):
+        """
+        Run the sampler
+
+        Parameters
+        ----------
+
+        n_steps: int
+            number of steps of each walker [default 1000]
+
+        n_burn: int
+            number of initial steps that are discarded [default n_steps / 2]
+
+        thin: int
+            keep every thin-th step [default 1]
+
+        initial_cube: ~np.ndarray
+            starting positions in the unit cube (n_walkers, n_params) -
+            None draws them uniformly [default None]
+
+        Returns
+        -------
+            : ~EnsembleResult
+        """
+        if n_burn is None:
+            n_burn = n_steps // 2
+
+        if initial_cube is None:
+            walkers, log_probability = self._initial_walkers()
+        else:
+            walkers = np.array(initial_cube, dtype=np.float64)
+            log_probability = self.log_probability(walkers)
+
+        halves = np.array_split(np.arange(self.n_walkers), 2)
+        n_accepted = np.zeros(self.n_walkers)
+        kept_steps = range(n_burn, n_steps, thin)
+        chain = np.empty((len(kept_steps), self.n_walkers, self.n_params))
+        chain_log_probability = np.empty((len(kept_steps), self.n_walkers))
+
+        start_time = time.time()
+        logger.info('Starting ensemble sampler with {0} walkers for {1} '
+                    'steps'.format(self.n_walkers, n_steps))
+
+        i = 0
+        for step in range(n_steps):
+            for active, others in (halves, halves[::-1]):
+                n_accepted[active] += self._stretch_move(
+                    walkers, log_probability, active, others)
+            if step >= n_burn and (step - n_burn) % thin == 0:
+                chain[i] = walkers
+                chain_log_probability[i] = log_probability
+                i += 1
+
+        logger.info("Sampling finished - took {0:.2f} s"
+                    .format(time.time() - start_time))
+
+        self.chain = chain
+        samples = self.priors.transform(chain.reshape(-1, self.n_params))
+        loglikelihood = chain_log_probability.ravel()
+
+        posterior_data = pd.DataFrame(
+            samples, columns=self.batch_likelihood.free_param_names)
+        posterior_data.insert(0, 'x', -2 * loglikelihood)
+        posterior_data.insert(0, 'posterior',
+                              np.ones(len(samples)) / len(samples))
+
+        self.result = EnsembleResult(posterior_data,
+                                     acceptance_fraction=n_accepted / n_steps)
+        return self.result
+
+    def __repr__(self):
+        return "{0}\n\n{1}".format(
+            self.likelihood, self.priors)
@@ -1,14 +1,13 @@
 import os
 import time
 import types
-from scipy import stats
 import tempfile
-from collections import OrderedDict
 from logging import getLogger
 import pandas as pd
 import shutil
 
 from starkit.fitkit.samplers.priors import PriorCollection
+from starkit.fitkit.samplers.base import cube_as_array, SamplerResult
 
 logger = getLogger(__name__)
 
@@ -25,12 +24,19 @@ except ImportError:
 else:
     multinest_available = True
 
+def prepare_multinest_evaluate(self):
+    # fixed parameters don't change during a run - keep a parameter buffer
+    # and the positions of the free parameters
+    self._multinest_free_index = np.flatnonzero(~self.fixed_mask())
+    self._multinest_parameters = np.array(self.parameters, dtype=np.float64)
+
 def multinest_evaluate(self, model_param, ndim, nparam):
     # returns the likelihood of observing the data given the model param_names
-    model_param = np.array([model_param[i] for i in xrange(nparam)])
-    parameters = self.parameters.copy()
-    parameters[~self.fixed_mask()] = model_param
-
+    parameters = getattr(self, '_multinest_parameters', None)
+    if parameters is None:
+        self.prepare_multinest_evaluate()
+        parameters = self._multinest_parameters
+    parameters[self._multinest_free_index] = cube_as_array(model_param, nparam)
 
     loglikelihood = self.evaluate(*parameters)
 
@@ -42,7 +48,7 @@ def fixed_mask(self):
 
 
 
-class MultiNestResult(object):
+class MultiNestResult(SamplerResult):
 
 
     @classmethod
@@ -64,26 +70,6 @@ class MultiNestResult(object):
 
         return cls(posterior_data)
 
-    @classmethod
-    def from_hdf5(cls, h5_fname, key):
-        """
-        Reading a Multinest result from its generated HDF5 file
-
-        Parameters
-        ----------
-
-        h5_fname: ~str
-            HDF5 filename
-
-        key: ~str
-            group identifier in the store
-        """
-
-        posterior_data = pd.read_hdf(h5_fname, key)
-
-        return cls(posterior_data)
-
-
     @staticmethod
     def read_posterior_data(basename, parameter_names):
         """
@@ -97,54 +83,6 @@ class MultiNestResult(object):
         posterior_data.index = np.arange(len(posterior_data))
         return posterior_data
 
-    def __init__(self, posterior_data):
-        self.posterior_data = posterior_data
-        self.parameter_names = [col_name for col_name in posterior_data.columns
-                                if col_name not in ['x', 'posterior']]
-
-    def calculate_sigmas(self, sigma):
-        sigmas = OrderedDict()
-        for parameter_name in self.parameter_names:
-            posterior_data = self.posterior_data.sort(parameter_name)
-            parameter_values, posterior_values = (posterior_data[parameter_name],
-                                                  posterior_data['posterior'])
-            posterior_cumsum = posterior_values.cumsum()
-
-            norm_distr = stats.norm(loc=0.0, scale=1.)
-
-            sigma_low = np.interp(norm_distr.cdf(-sigma), posterior_cumsum,
-                                  parameter_values)
-
-            sigma_high = np.interp(norm_distr.cdf(sigma), posterior_cumsum,
-                                  parameter_values)
-
-
-            sigmas[parameter_name] = (sigma_low, sigma_high)
-
-        return sigmas
-
-    @property
-    def mean(self):
-        if not hasattr(self, '_mean'):
-            _mean = OrderedDict([(param_name,
-                                  np.average(self.posterior_data[param_name],
-                                             weights=
-                                             self.posterior_data['posterior']))
-                                 for param_name in self.parameter_names])
-            self._mean = _mean
-
-        return self._mean
-
-
-    def plot_triangle(self, **kwargs):
-        try:
-            from triangle import corner
-        except ImportError:
-            raise ImportError('Plotting requires trianglepy')
-        data_columns = self.posterior_data.columns[2:]
-        corner(self.posterior_data[data_columns],
-               weights=self.posterior_data.posterior, **kwargs)
-
 
 
 
@@ -176,6 +114,8 @@ class MultiNest(object):
 
         self.likelihood.fixed_mask = types.MethodType(fixed_mask,
                                                       self.likelihood)
+        self.likelihood.prepare_multinest_evaluate = types.MethodType(
+            prepare_multinest_evaluate, self.likelihood)
         if not hasattr(priors, 'prior_transform'):
             self.priors = PriorCollection(priors)
         else:
@@ -225,6 +165,8 @@ class MultiNest(object):
 
         start_time = time.time()
 
+        self.likelihood.prepare_multinest_evaluate()
+
         logger.info('Starting fit in {0} with prefix {1}'.format(run_dir, self.prefix))
         pymultinest.run(self.likelihood.multinest_evaluate, self.priors.prior_transform,
                         self.n_params,
@@ -0,0 +1,120 @@
+import multiprocessing
+import warnings
+
+import numpy as np
+
+from starkit.fitkit.samplers.base import BatchLikelihood
+
+# likelihood of a worker process - set once when the worker starts
+_worker_likelihood = None
+
+
+def _initialize_worker(batch_likelihood):
+    global _worker_likelihood
+    _worker_likelihood = batch_likelihood
+
+
+def _evaluate_chunk(free_parameters):
+    return _worker_likelihood(free_parameters)
+
+
+def _uses_hdf5_fluxes(model):
+    """
+    Check if the grid of a model reads its fluxes through an open h5py file
+    """
+    grid = getattr(model, 'grid', None)
+    if grid is None:
+        try:
+            grid = model[0]
+        except (TypeError, IndexError):
+            grid = model
+    fluxes = getattr(getattr(grid, 'interpolator', None), 'fluxes', None)
+    return getattr(fluxes, 'file_handle', None) is not None
+
+
+class PoolLikelihood(object):
+    """
+    Evaluate a batched likelihood in a pool of worker processes
+
+    The workers are forked once when the pool is created and keep the
+    likelihood (including the grid) in their copy-on-write memory, so only
+    the parameter vectors and log-likelihoods are sent between processes.
+    Each call splits the parameter vectors into one chunk per worker.
+
+    Can be given as `pool` to batch-capable samplers, e.g.
+    `EnsembleSampler`. The pool should be closed after use (or be used as
+    a context manager).
+
+    Open h5py files can't be shared with forked processes, so grids loaded
+    with `flux_storage='hdf5'` are refused - use 'memory' or 'mmap'. Where
+    fork is not available the likelihood (including the grid) is copied
+    to every worker.
+
+    Parameters
+    ----------
+
+    batch_likelihood: ~BatchLikelihood or ~astropy.modeling.Model
+        likelihood to evaluate - models are wrapped in a `BatchLikelihood`
+
+    processes: int
+        number of worker processes [default number of CPUs]
+    """
+
+    def __init__(self, batch_likelihood, processes=None):
+        if not isinstance(batch_likelihood, BatchLikelihood):
+            batch_likelihood = BatchLikelihood(batch_likelihood)
+        self.batch_likelihood = batch_likelihood
+        if _uses_hdf5_fluxes(batch_likelihood.likelihood):
+            raise ValueError("Grids reading their fluxes through h5py can't "
+                             "be shared with worker processes - load the "
+                             "grid with flux_storage='memory' or 'mmap'")
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+
+        try:
+            # fork shares the memory of this process with the workers
+            context = multiprocessing.get_context('fork')
+        except (AttributeError, ValueError):
+            warnings.warn('fork is not available - the likelihood (including '
+                          'the grid) is copied to every worker process')
+            context = multiprocessing
+        self._pool = context.Pool(processes, initializer=_initialize_worker,
+                                  initargs=(batch_likelihood, ))
+
+    @property
+    def n_params(self):
+        return self.batch_likelihood.n_params
+
+    def __call__(self, free_parameters):
+        """
+        Parameters
+        ----------
+
+        free_parameters: ~np.ndarray
+            values of the free parameters (n_points, n_params)
+
+        Returns
+        -------
+            : ~np.ndarray
+            log-likelihoods (n_points, )
+        """
+        if self._pool is None:
+            raise ValueError('Pool is closed')
+        free_parameters = np.atleast_2d(free_parameters)
+        chunks = np.array_split(free_parameters,
+                                min(self.processes, len(free_parameters)))
+        return np.concatenate(self._pool.map(_evaluate_chunk, chunks))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,4 +1,7 @@
-from scipy import stats
+import numpy as np
+from scipy import stats, special
+
+from starkit.fitkit.samplers.base import cube_as_array
 
 
 class UniformPrior(object):
@@ -46,7 +49,7 @@ class GaussianPrior(object):
         self.sigma = sigma
 
     def __call__(self, cube):
-        return stats.norm.ppf(cube,scale=self.sigma,loc=self.m)
+        return self.m + self.sigma * special.ndtri(cube)
 
     def __repr__(self):
         return "gaussian prior - mean {0} std {1}".format(self.m, self.sigma)
@@ -68,7 +71,7 @@ class PoissonPrior(object):
         self.m = m
 
     def __call__(self,cube):
-        return stats.poisson.ppf(cube,loc=self.m)
+        return stats.poisson.ppf(cube, self.m)
 
     def __repr__(self):
         return "poisson prior: loc {0}".format(self.m)
@@ -100,6 +103,10 @@ class FixedPrior(object):
 class PriorCollection(object):
     """
     A collection of prior objects that will be evaluated
+
+    Uniform, gaussian, poisson and fixed priors are grouped by type and
+    transformed together with array operations; other callables are called
+    one by one.
     """
     def __init__(self, priors_list):
 
@@ -109,12 +116,83 @@ class PriorCollection(object):
             if not hasattr(prior, '__call__'):
                 raise TypeError('Given prior {0} is not callable'.format(prior))
 
+        self._group_priors()
+
+    def _group_priors(self):
+        def group(prior_class, *attributes):
+            index = [i for i, prior in enumerate(self.priors)
+                     if type(prior) is prior_class]
+            values = [np.array([getattr(self.priors[i], attribute)
+                                for i in index], dtype=np.float64)
+                      for attribute in attributes]
+            return [np.array(index, dtype=np.int64)] + values
+
+        self._uniform_index, lbound, ubound = group(UniformPrior, 'lbound',
+                                                    'ubound')
+        self._uniform_lbound = lbound
+        self._uniform_width = ubound - lbound
+        (self._gaussian_index, self._gaussian_m,
+         self._gaussian_sigma) = group(GaussianPrior, 'm', 'sigma')
+        self._poisson_index, self._poisson_m = group(PoissonPrior, 'm')
+        self._fixed_index, self._fixed_val = group(FixedPrior, 'val')
+
+        grouped_classes = (UniformPrior, GaussianPrior, PoissonPrior,
+                           FixedPrior)
+        self._other_priors = [(i, prior) for i, prior in enumerate(self.priors)
+                              if type(prior) not in grouped_classes]
+
+    def _transform(self, cube, parameters):
+        """
+        Transform unit cube values (..., n_priors) into parameters - cube and
+        parameters may be the same array
+        """
+        if len(self._uniform_index) > 0:
+            index = self._uniform_index
+            parameters[..., index] = (cube[..., index] * self._uniform_width
+                                      + self._uniform_lbound)
+        if len(self._gaussian_index) > 0:
+            index = self._gaussian_index
+            parameters[..., index] = (self._gaussian_m + self._gaussian_sigma
+                                      * special.ndtri(cube[..., index]))
+        if len(self._poisson_index) > 0:
+            index = self._poisson_index
+            parameters[..., index] = stats.poisson.ppf(cube[..., index],
+                                                       self._poisson_m)
+        if len(self._fixed_index) > 0:
+            parameters[..., self._fixed_index] = self._fixed_val
+
+        for i, prior in self._other_priors:
+            parameters[..., i] = prior(cube[..., i])
+
+        return parameters
+
     def prior_transform(self, cube, ndim, nparam):
         # will be given an array of values from 0 to 1 and transforms it
         # according to the prior distribution
 
-        for i in xrange(nparam):
-            cube[i] = self.priors[i](cube[i])
+        values = cube_as_array(cube, nparam)
+        self._transform(values, values)
+        if isinstance(cube, list):
+            cube[:nparam] = values.tolist()
+
+    def transform(self, cube):
+        """
+        Transform points in the unit cube according to the priors
+
+        Parameters
+        ----------
+
+        cube: ~np.ndarray
+            values between 0 and 1 - a single point (n_priors, ) or many
+            points (n_points, n_priors)
+
+        Returns
+        -------
+            : ~np.ndarray
+            parameters with the same shape as cube
+        """
+        cube = np.asarray(cube, dtype=np.float64)
+        return self._transform(cube, np.empty_like(cube))
 
     def _generate_prior_str(self):
         return [repr(item) for item in self.priors]
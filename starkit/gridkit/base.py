@@ -1,9 +1,14 @@
+import warnings
+
 from astropy import modeling
 from astropy import units as u, constants as const
 import pandas as pd
 import h5py
 from scipy import interpolate
 from starkit.fitkit.samplers.priors import UniformPrior
+from starkit.gridkit.interpolation import RegularGridInterpolator
+from starkit.base.operations.base import (add_derivatives,
+                                          parameter_derivative)
 
 import numpy as np
 
@@ -17,10 +22,18 @@ class BaseSpectralGrid(modeling.FittableModel):
         self.R = kwargs.pop('R', None)
         self.R_sampling = kwargs.pop('R_sampling', None)
         self.flux_unit = kwargs.pop('flux_unit', None)
+        self.wavelength_unit = kwargs.pop('wavelength_unit', None)
+        self.parameter_ranges = kwargs.pop('parameter_ranges', None) or {}
+        interpolator = kwargs.pop('interpolator', 'auto')
 
         super(BaseSpectralGrid, self).__init__(**kwargs)
-        self.interpolator = self._generate_interpolator(index, fluxes)
-        self.wavelength = wavelength
+        self.interpolator = self._generate_interpolator(index, fluxes,
+                                                        interpolator)
+        if hasattr(wavelength, 'unit'):
+            # keep the units out of the evaluation
+            self.wavelength_unit = wavelength.unit
+            wavelength = wavelength.value
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
 
 
 #    def prepare_inputs(self, *inputs, **kwargs):
@@ -32,8 +45,12 @@ class BaseSpectralGrid(modeling.FittableModel):
     def get_grid_extent(self):
         extents = []
         for i, param_name in enumerate(self.param_names):
-            extents.append((self.interpolator.points[:,i].min(),
-                            self.interpolator.points[:,i].max()))
+            lower, upper = (self.interpolator.points[:,i].min(),
+                            self.interpolator.points[:,i].max())
+            if param_name in self.parameter_ranges:
+                range_lower, range_upper = self.parameter_ranges[param_name]
+                lower, upper = max(lower, range_lower), min(upper, range_upper)
+            extents.append((lower, upper))
         return extents
 
     def get_grid_uniform_priors(self):
@@ -45,13 +62,129 @@ class BaseSpectralGrid(modeling.FittableModel):
         return priors
 
     def evaluate(self, *args):
-
-        return self.wavelength, self.interpolator(np.array(
-            args).reshape(len(self.param_names)))[0]
+        parameters = np.array(np.broadcast_arrays(*args), dtype=np.float64)
+        if parameters.size == len(self.param_names):
+            return self.wavelength, self.interpolator(
+                parameters.reshape(len(self.param_names)))[0]
+        else:
+            return self.evaluate_batch(
+                parameters.reshape(len(self.param_names), -1).T)
+
+    def evaluate_batch(self, parameters):
+        """
+        Evaluate the grid for many parameter vectors at once
+
+        Parameters
+        ----------
+
+        parameters: ~np.ndarray
+            parameter vectors (n_spectra, n_params) in the order of
+            `param_names`
+
+        Returns
+        -------
+            : ~np.ndarray
+            wavelength (n_wavelength, )
+            : ~np.ndarray
+            stacked fluxes (n_spectra, n_wavelength)
+        """
+        parameters = np.asarray(parameters, dtype=np.float64).reshape(
+            -1, len(self.param_names))
+        return self.wavelength, self.interpolator(parameters)
+
+    def evaluate_derivative(self, parameter_directions, *args):
+        """
+        Evaluate the grid for a single parameter vector together with the
+        derivatives of the spectrum along the given directions
+
+        Parameters
+        ----------
+
+        parameter_directions: list
+            derivative of each grid parameter along the directions
+            ((n_directions, ) arrays or None for fixed parameters)
+
+        Returns
+        -------
+            : ~np.ndarray
+            wavelength
+            : ~np.ndarray
+            flux
+            : None
+            derivatives of the wavelength (zero)
+            : ~np.ndarray or None
+            derivatives of the flux (n_directions, n_wavelength)
+        """
+        parameters = np.array(args, dtype=np.float64).reshape(
+            len(self.param_names))
+        if hasattr(self.interpolator, 'gradient'):
+            flux, gradient = self.interpolator.gradient(parameters)
+        else:
+            # central differences for interpolators without derivatives
+            flux = self.interpolator(parameters)[0]
+            gradient = []
+            for i, direction in enumerate(parameter_directions):
+                if direction is None:
+                    gradient.append(None)
+                    continue
+                step = 1e-6 * max(np.abs(parameters[i]), 1.)
+                offset = np.zeros_like(parameters)
+                offset[i] = step
+                gradient.append(
+                    (self.interpolator(parameters + offset)[0] -
+                     self.interpolator(parameters - offset)[0]) / (2 * step))
+
+        d_flux = add_derivatives(*[
+            parameter_derivative(direction, gradient[i])
+            for i, direction in enumerate(parameter_directions)])
+        return self.wavelength, flux, None, d_flux
 
     @staticmethod
-    def _generate_interpolator(index, fluxes):
-        return interpolate.LinearNDInterpolator(index, fluxes)
+    def _generate_interpolator(index, fluxes, interpolator='auto'):
+        """
+        Generate the interpolator for the grid
+
+        Parameters
+        ----------
+
+        index: ~pd.DataFrame
+            grid parameters of the spectra
+
+        fluxes: ~np.ndarray
+            spectra of the grid
+
+        interpolator: str
+            'regular' uses a multilinear interpolation on the rectilinear
+            grid, 'delaunay' triangulates the grid and 'auto' chooses
+            'regular' only if no grid point is missing. 'regular' returns nan
+            in cells next to a missing grid point (with a warning), where
+            'delaunay' interpolates from the surrounding points. 'delaunay'
+            needs all fluxes in memory [default 'auto']
+        """
+        points = np.asarray(index, dtype=np.float64)
+        is_complete = RegularGridInterpolator.is_regular(
+            points, min_fill_fraction=1.)
+        if interpolator == 'auto':
+            interpolator = 'regular' if is_complete else 'delaunay'
+
+        if interpolator == 'regular':
+            if not is_complete:
+                warnings.warn("The grid has missing points - the regular "
+                              "interpolator returns nan in the cells next "
+                              "to them (use interpolator='delaunay' to "
+                              "interpolate across them)")
+            return RegularGridInterpolator(points, fluxes)
+        elif interpolator == 'delaunay':
+            if isinstance(fluxes, OnDiskFluxes):
+                # LinearNDInterpolator would read the whole grid into memory
+                raise ValueError("The delaunay interpolator needs the fluxes "
+                                 "in memory - use flux_storage='memory' or "
+                                 "interpolator='regular'")
+            return interpolate.LinearNDInterpolator(points, fluxes)
+        else:
+            raise ValueError('Interpolator {0} not understood - '
+                             'use regular, delaunay or auto'.format(
+                interpolator))
 
     @property
     def velocity_per_pix(self):
@@ -61,6 +194,213 @@ class BaseSpectralGrid(modeling.FittableModel):
         else:
             return const.c / self.R / self.R_sampling
 
+class OnDiskFluxes(object):
+    """
+    Row-wise access to a grid flux array that is kept on disk
+
+    Only the rows requested through indexing are read, so the operating
+    system page cache can be shared between processes using the same grid.
+
+    Parameters
+    ----------
+
+    fluxes: ~np.memmap or ~h5py.Dataset
+        flux array on disk (n_points, n_wavelength)
+
+    rows: ~np.ndarray
+        rows of the on-disk array to expose - None for all [default None]
+
+    columns: slice
+        columns (wavelength range) of the on-disk array to expose
+        [default all]
+
+    file_handle: ~h5py.File
+        open file the dataset belongs to - kept alive with this object
+
+    dtype: ~np.dtype
+        convert the rows to this type when reading - None keeps the type on
+        disk [default None]
+    """
+
+    def __init__(self, fluxes, rows=None, columns=slice(None),
+                 file_handle=None, dtype=None):
+        self.fluxes = fluxes
+        self.rows = rows
+        self.columns = columns
+        self.file_handle = file_handle
+
+        n_rows = fluxes.shape[0] if rows is None else len(rows)
+        n_columns = len(range(*columns.indices(fluxes.shape[1])))
+        self.shape = (n_rows, n_columns)
+        self.dtype = np.dtype(fluxes.dtype if dtype is None else dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        rows = np.arange(self.shape[0])[item]
+        scalar = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        if self.rows is not None:
+            rows = self.rows[rows]
+
+        if isinstance(self.fluxes, np.ndarray):
+            data = np.asarray(self.fluxes[rows, self.columns])
+        else:
+            # h5py only allows increasing and unique indices
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            data = self.fluxes[unique_rows.tolist(), self.columns][inverse]
+
+        data = data.astype(self.dtype, copy=False)
+        return data[0] if scalar else data
+
+    def __array__(self, dtype=None, copy=None):
+        if copy is False:
+            raise ValueError('Fluxes on disk can not be converted to an '
+                             'array without reading (copying) them')
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+
+def _open_fluxes(hdf_fname, flux_storage, columns=slice(None), rows=None,
+                 dtype=None):
+    """
+    Open the flux array of a grid file
+
+    Parameters
+    ----------
+
+    hdf_fname: str
+        filename of the grid
+
+    flux_storage: str
+        'memory' reads the full array, 'mmap' memory-maps it (falling back
+        to 'hdf5' for non-contiguous datasets) and 'hdf5' reads rows through
+        h5py on demand
+
+    columns: slice
+        wavelength columns to use [default all]
+
+    rows: ~np.ndarray
+        increasing grid points (rows) to use - None for all [default None]
+
+    dtype: ~np.dtype
+        type of the returned fluxes - None keeps the type of the file
+        [default None]
+
+    Returns
+    -------
+        : ~np.ndarray or ~OnDiskFluxes
+    """
+    if flux_storage not in ('memory', 'mmap', 'hdf5'):
+        raise ValueError('flux_storage {0} not understood - '
+                         'use memory, mmap or hdf5'.format(flux_storage))
+
+    if flux_storage == 'memory':
+        with h5py.File(hdf_fname, 'r') as fh:
+            if rows is None:
+                fluxes = fh['fluxes'][:, columns]
+            else:
+                fluxes = fh['fluxes'][rows.tolist(), columns]
+        return fluxes if dtype is None else fluxes.astype(dtype, copy=False)
+
+    fh = h5py.File(hdf_fname, 'r')
+    dataset = fh['fluxes']
+
+    if flux_storage == 'mmap':
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            fluxes = np.memmap(hdf_fname, mode='r', dtype=dataset.dtype,
+                               shape=dataset.shape, offset=offset)
+            fh.close()
+            return OnDiskFluxes(fluxes, rows=rows, columns=columns,
+                                dtype=dtype)
+
+    return OnDiskFluxes(dataset, rows=rows, columns=columns, file_handle=fh,
+                        dtype=dtype)
+
+
+def _get_wavelength_slice(wavelength, wavelength_range,
+                          velocity_padding=None):
+    """
+    Find the columns of the grid covering a wavelength range
+
+    Parameters
+    ----------
+
+    wavelength: ~np.ndarray
+        wavelength of the grid
+
+    wavelength_range: tuple
+        lower and upper wavelength (in the units of the grid wavelength)
+
+    velocity_padding: float
+        maximum velocity (km/s) by which the range is extended on either
+        side, e.g. to allow for doppler shifts and broadening kernels
+        [default None]
+
+    Returns
+    -------
+        : slice
+    """
+    lower, upper = wavelength_range
+    if velocity_padding is not None:
+        beta = (u.Quantity(velocity_padding, u.km / u.s) / const.c).to(1).value
+        doppler_factor = np.sqrt((1 + beta) / (1 - beta))
+        lower /= doppler_factor
+        upper *= doppler_factor
+
+    if lower >= wavelength[-1] or upper <= wavelength[0]:
+        raise ValueError('Wavelength range {0} - {1} is not covered by the '
+                         'grid'.format(*wavelength_range))
+
+    # keep one pixel beyond the range on either side for interpolation
+    start = max(np.searchsorted(wavelength, lower, side='right') - 1, 0)
+    stop = min(np.searchsorted(wavelength, upper, side='left') + 1,
+               len(wavelength))
+    return slice(start, stop)
+
+
+def _get_parameter_rows(index, parameter_ranges):
+    """
+    Find the grid points inside the given parameter ranges
+
+    For every parameter the nearest grid node at or beyond each bound is
+    included so that interpolation at the bounds is possible.
+
+    Parameters
+    ----------
+
+    index: ~pd.DataFrame
+        grid parameters of the spectra
+
+    parameter_ranges: dict
+        lower and upper bound for parameters, e.g. {'teff': (3000, 4500)}
+
+    Returns
+    -------
+        : ~np.ndarray
+        increasing row numbers of the selected grid points
+    """
+    selected = np.ones(len(index), dtype=bool)
+    for param_name, (lower, upper) in parameter_ranges.items():
+        if param_name not in index.columns:
+            raise ValueError('Parameter {0} not in grid (available {1})'.format(
+                param_name, ', '.join(index.columns)))
+        values = index[param_name].values
+        nodes = np.unique(values)
+        lower_node = nodes[max(np.searchsorted(nodes, lower, side='right') - 1,
+                               0)]
+        upper_node = nodes[min(np.searchsorted(nodes, upper, side='left'),
+                               len(nodes) - 1)]
+        selected &= (values >= lower_node) & (values <= upper_node)
+
+    if not np.any(selected):
+        raise ValueError('No grid points within {0}'.format(parameter_ranges))
+
+    return np.nonzero(selected)[0]
+
+
 def _get_interpolate_parameters(index):
     interpolate_parameters = []
 
@@ -70,12 +410,69 @@ def _get_interpolate_parameters(index):
     return interpolate_parameters
 
 
-def load_grid(hdf_fname):
+def load_grid(hdf_fname, interpolator='auto', flux_storage='memory',
+              wavelength_range=None, velocity_padding=None,
+              parameter_ranges=None, dtype=None):
+    """
+    Load a spectral grid from an HDF5 file
+
+    The wavelength and flux units of the file are stored on the grid
+    (`wavelength_unit`, `flux_unit`) and the evaluation works on plain
+    arrays in these units.
+
+    Parameters
+    ----------
+
+    hdf_fname: str
+        filename of the grid
+
+    interpolator: str
+        interpolation engine to use - 'regular', 'delaunay' or 'auto'
+        ('regular' for complete grids, 'delaunay' for grids with missing
+        points; see `BaseSpectralGrid._generate_interpolator`)
+        [default 'auto']
+
+    flux_storage: str
+        'memory' loads all fluxes into memory, 'mmap' memory-maps the
+        (contiguous) flux dataset and 'hdf5' reads the needed rows through
+        h5py. The on-disk modes only read the spectra needed for an
+        interpolation and require the 'regular' interpolator
+        [default 'memory']
+
+    wavelength_range: tuple of float or ~astropy.units.Quantity
+        only load the part of the grid between these wavelengths. Floats are
+        interpreted in the wavelength unit of the grid [default None]
+
+    velocity_padding: float or ~astropy.units.Quantity
+        extend the wavelength range by this velocity (km/s if float) on
+        either side - should cover the largest doppler shift and
+        broadening kernel width expected in the fit [default None]
+
+    parameter_ranges: dict
+        only load grid points within these parameter bounds, e.g.
+        {'teff': (3000, 4500), 'logg': (4., 5.5)}. The neighbouring node
+        beyond each bound is kept for interpolation and the grid extent is
+        limited to the bounds [default None]
+
+    dtype: ~np.dtype
+        type of the grid fluxes, e.g. np.float32 to halve the memory
+        footprint - None keeps the type of the file [default None]
+
+    Returns
+    -------
+        : ~SpectralGrid
+    """
     index = pd.read_hdf(hdf_fname, 'index')
+
+    if parameter_ranges is None:
+        rows = None
+    else:
+        rows = _get_parameter_rows(index, parameter_ranges)
+        index = index.iloc[rows]
+
     interpolate_parameters = _get_interpolate_parameters(index)
 
-    with h5py.File(hdf_fname) as fh:
-        fluxes = fh['fluxes'].__array__()
+    with h5py.File(hdf_fname, 'r') as fh:
         flux_unit = u.Unit(fh['fluxes'].attrs['unit'])
         wavelength = fh['wavelength'].__array__()
         data_set_type = fh['wavelength'].attrs['grid']
@@ -89,6 +486,17 @@ def load_grid(hdf_fname):
 
         wavelength_unit = u.Unit(fh['wavelength'].attrs['unit'])
 
+    if wavelength_range is None:
+        wavelength_slice = slice(None)
+    else:
+        wavelength_range = u.Quantity(wavelength_range, wavelength_unit)
+        wavelength_slice = _get_wavelength_slice(
+            wavelength, wavelength_range.value, velocity_padding)
+        wavelength = wavelength[wavelength_slice]
+
+    fluxes = _open_fluxes(hdf_fname, flux_storage, wavelength_slice, rows,
+                          dtype)
+
     class_dict = {item:modeling.Parameter() for item in interpolate_parameters}
     class_dict['__init__'] = BaseSpectralGrid.__init__
 
@@ -98,7 +506,9 @@ def load_grid(hdf_fname):
 
     return SpectralGrid(wavelength, index[interpolate_parameters], fluxes,
                         R=R, R_sampling=R_sampling, flux_unit=flux_unit,
-                        **initial_parameters)
+                        wavelength_unit=wavelength_unit,
+                        interpolator=interpolator,
+                        parameter_ranges=parameter_ranges, **initial_parameters)
 
 
 
@@ -0,0 +1,124 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from astropy import constants as const
+
+from starkit.base.operations.stellar import RotationalBroadening
+from starkit.base.operations.spectrograph import InstrumentConvolve
+
+logger = logging.getLogger(__name__)
+
+
+def write_broadened_grid(hdf_fname, broadened_fname, vrot, R=np.inf,
+                         limb_darkening=0.6, chunk_size=100, clobber=False):
+    """
+    Pre-convolve all spectra of a grid with rotational and instrumental
+    broadening and write them as a new grid
+
+    The new grid gains `vrot` as an additional parameter (sampled at the
+    given values) and has the instrument resolution `R` baked in, so a fit
+    with fixed `R` only needs to interpolate in (grid parameters, vrot) and
+    neither `RotationalBroadening` nor `InstrumentConvolve` are needed in the
+    model. The file can be read with `load_grid`.
+
+    Parameters
+    ----------
+
+    hdf_fname: str
+        filename of the (log-sampled) input grid
+
+    broadened_fname: str
+        filename of the broadened grid
+
+    vrot: ~np.ndarray
+        rotational velocities (km/s) of the vrot lattice
+
+    R: float
+        instrument resolution - np.inf for no instrumental broadening
+        [default np.inf]
+
+    limb_darkening: float
+        limb darkening used for the rotational profile [default 0.6]
+
+    chunk_size: int
+        number of grid spectra processed at once [default 100]
+
+    clobber: bool
+        overwrite an existing file [default False]
+    """
+
+    if os.path.exists(broadened_fname):
+        if clobber:
+            os.remove(broadened_fname)
+        else:
+            raise IOError('File {0} exists - if you want overwrite set '
+                          'clobber=True'.format(broadened_fname))
+
+    vrot = np.atleast_1d(np.asarray(vrot, dtype=np.float64))
+    index = pd.read_hdf(hdf_fname, 'index')
+    if 'vrot' in index.columns:
+        raise ValueError('Grid {0} already contains vrot'.format(hdf_fname))
+
+    with h5py.File(hdf_fname, 'r') as fh:
+        fluxes = fh['fluxes']
+        wavelength_attrs = dict(fh['wavelength'].attrs)
+        wavelength = fh['wavelength'].__array__()
+
+        if wavelength_attrs.get('grid') != 'log':
+            raise ValueError('Broadened grids can only be computed for '
+                             'log-sampled grids')
+
+        grid_R = wavelength_attrs.get('R', None)
+        grid_sampling = wavelength_attrs.get('R_sampling', 4)
+        if grid_R is None:
+            raise ValueError('Grid {0} has no resolution R'.format(hdf_fname))
+
+        velocity_per_pix = const.c / grid_R / grid_sampling
+        rotation = RotationalBroadening(velocity_per_pix=velocity_per_pix)
+        instrument = InstrumentConvolve(R=R, grid_R=grid_R,
+                                        grid_sampling=grid_sampling)
+
+        n_points, n_wavelength = fluxes.shape
+
+        with h5py.File(broadened_fname, 'w') as broadened_fh:
+            broadened_fluxes = broadened_fh.create_dataset(
+                'fluxes', (n_points * len(vrot), n_wavelength),
+                dtype=fluxes.dtype)
+            broadened_fluxes.attrs['unit'] = fluxes.attrs['unit']
+
+            for start in range(0, n_points, chunk_size):
+                stop = min(start + chunk_size, n_points)
+                logger.info('Broadening spectra {0} - {1} of {2}'.format(
+                    start, stop, n_points))
+                flux_chunk = fluxes[start:stop]
+                # the chunk is broadened with every vrot - transform it once
+                flux_transforms = {}
+                for i, current_vrot in enumerate(vrot):
+                    broadened_flux = rotation._broaden(
+                        flux_chunk, current_vrot, limb_darkening,
+                        flux_transforms)
+                    _, broadened_flux = instrument.evaluate(
+                        wavelength, broadened_flux, R)
+                    offset = i * n_points
+                    broadened_fluxes[offset + start:offset + stop] = \
+                        broadened_flux
+
+            broadened_fh['wavelength'] = wavelength
+            for key, value in wavelength_attrs.items():
+                broadened_fh['wavelength'].attrs[key] = value
+
+            if not np.isinf(R):
+                # resolution changes, velocity per pixel stays the same
+                broadened_fh['wavelength'].attrs['R'] = R
+                broadened_fh['wavelength'].attrs['R_sampling'] = (
+                    grid_R * grid_sampling / float(R))
+            broadened_fh['wavelength'].attrs['limb_darkening'] = limb_darkening
+
+    broadened_index = pd.concat([index.assign(vrot=current_vrot)
+                                 for current_vrot in vrot],
+                                ignore_index=True)
+    broadened_index.to_hdf(broadened_fname, key='index')
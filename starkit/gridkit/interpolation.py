@@ -0,0 +1,240 @@
+from itertools import product
+
+import numpy as np
+from scipy import sparse
+
+
+class RegularGridInterpolator(object):
+    """
+    Multilinear interpolation on a rectilinear grid of spectra
+
+    The grid may have holes (missing nodes). Spectra are blended from the
+    2^d corner nodes of the cell containing the requested point, which
+    gives the same values as `scipy.interpolate.RegularGridInterpolator`
+    on complete grids. Points outside the grid return `fill_value`
+    (mimicking `scipy.interpolate.LinearNDInterpolator`).
+
+    Unlike the triangulation of `LinearNDInterpolator`, which interpolates
+    across holes from the surrounding nodes, points in a cell next to a
+    hole (with a missing corner that has a non-zero weight) also return
+    `fill_value`.
+
+    Parameters
+    ----------
+
+    points: ~np.ndarray
+        grid parameters of each spectrum (n_points, n_dim)
+
+    fluxes: ~np.ndarray
+        spectra (n_points, n_wavelength)
+
+    fill_value: float
+        value for points that can't be interpolated [default nan]
+    """
+
+    def __init__(self, points, fluxes, fill_value=np.nan):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.fluxes = fluxes
+        self.fill_value = fill_value
+        # float32 grids are interpolated in float32
+        self.result_dtype = np.result_type(fluxes.dtype, np.float32)
+
+        self.ndim = self.points.shape[1]
+        self.axes = [np.unique(self.points[:, i]) for i in range(self.ndim)]
+        self.shape = tuple(len(axis) for axis in self.axes)
+
+        # lattice position -> row in fluxes (-1 marks a hole)
+        node_index = tuple(np.searchsorted(axis, self.points[:, i])
+                           for i, axis in enumerate(self.axes))
+        self.lookup = -np.ones(self.shape, dtype=np.int64)
+        self.lookup[node_index] = np.arange(len(self.points))
+
+        self.corner_offsets = np.array(list(product([0, 1],
+                                                    repeat=self.ndim)))
+
+    @staticmethod
+    def is_regular(points, min_fill_fraction=0.5):
+        """
+        Check if points lie on a sufficiently filled rectilinear lattice
+
+        Parameters
+        ----------
+
+        points: ~np.ndarray
+            grid parameters (n_points, n_dim)
+
+        min_fill_fraction: float
+            minimum fraction of lattice nodes that need to be present
+        """
+        points = np.asarray(points)
+        n_nodes = np.prod([len(np.unique(points[:, i]))
+                           for i in range(points.shape[1])])
+        return len(points) >= min_fill_fraction * n_nodes
+
+    def find_cells(self, xi):
+        """
+        Locate the cells containing the requested points
+
+        Parameters
+        ----------
+
+        xi: ~np.ndarray
+            requested points (n, n_dim)
+
+        Returns
+        -------
+            : ~np.ndarray
+            lower corner lattice index (n, n_dim)
+            : ~np.ndarray
+            fractional position within the cell (n, n_dim)
+            : ~np.ndarray
+            boolean array marking points inside the grid extent (n, )
+        """
+        cell_index = np.empty(xi.shape, dtype=np.int64)
+        cell_fraction = np.empty(xi.shape, dtype=np.float64)
+        inside = np.ones(len(xi), dtype=bool)
+
+        for i, axis in enumerate(self.axes):
+            x = xi[:, i]
+            inside &= (x >= axis[0]) & (x <= axis[-1])
+            if len(axis) == 1:
+                cell_index[:, i] = 0
+                cell_fraction[:, i] = 0.0
+                continue
+            idx = np.clip(np.searchsorted(axis, x, side='right') - 1,
+                          0, len(axis) - 2)
+            cell_index[:, i] = idx
+            cell_fraction[:, i] = (x - axis[idx]) / (axis[idx + 1] - axis[idx])
+
+        return cell_index, cell_fraction, inside
+
+    def corner_weights(self, xi):
+        """
+        Calculate the flux rows and blending weights of the cell corners
+
+        Parameters
+        ----------
+
+        xi: ~np.ndarray
+            requested points (n, n_dim)
+
+        Returns
+        -------
+            : ~np.ndarray
+            rows into fluxes for each corner (n, 2^n_dim); -1 for holes
+            : ~np.ndarray
+            weights for each corner (n, 2^n_dim)
+            : ~np.ndarray
+            boolean array marking points that can be interpolated (n, )
+        """
+        cell_index, cell_fraction, valid = self.find_cells(xi)
+
+        corner_index = (cell_index[:, np.newaxis, :] +
+                        self.corner_offsets[np.newaxis, :, :])
+        corner_index = np.minimum(corner_index,
+                                  np.array(self.shape) - 1)
+        rows = self.lookup[tuple(corner_index[..., i]
+                                 for i in range(self.ndim))]
+
+        weights = np.where(self.corner_offsets[np.newaxis, :, :] == 1,
+                           cell_fraction[:, np.newaxis, :],
+                           1. - cell_fraction[:, np.newaxis, :]).prod(-1)
+
+        # holes only matter if they contribute to the interpolation
+        valid &= ~np.any((rows < 0) & (weights > 0), axis=1)
+        rows = np.where(weights > 0, rows, -1)
+
+        return rows, weights, valid
+
+    def __call__(self, xi):
+        xi = np.asarray(xi, dtype=np.float64).reshape(-1, self.ndim)
+        rows, weights, valid = self.corner_weights(xi)
+        n_wavelength = self.fluxes.shape[1]
+
+        rows[~valid] = -1
+        used = rows >= 0
+        if not np.any(used):
+            return np.ones((len(xi), n_wavelength),
+                           dtype=self.result_dtype) * self.fill_value
+
+        point_index = np.nonzero(used)[0]
+        corner_weights = weights[used].astype(self.result_dtype)
+        needed_rows, corner_rows = np.unique(rows[used], return_inverse=True)
+        if 4 * len(needed_rows) <= len(corner_rows):
+            # points share their corners - read every needed spectrum once
+            # and blend them with a dense (n_points, n_needed_rows) product
+            weight_matrix = np.zeros((len(xi), len(needed_rows)),
+                                     dtype=self.result_dtype)
+            np.add.at(weight_matrix, (point_index, corner_rows),
+                      corner_weights)
+            result = np.dot(weight_matrix, self.fluxes[needed_rows])
+        elif isinstance(self.fluxes, np.ndarray):
+            # sparse product reading the corner spectra in place
+            weight_matrix = sparse.csr_matrix(
+                (corner_weights, (point_index, rows[used])),
+                shape=(len(xi), len(self.fluxes)))
+            result = weight_matrix.dot(self.fluxes)
+        else:
+            # fluxes on disk are read once
+            weight_matrix = sparse.csr_matrix(
+                (corner_weights, (point_index, corner_rows)),
+                shape=(len(xi), len(needed_rows)))
+            result = weight_matrix.dot(self.fluxes[needed_rows])
+
+        result = result.astype(self.result_dtype, copy=False)
+        result[~valid] = self.fill_value
+        return result
+
+    def gradient(self, xi):
+        """
+        Interpolate a single point and calculate the derivatives of the
+        spectrum with respect to the grid parameters
+
+        Within a cell the interpolation is linear in each parameter, so the
+        derivatives follow from the derivatives of the corner weights.
+
+        Parameters
+        ----------
+
+        xi: ~np.ndarray
+            requested point (n_dim, )
+
+        Returns
+        -------
+            : ~np.ndarray
+            spectrum (n_wavelength, )
+            : ~np.ndarray
+            derivatives (n_dim, n_wavelength)
+        """
+        xi = np.asarray(xi, dtype=np.float64).reshape(1, self.ndim)
+        cell_index, cell_fraction, inside = self.find_cells(xi)
+        n_wavelength = self.fluxes.shape[1]
+        if not inside[0]:
+            return (np.ones(n_wavelength) * self.fill_value,
+                    np.ones((self.ndim, n_wavelength)) * self.fill_value)
+
+        corner_index = np.minimum(cell_index + self.corner_offsets,
+                                  np.array(self.shape) - 1)
+        rows = self.lookup[tuple(corner_index[:, i]
+                                 for i in range(self.ndim))]
+
+        upper_corner = self.corner_offsets == 1
+        factors = np.where(upper_corner, cell_fraction, 1. - cell_fraction)
+        weights = factors.prod(1)
+        weight_gradient = np.zeros((len(rows), self.ndim))
+        for i, axis in enumerate(self.axes):
+            if len(axis) == 1:
+                continue
+            width = axis[cell_index[0, i] + 1] - axis[cell_index[0, i]]
+            weight_gradient[:, i] = (np.where(upper_corner[:, i], 1., -1.) *
+                                     np.delete(factors, i, axis=1).prod(1) /
+                                     width)
+
+        used = (weights != 0) | np.any(weight_gradient != 0, axis=1)
+        if np.any(used & (rows < 0)):
+            return (np.ones(n_wavelength) * self.fill_value,
+                    np.ones((self.ndim, n_wavelength)) * self.fill_value)
+
+        corner_fluxes = np.asarray(self.fluxes[rows[used]], dtype=np.float64)
+        return (np.dot(weights[used], corner_fluxes),
+                np.dot(weight_gradient[used].T, corner_fluxes))
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+
+from astropy import units as u
+
+pytest.importorskip('specutils')
+pytest.importorskip('tables')
+
+from starkit.fix_spectrum1d import Spectrum1D
+from starkit.base.assemble_model import assemble_model
+from starkit.fitkit.batch import BatchFitter
+from starkit.tests.test_derivatives import make_grid
+
+truth = {'teff_0': 4300., 'logg_0': 2.7, 'vrot_1': 40., 'vrad_2': 25.}
+
+
+def make_spectra():
+    grid = make_grid()
+    grid.teff, grid.logg = truth['teff_0'], truth['logg_0']
+    spectra = {}
+    for seed, (name, n_pix) in enumerate([('long', 700), ('short', 450)]):
+        wavelength = np.linspace(5015., 5015. + n_pix / 10., n_pix)
+        template = Spectrum1D.from_array(
+            wavelength * u.angstrom,
+            np.ones(n_pix) * u.erg / u.s / u.cm**2 / u.angstrom)
+        flux = assemble_model(grid, template, vrot=truth['vrot_1'],
+                              vrad=truth['vrad_2'], R=8000.)()[1]
+        uncertainty = 1e-3 * np.ones(n_pix)
+        flux = flux + uncertainty * np.random.RandomState(seed).randn(n_pix)
+        spectra[name] = Spectrum1D.from_array(
+            wavelength * u.angstrom, flux * template.flux.unit)
+        spectra[name].uncertainty = uncertainty * template.flux.unit
+    return make_grid(), spectra
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_batch_fitter(tmpdir, processes):
+    grid, spectra = make_spectra()
+    output_dir = str(tmpdir.join('results'))
+    batch_fitter = BatchFitter(grid, spectra['long'], vrot=30., vrad=20.,
+                               R=8000.)
+    result_fnames = batch_fitter.run(spectra, output_dir,
+                                     processes=processes)
+    assert list(result_fnames.keys()) == ['long', 'short']
+
+    for name, fname in result_fnames.items():
+        assert fname == os.path.join(output_dir, '{0}.h5'.format(name))
+        best_fit = pd.read_hdf(fname, key='best_fit')
+        assert np.isfinite(best_fit['loglikelihood'][0])
+        for param_name, tolerance in zip(truth, [20., 0.05, 1., 0.1]):
+            assert abs(best_fit[param_name][0] -
+                       truth[param_name]) < tolerance
+
+        # results in this process start from the same parameters
+        assert_allclose(batch_fitter.fit(spectra[name]).best_fit[
+            'vrad_2'], best_fit['vrad_2'][0], rtol=1e-6)
+
+    # existing results are skipped unless overwritten
+    modification_time = os.path.getmtime(result_fnames['short'])
+    os.utime(result_fnames['short'], (0, 0))
+    assert batch_fitter.run(spectra, output_dir,
+                            processes=processes) == result_fnames
+    assert os.path.getmtime(result_fnames['short']) == 0
+    batch_fitter.run({'short': spectra['short']}, output_dir,
+                     processes=processes, overwrite=True)
+    assert os.path.getmtime(result_fnames['short']) >= modification_time
@@ -0,0 +1,172 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+
+from astropy import modeling, units as u
+
+pytest.importorskip('specutils')
+
+from starkit.fix_spectrum1d import Spectrum1D
+from starkit.base.compiled_model import CompiledModel
+from starkit.base.operations.stellar import (RotationalBroadening,
+                                             DopplerShift, CCM89Extinction)
+from starkit.base.operations.spectrograph import (InstrumentConvolve,
+                                                  Interpolate, Normalize)
+from starkit.fitkit.likelihoods import Chi2Likelihood
+from starkit.gridkit.base import BaseSpectralGrid
+
+R = 20000.
+R_sampling = 4.
+
+
+class SyntheticGrid(BaseSpectralGrid):
+    teff = modeling.Parameter()
+    logg = modeling.Parameter()
+
+    __init__ = BaseSpectralGrid.__init__
+
+
+class ParameterStandIn(object):
+    def __init__(self, fixed):
+        self.fixed = fixed
+
+
+class ModelStandIn(object):
+    """
+    Parameter names, values and fixed flags of the compound model of a chain
+    """
+
+    def __init__(self, models):
+        self.param_names = []
+        parameters = []
+        for i, model in enumerate(models):
+            for param_name in model.param_names:
+                name = '{0}_{1}'.format(param_name, i)
+                self.param_names.append(name)
+                parameters.append(float(getattr(model, param_name).value))
+                setattr(self, name, ParameterStandIn(
+                    getattr(model, param_name).fixed))
+        self.parameters = np.array(parameters)
+
+
+def make_grid():
+    wavelength = np.exp(np.arange(np.log(5000), np.log(5100),
+                                  1 / R / R_sampling))
+    points = np.array([[teff, logg] for teff in [4000., 4500., 5000.]
+                       for logg in [1., 2., 3., 4.]])
+    fluxes = []
+    for teff, logg in points:
+        lines = sum(0.5 * np.exp(-0.5 * ((wavelength - center) /
+                                         (0.05 + 0.02 * logg)) ** 2) *
+                    (teff / 5000.) ** (1 + 0.3 * i)
+                    for i, center in enumerate(np.linspace(5010, 5090, 12)))
+        fluxes.append((1 - lines) *
+                      (1 + 1e-4 * (wavelength - 5000) * teff / 5000))
+    return SyntheticGrid(wavelength, pd.DataFrame(points, columns=['teff', 'logg']),
+                    np.array(fluxes), R=R, R_sampling=R_sampling, teff=4600.,
+                    logg=2.3)
+
+
+def make_observed():
+    observed_wavelength = np.linspace(5015, 5085, 700)
+    random_state = np.random.RandomState(1)
+    observed = Spectrum1D.from_array(
+        observed_wavelength * u.angstrom,
+        (1 + 0.01 * random_state.randn(700)) * u.erg / u.s / u.cm**2 /
+        u.angstrom)
+    observed.uncertainty = 0.01 * np.ones(700) * observed.flux.unit
+    return observed
+
+
+def compile_model(grid, spectrograph_operations, likelihood):
+    stellar_operations = [
+        RotationalBroadening(velocity_per_pix=grid.velocity_per_pix,
+                             vrot=15.),
+        DopplerShift(vrad=20.), CCM89Extinction(a_v=0.8)]
+    model = ModelStandIn([grid] + stellar_operations +
+                         spectrograph_operations + [likelihood])
+    return model, CompiledModel(model, grid, stellar_operations,
+                                spectrograph_operations, likelihood=likelihood)
+
+
+@pytest.mark.parametrize('normalize, marginalize', [
+    (False, False), (True, False), (False, True)])
+def test_jacobian_finite_differences(normalize, marginalize):
+    grid = make_grid()
+    observed = make_observed()
+    spectrograph_operations = [
+        InstrumentConvolve(R=8000., grid_R=R, grid_sampling=R_sampling),
+        Interpolate(observed)]
+    if normalize:
+        spectrograph_operations.append(Normalize(observed, 2))
+    likelihood = Chi2Likelihood(observed, normalize=2 if marginalize else None)
+    model, compiled_model = compile_model(grid, spectrograph_operations,
+                                          likelihood)
+
+    parameters = model.parameters
+    loglikelihood, jacobian = compiled_model.evaluate_jacobian(*parameters)
+    assert_allclose(loglikelihood, compiled_model.evaluate(*parameters),
+                    rtol=1e-12)
+
+    free_index = np.flatnonzero(~compiled_model._fixed_mask())
+    for i, parameter_index in enumerate(free_index):
+        # the rotational kernel is quantized, its derivative is itself a
+        # finite difference
+        if model.param_names[parameter_index].startswith('vrot'):
+            continue
+        step = 1e-4 * max(abs(parameters[parameter_index]), 1.)
+        upper_parameters = parameters.copy()
+        upper_parameters[parameter_index] += step
+        lower_parameters = parameters.copy()
+        lower_parameters[parameter_index] -= step
+        numerical = (compiled_model.evaluate(*upper_parameters) -
+                     compiled_model.evaluate(*lower_parameters)) / (2 * step)
+        assert_allclose(jacobian[i], numerical, rtol=1e-4)
+
+
+def test_marginal_loglikelihood():
+    observed = make_observed()
+    model_flux = 1 + 0.05 * np.sin(observed.wavelength.value / 7.)
+    observed_flux = observed.flux.value
+    uncertainty = observed.uncertainty.value
+    reduced_wavelength = (observed.wavelength.value /
+                          observed.wavelength.value.mean() - 1.)
+
+    for npol in [0, 1, 2]:
+        likelihood = Chi2Likelihood(observed, normalize=npol)
+        # log of the integral over the polynomial coefficients of the
+        # gaussian likelihood of y = V c
+        design = (np.polynomial.polynomial.polyvander(reduced_wavelength,
+                                                      npol) *
+                  (model_flux / uncertainty)[:, np.newaxis])
+        data = observed_flux / uncertainty
+        coefficients = np.linalg.lstsq(design, data, rcond=None)[0]
+        chi2 = np.sum((data - np.dot(design, coefficients)) ** 2)
+        log_determinant = np.linalg.slogdet(np.dot(design.T, design))[1]
+        expected = (-0.5 * chi2 - 0.5 * log_determinant +
+                    0.5 * (npol + 1) * np.log(2 * np.pi))
+
+        assert_allclose(likelihood.evaluate(None, model_flux), expected,
+                        rtol=1e-11)
+        assert_allclose(likelihood.evaluate(
+            None, np.vstack((model_flux, model_flux))), [expected, expected],
+            rtol=1e-11)
+
+
+def test_marginal_loglikelihood_singular():
+    observed = make_observed()
+    model_flux = 1 + 0.05 * np.sin(observed.wavelength.value / 7.)
+    likelihood = Chi2Likelihood(observed, normalize=2)
+    flux = np.vstack((model_flux, np.zeros_like(model_flux)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        loglikelihood = likelihood.evaluate(None, flux)
+        assert likelihood.evaluate(None, flux[1]) == -np.inf
+        assert likelihood.evaluate_derivative(
+            None, flux[1], None, np.ones((2, len(model_flux))),
+            [])[1].tolist() == [0., 0.]
+    assert np.isfinite(loglikelihood[0])
+    assert loglikelihood[1] == -np.inf
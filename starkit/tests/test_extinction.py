@@ -0,0 +1,65 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from starkit.base.operations.stellar import (CCM89Extinction, DopplerShift,
+                                             ccm89_coefficients)
+
+
+def direct_curve(wavelength, r_v):
+    a, b = ccm89_coefficients(wavelength)
+    return a + b / r_v
+
+
+def test_shifted_curve():
+    # covers the boundaries of the functional forms at 3030 and 9091 Angstrom
+    wavelength = np.exp(np.linspace(np.log(2500), np.log(12000), 20000))
+    extinction = CCM89Extinction(a_v=1., r_v=3.1)
+    doppler_shift = DopplerShift()
+    extinction.extinction_curve(wavelength, 3.1)
+
+    for vrad in [-250., -30., 0., 5., 120., 2000.]:
+        shifted_wavelength = doppler_shift.evaluate(
+            wavelength, np.ones_like(wavelength), vrad)[0]
+        assert_allclose(extinction.extinction_curve(shifted_wavelength, 3.1),
+                        direct_curve(shifted_wavelength, 3.1), rtol=1e-12)
+
+    # stacked spectra
+    vrad = np.array([-40., 10., 200.])
+    r_v = np.array([3.1, 3.1, 4.])
+    shifted_wavelength = doppler_shift.evaluate(
+        wavelength, np.ones((3, len(wavelength))), vrad)[0]
+    assert_allclose(
+        extinction.extinction_curve(shifted_wavelength, r_v[:, np.newaxis]),
+        [direct_curve(current_wavelength, current_r_v)
+         for current_wavelength, current_r_v
+         in zip(shifted_wavelength, r_v)], rtol=1e-12)
+
+
+def test_derivative():
+    wavelength = np.exp(np.linspace(np.log(4000), np.log(6000), 2000))
+    flux = 1 + 0.1 * np.sin(wavelength)
+    d_wavelength = np.zeros((3, len(wavelength)))
+    d_wavelength[0] = wavelength * 1e-4
+    extinction = CCM89Extinction()
+    a_v, r_v = 0.8, 3.5
+
+    extincted_flux, d_flux = extinction.evaluate_derivative(
+        wavelength, flux, d_wavelength, None,
+        [np.array([0., 1., 0.]), np.array([0., 0., 1.])], a_v, r_v)[1::2]
+    assert_allclose(extincted_flux,
+                    extinction.evaluate(wavelength, flux, a_v, r_v)[1],
+                    rtol=1e-12)
+
+    def numerical(step, wavelength_step=0., a_v_step=0., r_v_step=0.):
+        # the flux moves with the wavelength
+        return (extinction.evaluate(
+            wavelength + wavelength_step * d_wavelength[0], flux,
+            a_v + a_v_step, r_v + r_v_step)[1] -
+                extinction.evaluate(
+            wavelength - wavelength_step * d_wavelength[0], flux,
+            a_v - a_v_step, r_v - r_v_step)[1]) / (2 * step)
+
+    assert_allclose(d_flux[0], numerical(1e-3, wavelength_step=1e-3),
+                    rtol=1e-6)
+    assert_allclose(d_flux[1], numerical(1e-4, a_v_step=1e-4), rtol=1e-6)
+    assert_allclose(d_flux[2], numerical(1e-4, r_v_step=1e-4), rtol=1e-6)
@@ -0,0 +1,180 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+from scipy.interpolate import LinearNDInterpolator
+
+from astropy import units as u
+
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('tables')
+
+from starkit.base.operations.stellar import DopplerShift
+from starkit.gridkit.base import OnDiskFluxes, load_grid
+from starkit.gridkit.interpolation import RegularGridInterpolator
+
+R = 20000.
+R_sampling = 4.
+
+
+def write_grid(fname, n_teff=4, n_logg=3, holes=()):
+    wavelength = np.exp(np.arange(np.log(5000), np.log(5100),
+                                  1 / R / R_sampling))
+    index = pd.DataFrame([[teff, logg, 0.]
+                          for teff in np.linspace(4000., 5500., n_teff)
+                          for logg in np.linspace(1., 5., n_logg)],
+                         columns=['teff', 'logg', 'feh'])
+    index = index.drop(list(holes)).reset_index(drop=True)
+    fluxes = np.array([1 + 1e-4 * teff * np.sin(wavelength / logg)
+                       for teff, logg in index[['teff', 'logg']].values])
+
+    index.to_hdf(fname, key='index')
+    with h5py.File(fname, 'a') as fh:
+        fh['fluxes'] = fluxes
+        fh['fluxes'].attrs['unit'] = 'erg / (Angstrom cm2 s)'
+        fh['wavelength'] = wavelength
+        fh['wavelength'].attrs['unit'] = 'Angstrom'
+        fh['wavelength'].attrs['grid'] = 'log'
+        fh['wavelength'].attrs['R'] = R
+        fh['wavelength'].attrs['R_sampling'] = R_sampling
+    return wavelength, index, fluxes
+
+
+@pytest.mark.parametrize('flux_storage', ['memory', 'mmap', 'hdf5'])
+def test_flux_storage(tmpdir, flux_storage):
+    grid_fname = str(tmpdir.join('grid.h5'))
+    wavelength, index, fluxes = write_grid(grid_fname)
+    grid = load_grid(grid_fname, flux_storage=flux_storage)
+    assert grid.param_names == ('teff', 'logg')
+    assert_allclose(grid.wavelength, wavelength)
+
+    interpolator_fluxes = grid.interpolator.fluxes
+    if flux_storage == 'memory':
+        assert isinstance(interpolator_fluxes, np.ndarray)
+    else:
+        assert isinstance(interpolator_fluxes, OnDiskFluxes)
+        assert interpolator_fluxes.shape == fluxes.shape
+        assert_allclose(interpolator_fluxes[[3, 1, 3]], fluxes[[3, 1, 3]])
+        assert_allclose(np.array(interpolator_fluxes), fluxes)
+        with pytest.raises(ValueError):
+            np.asarray(interpolator_fluxes, copy=False)
+
+    # on a node and between the nodes
+    grid.teff, grid.logg = 4500., 3.
+    assert_allclose(grid()[1], fluxes[4], rtol=1e-12)
+    assert_allclose(grid.evaluate(4321., 2.3)[1],
+                    load_grid(grid_fname).evaluate(4321., 2.3)[1],
+                    rtol=1e-12)
+
+    # float32 fluxes
+    grid = load_grid(grid_fname, flux_storage=flux_storage,
+                     dtype=np.float32)
+    flux = grid.evaluate(4321., 2.3)[1]
+    assert flux.dtype == np.float32
+    assert_allclose(flux, load_grid(grid_fname).evaluate(4321., 2.3)[1],
+                    rtol=1e-6)
+
+
+@pytest.mark.parametrize('flux_storage', ['mmap', 'hdf5'])
+def test_on_disk_delaunay(tmpdir, flux_storage):
+    fname = str(tmpdir.join('grid.h5'))
+    # a grid with missing points is triangulated with 'auto'
+    write_grid(fname, holes=[4])
+    for interpolator in ['delaunay', 'auto']:
+        with pytest.raises(ValueError):
+            load_grid(fname, interpolator=interpolator,
+                      flux_storage=flux_storage)
+    load_grid(fname, interpolator='delaunay', flux_storage='memory')
+
+
+def test_auto_interpolator(tmpdir):
+    complete_fname = str(tmpdir.join('complete.h5'))
+    write_grid(complete_fname)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        grid = load_grid(complete_fname)
+    assert isinstance(grid.interpolator, RegularGridInterpolator)
+
+    # next to a missing point only 'delaunay' interpolates
+    fname = str(tmpdir.join('grid.h5'))
+    write_grid(fname, holes=[4])
+    grid = load_grid(fname)
+    assert isinstance(grid.interpolator, LinearNDInterpolator)
+    assert np.all(np.isfinite(grid.evaluate(4400., 2.5)[1]))
+    with pytest.warns(UserWarning, match='missing points'):
+        grid = load_grid(fname, interpolator='regular')
+    assert np.all(np.isnan(grid.evaluate(4400., 2.5)[1]))
+    assert np.all(np.isfinite(grid.evaluate(5200., 2.5)[1]))
+
+
+def test_wavelength_range(tmpdir):
+    grid_fname = str(tmpdir.join('grid.h5'))
+    write_grid(grid_fname)
+    full_grid = load_grid(grid_fname)
+    observed_wavelength = np.linspace(5020., 5080., 500)
+    max_vrad = 300.
+    grid = load_grid(grid_fname, wavelength_range=(5020., 5080.),
+                     velocity_padding=max_vrad)
+    assert len(grid.wavelength) < len(full_grid.wavelength)
+    # the same range in other units
+    nm_grid = load_grid(grid_fname, wavelength_range=(502., 508.) * u.nm,
+                        velocity_padding=max_vrad * u.km / u.s)
+    assert_allclose(nm_grid.wavelength, grid.wavelength)
+
+    start = np.searchsorted(full_grid.wavelength, grid.wavelength[0])
+    stop = start + len(grid.wavelength)
+    assert_allclose(grid.wavelength, full_grid.wavelength[start:stop])
+    for parameters in [(4321., 2.3), (5500., 5.)]:
+        flux = grid.evaluate(*parameters)[1]
+        full_flux = full_grid.evaluate(*parameters)[1]
+        assert_allclose(flux, full_flux[start:stop], rtol=1e-12)
+
+        # the shifted grid covers the observed range up to max_vrad
+        doppler_shift = DopplerShift()
+        for vrad in [-max_vrad, 0., max_vrad]:
+            shifted_wavelength = doppler_shift.evaluate(grid.wavelength, flux,
+                                                        vrad)[0]
+            assert shifted_wavelength[0] <= observed_wavelength[0]
+            assert shifted_wavelength[-1] >= observed_wavelength[-1]
+            full_shifted_wavelength = doppler_shift.evaluate(
+                full_grid.wavelength, full_flux, vrad)[0]
+            assert_allclose(
+                np.interp(observed_wavelength, shifted_wavelength, flux),
+                np.interp(observed_wavelength, full_shifted_wavelength,
+                          full_flux), rtol=1e-12)
+
+    # without padding the shifted grid misses the ends of the range
+    unpadded_grid = load_grid(grid_fname, wavelength_range=(5020., 5080.))
+    assert len(unpadded_grid.wavelength) < len(grid.wavelength)
+    assert (DopplerShift().evaluate(unpadded_grid.wavelength, None,
+                                    max_vrad)[0][0] > observed_wavelength[0])
+
+    with pytest.raises(ValueError):
+        load_grid(grid_fname, wavelength_range=(6000., 6100.))
+
+
+@pytest.mark.parametrize('flux_storage', ['memory', 'hdf5'])
+def test_parameter_ranges(tmpdir, flux_storage):
+    grid_fname = str(tmpdir.join('grid.h5'))
+    write_grid(grid_fname)
+    full_grid = load_grid(grid_fname)
+    parameter_ranges = {'teff': (4200., 4800.), 'logg': (1.5, 3.)}
+    grid = load_grid(grid_fname, parameter_ranges=parameter_ranges,
+                     flux_storage=flux_storage)
+
+    # the neighbouring nodes beyond the bounds are kept
+    assert_allclose(np.unique(grid.interpolator.points[:, 0]),
+                    [4000., 4500., 5000.])
+    assert_allclose(np.unique(grid.interpolator.points[:, 1]), [1., 3.])
+    assert grid.get_grid_extent() == [parameter_ranges['teff'],
+                                      parameter_ranges['logg']]
+
+    for teff in [4200., 4321., 4500., 4800.]:
+        for logg in [1.5, 2.2, 3.]:
+            assert_allclose(grid.evaluate(teff, logg)[1],
+                            full_grid.evaluate(teff, logg)[1], rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        load_grid(grid_fname, parameter_ranges={'vrot': (0., 10.)})
@@ -0,0 +1,88 @@
+from itertools import product
+
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy import interpolate
+
+from starkit.gridkit.interpolation import RegularGridInterpolator
+
+
+def make_grid(n_wavelength=50):
+    axes = [np.linspace(3000, 6000, 4), np.linspace(0, 5, 3),
+            np.array([-1., -0.5, 0.])]
+    points = np.array(list(product(*axes)))
+    fluxes = np.random.RandomState(0).rand(len(points), n_wavelength)
+    return axes, points, fluxes
+
+
+def test_matches_scipy_regular_grid():
+    axes, points, fluxes = make_grid()
+    interpolator = RegularGridInterpolator(points, fluxes)
+    scipy_interpolator = interpolate.RegularGridInterpolator(
+        axes, fluxes.reshape([len(axis) for axis in axes] + [-1]))
+
+    xi = np.array([[4321., 2.3, -0.7], [3000., 0., -1.], [6000., 5., 0.],
+                   [5000., 2.5, -0.25]])
+    # single points and batches
+    for point in xi:
+        assert_allclose(interpolator(point)[0], scipy_interpolator(point)[0],
+                        rtol=1e-12)
+    assert_allclose(interpolator(xi), scipy_interpolator(xi), rtol=1e-12)
+
+    # batch of points sharing their corners
+    clustered_xi = (np.array([4321., 2.3, -0.7]) +
+                    np.random.RandomState(1).randn(20, 3) * [10., 0.1, 0.02])
+    assert_allclose(interpolator(clustered_xi),
+                    scipy_interpolator(clustered_xi), rtol=1e-12)
+
+
+class RowReader(object):
+    """
+    Minimal stand-in for fluxes stored on disk
+    """
+
+    def __init__(self, fluxes):
+        self._fluxes = fluxes
+        self.shape = fluxes.shape
+        self.dtype = fluxes.dtype
+
+    def __getitem__(self, item):
+        return self._fluxes[item]
+
+
+def test_on_disk_fluxes():
+    axes, points, fluxes = make_grid()
+    xi = np.array([[4321., 2.3, -0.7], [5000., 2.5, -0.25]])
+    assert_allclose(
+        RegularGridInterpolator(points, RowReader(fluxes))(xi),
+        RegularGridInterpolator(points, fluxes)(xi), rtol=1e-12)
+
+
+def test_outside_and_holes():
+    axes, points, fluxes = make_grid()
+    interpolator = RegularGridInterpolator(points, fluxes)
+    assert np.all(np.isnan(interpolator([7000., 2., -0.5])))
+
+    # remove one node - the cells around it can't be interpolated
+    hole = np.all(points == [4000., 2.5, -0.5], axis=1)
+    interpolator = RegularGridInterpolator(points[~hole], fluxes[~hole])
+    result = interpolator([[3500., 2., -0.7], [5500., 4., -0.2],
+                           [4000., 0., -1.]])
+    assert np.all(np.isnan(result[0]))
+    assert np.all(np.isfinite(result[1:]))
+    assert_allclose(result[2], fluxes[np.all(points == [4000., 0., -1.],
+                                             axis=1)][0])
+
+
+def test_gradient():
+    axes, points, fluxes = make_grid()
+    interpolator = RegularGridInterpolator(points, fluxes)
+    xi = np.array([4321., 2.3, -0.7])
+    flux, gradient = interpolator.gradient(xi)
+    assert_allclose(flux, interpolator(xi)[0], rtol=1e-12)
+    for i, step in enumerate([1e-2, 1e-5, 1e-5]):
+        offset = np.zeros(3)
+        offset[i] = step
+        numerical = (interpolator(xi + offset)[0] -
+                     interpolator(xi - offset)[0]) / (2 * step)
+        assert_allclose(gradient[i], numerical, rtol=1e-6)
@@ -0,0 +1,78 @@
+import warnings
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from astropy import units as u
+
+pytest.importorskip('specutils')
+
+from starkit.fix_spectrum1d import Spectrum1D
+from starkit.base.operations.spectrograph import (Normalize, NormalizeParts,
+                                                  solve_normal_equations)
+
+
+def make_spectra(continuum_degree=3):
+    wavelength = np.linspace(5000., 5100., 2000)
+    reduced_wavelength = wavelength / wavelength.mean() - 1.
+    model_flux = 1 + 0.3 * np.sin(wavelength / 2.)
+    continuum = np.polynomial.polynomial.polyval(
+        reduced_wavelength, [1., 3., -20., 500.][:continuum_degree + 1])
+    observed = Spectrum1D.from_array(
+        wavelength * u.angstrom,
+        model_flux * continuum * u.erg / u.s / u.cm**2 / u.angstrom)
+    observed.uncertainty = 0.01 * np.ones_like(wavelength) * \
+        observed.flux.unit
+    return observed, model_flux
+
+
+def test_lstsq_solution():
+    # degree 8 on a ~2% wavelength range - solving the normal equations
+    # (by Cholesky or least squares) loses about half of the precision
+    observed, model_flux = make_spectra()
+    normalize = Normalize(observed, 8)
+    parts = NormalizeParts(observed, [slice(0, 1000), slice(1000, None)], 8)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        solution = normalize._lstsq_solution(model_flux)
+        stacked_solution = normalize._lstsq_solution(
+            np.vstack((model_flux, model_flux)))
+        normalized_flux = normalize._normalize_lstsq(model_flux)
+        parts_solution = parts._lstsq_solution(model_flux)
+
+    assert_allclose(model_flux * np.dot(normalize._Vp, solution),
+                    observed.flux.value, rtol=1e-12)
+    assert_allclose(stacked_solution, [solution, solution], rtol=1e-12)
+    assert_allclose(normalized_flux, observed.flux.value, rtol=1e-12)
+    assert_allclose(model_flux * parts._sparse_dot(parts._vander,
+                                                   parts_solution.ravel()),
+                    observed.flux.value, rtol=1e-12)
+
+
+def test_fallback():
+    # a part without model flux can't be solved with Cholesky
+    observed, model_flux = make_spectra()
+    model_flux[:500] = 0.
+    parts = NormalizeParts(observed, [slice(0, 500), slice(500, None)], 3)
+    assert solve_normal_equations(
+        *parts._normal_equations(model_flux)) is None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        normalized_flux = parts.evaluate(None, model_flux)[1]
+        derivative_flux = parts.evaluate_derivative(
+            None, model_flux, None, None, [])[1]
+    assert_allclose(normalized_flux[:500], 0.)
+    assert_allclose(normalized_flux[500:], observed.flux.value[500:],
+                    rtol=1e-12)
+    assert_allclose(derivative_flux, normalized_flux, rtol=1e-12)
+
+
+def test_parts_result_kept():
+    observed, model_flux = make_spectra()
+    parts = NormalizeParts(observed, [slice(0, 1000), slice(1000, None)], 3)
+    normalized_flux = parts.evaluate(None, model_flux)[1]
+    expected = normalized_flux.copy()
+    parts.evaluate(None, 2 * model_flux[::-1])
+    assert_allclose(normalized_flux, expected, rtol=0)
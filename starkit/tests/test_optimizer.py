@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from astropy import units as u
+
+pytest.importorskip('specutils')
+
+from starkit.fix_spectrum1d import Spectrum1D
+from starkit.base.assemble_model import assemble_model
+from starkit.fitkit.likelihoods import Chi2Likelihood
+from starkit.fitkit.optimizers.base import Optimizer
+from starkit.tests.test_derivatives import make_grid, make_observed
+
+truth = {'teff_0': 4300., 'logg_0': 2.7, 'vrot_1': 40., 'vrad_2': 25.}
+
+
+def make_fit(compiled):
+    grid = make_grid()
+    observed = make_observed()
+    grid.teff, grid.logg = truth['teff_0'], truth['logg_0']
+    wavelength, flux = assemble_model(grid, observed, vrot=truth['vrot_1'],
+                                      vrad=truth['vrad_2'], R=8000.)()
+
+    uncertainty = 1e-3 * np.ones_like(flux)
+    flux = flux + uncertainty * np.random.RandomState(2).randn(len(flux))
+    data = Spectrum1D.from_array(wavelength * u.angstrom,
+                                 flux * observed.flux.unit)
+    data.uncertainty = uncertainty * observed.flux.unit
+
+    grid.teff, grid.logg = 4600., 2.3
+    model = assemble_model(grid, data, vrot=30., vrad=20., R=8000.,
+                           compiled=compiled)
+    model.R_3.fixed = True
+    return Optimizer(model, Chi2Likelihood(data))
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_recovery(compiled):
+    optimizer = make_fit(compiled)
+    assert optimizer.has_jacobian == compiled
+    # physical range of vrot
+    assert_allclose(optimizer.bounds[optimizer.free_param_names.index(
+        'vrot_1')], [0, np.inf])
+
+    best_fit = optimizer.fit().best_fit
+    assert list(best_fit.keys()) == list(truth.keys())
+    for param_name, tolerance in zip(truth, [10., 0.02, 0.5, 0.5]):
+        assert abs(best_fit[param_name] - truth[param_name]) < tolerance
+
+
+def test_finite_difference_gradient():
+    optimizer = make_fit(compiled=True)
+    free_parameters = optimizer.batch_likelihood.parameters[
+        optimizer.batch_likelihood.free_index]
+    value, gradient = optimizer.negative_loglikelihood_gradient(
+        free_parameters)
+    fd_value, fd_gradient = optimizer.negative_loglikelihood_finite_difference(
+        free_parameters)
+    assert_allclose(fd_value, value, rtol=1e-12)
+    # vrot is differentiated numerically in both cases
+    assert_allclose(fd_gradient[[0, 1, 3]], gradient[[0, 1, 3]], rtol=1e-4)
+
+    # one-sided at the grid edge
+    free_parameters[0] = optimizer.bounds[0, 0]
+    fd_value, fd_gradient = optimizer.negative_loglikelihood_finite_difference(
+        free_parameters)
+    assert np.all(np.isfinite(fd_gradient))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from astropy import units as u
+
+from starkit.base.operations.stellar import DopplerShift
+
+pytest.importorskip('wsynphot')
+
+from starkit.base.operations.imager import Photometry
+
+
+class FilterCurve(object):
+    def __init__(self, lower, upper):
+        self.wavelength = np.linspace(lower, upper, 200) * u.angstrom
+        self.transmission_lambda = np.sin(np.linspace(0, np.pi, 200)) ** 2
+
+
+class FilterSet(object):
+    """
+    Filter set with a flat magnitude system
+    """
+    def __init__(self):
+        self.filter_set = [FilterCurve(4000, 5000), FilterCurve(5000, 6500),
+                           FilterCurve(6000, 8000)]
+
+    def __iter__(self):
+        return iter(self.filter_set)
+
+    def calculate_vega_magnitudes(self, spectrum):
+        return np.zeros(len(self.filter_set))
+
+
+def test_shifted_integration_matrix():
+    photometry = Photometry(FilterSet())
+    wavelength = np.exp(np.linspace(np.log(3500), np.log(9000), 20000))
+    flux = 1 + np.random.RandomState(0).rand(len(wavelength))
+    photometry.evaluate(wavelength, flux)
+
+    doppler_shift = DopplerShift()
+    for vrad in [-300., 0., 20., 150., 5000.]:
+        shifted_wavelength = doppler_shift.evaluate(wavelength, flux, vrad)[0]
+        expected = photometry._calculate_integration_matrix(
+            shifted_wavelength).dot(flux)
+        assert_allclose(
+            photometry.get_integration_matrix(shifted_wavelength).dot(flux),
+            expected, rtol=1e-12)
+        assert_allclose(photometry.evaluate(shifted_wavelength, flux),
+                        -2.5 * np.log10(expected) + photometry.zero_points,
+                        rtol=1e-12)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+pytest.importorskip('specutils')
+pytest.importorskip('tables')
+
+from starkit.base.assemble_model import assemble_model
+from starkit.fitkit.likelihoods import Chi2Likelihood
+from starkit.fitkit.samplers.base import BatchLikelihood
+from starkit.fitkit.samplers.pool import PoolLikelihood
+from starkit.gridkit.base import load_grid
+from starkit.tests.test_derivatives import make_observed
+from starkit.tests.test_grid import write_grid
+
+
+def make_likelihood(grid):
+    observed = make_observed()
+    model = assemble_model(grid, observed, vrot=20., vrad=10., R=8000.,
+                           compiled=True)
+    model.R_3.fixed = True
+    return model | Chi2Likelihood(observed)
+
+
+@pytest.mark.parametrize('flux_storage', ['memory', 'mmap'])
+def test_pooled_likelihood(tmpdir, flux_storage):
+    grid_fname = str(tmpdir.join('grid.h5'))
+    write_grid(grid_fname)
+    likelihood = make_likelihood(load_grid(grid_fname,
+                                           flux_storage=flux_storage))
+    batch_likelihood = BatchLikelihood(likelihood)
+
+    random_state = np.random.RandomState(0)
+    free_parameters = np.column_stack((
+        random_state.uniform(4000., 5500., 7), random_state.uniform(1., 5., 7),
+        random_state.uniform(0., 50., 7), random_state.uniform(-50., 50., 7)))
+    with PoolLikelihood(batch_likelihood, processes=2) as pool:
+        assert pool.n_params == 4
+        assert_allclose(pool(free_parameters),
+                        batch_likelihood(free_parameters), rtol=1e-12)
+        # fewer points than processes
+        assert_allclose(pool(free_parameters[0]),
+                        batch_likelihood(free_parameters[:1]), rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        pool(free_parameters)
+
+
+def test_hdf5_refused(tmpdir):
+    grid_fname = str(tmpdir.join('grid.h5'))
+    write_grid(grid_fname)
+    likelihood = make_likelihood(load_grid(grid_fname, flux_storage='hdf5'))
+    with pytest.raises(ValueError):
+        PoolLikelihood(likelihood, processes=2)
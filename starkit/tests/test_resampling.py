@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from astropy import units as u
+
+pytest.importorskip('specutils')
+
+from starkit.fix_spectrum1d import Spectrum1D
+from starkit.base.operations.spectrograph import Interpolate
+
+
+def make_interpolate(observed_wavelength, mode='rebin'):
+    observed = Spectrum1D.from_array(
+        observed_wavelength * u.angstrom,
+        np.ones_like(observed_wavelength) * u.erg / u.s / u.cm**2 / u.angstrom)
+    return Interpolate(observed, mode=mode)
+
+
+def test_rebin_flux_conservation():
+    interpolate = make_interpolate(np.linspace(5010., 5090., 41))
+    wavelength = np.linspace(5000., 5100., 1001)
+    flux = 1 + 0.5 * np.sin(wavelength / 3.)
+
+    # a model spectrum that is sampled much finer gives the pixel averages
+    resampled_flux = interpolate.evaluate(wavelength, flux)[1]
+    edges = interpolate._observed_edges
+    fine_wavelength = np.linspace(edges[0], edges[-1], 400001)
+    fine_flux = np.interp(fine_wavelength, wavelength, flux)
+    pixel_index = np.searchsorted(edges, fine_wavelength[1:]) - 1
+    expected = (np.bincount(pixel_index, fine_flux[1:]) /
+                np.bincount(pixel_index))
+    assert_allclose(resampled_flux, expected, rtol=1e-3)
+
+    # stacked spectra use cached weights
+    assert_allclose(interpolate.evaluate(wavelength, np.vstack((flux, flux)))[1],
+                    [resampled_flux, resampled_flux], rtol=1e-12)
+
+
+def test_rebin_outside_model():
+    # observed pixels beyond the model edges can't be rebinned
+    interpolate = make_interpolate(np.linspace(5000., 5100., 51))
+    wavelength = np.linspace(5010., 5090., 801)
+    flux = np.ones_like(wavelength)
+
+    resampled_flux = interpolate.evaluate(wavelength, flux)[1]
+    observed_wavelength = interpolate._observed_wavelength
+    covered = (observed_wavelength > 5011.) & (observed_wavelength < 5089.)
+    assert np.all(np.isnan(resampled_flux[~covered]))
+    assert_allclose(resampled_flux[covered], 1., rtol=1e-12)
+
+    stacked_flux = interpolate.evaluate(wavelength,
+                                        np.vstack((flux, 2 * flux)))[1]
+    assert np.all(np.isnan(stacked_flux[:, ~covered]))
+    assert_allclose(stacked_flux[:, covered],
+                    [[1.], [2.]] * np.ones((2, covered.sum())), rtol=1e-12)
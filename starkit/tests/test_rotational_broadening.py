@@ -0,0 +1,73 @@
+import timeit
+
+import numpy as np
+import scipy.ndimage as nd
+from numpy.testing import assert_allclose
+
+from starkit.base.operations.stellar import RotationalBroadening
+
+
+def make_rotation(n_pix=40000):
+    rotation = RotationalBroadening(velocity_per_pix=0.5)
+    flux = 1 + np.random.RandomState(0).rand(3, n_pix)
+    return rotation, flux
+
+
+def test_fft_matches_convolve1d():
+    rotation, flux = make_rotation()
+    flux_transforms = {}
+    for vrot in [70., 100., 250., 1000.]:
+        profile = rotation.rotational_profile(vrot, 0.6)
+        assert len(profile) >= rotation.fft_threshold
+        expected = nd.convolve1d(flux, profile, axis=-1)
+        # single and stacked spectra, with and without shared transforms
+        assert_allclose(rotation._fft_convolve(flux[0], profile),
+                        expected[0], rtol=0, atol=1e-12)
+        assert_allclose(rotation._fft_convolve(flux, profile),
+                        expected, rtol=0, atol=1e-12)
+        assert_allclose(rotation._broaden(flux, vrot, 0.6, flux_transforms),
+                        expected, rtol=0, atol=1e-12)
+
+
+def test_modified_flux():
+    rotation, flux = make_rotation()
+    first = rotation.evaluate(None, flux, 250., 0.6)[1]
+    flux *= 2
+    assert_allclose(rotation.evaluate(None, flux, 250., 0.6)[1], 2 * first,
+                    rtol=1e-12)
+
+
+def test_fft_benchmark():
+    rotation, flux = make_rotation()
+    profile = rotation.rotational_profile(1000., 0.6)
+    fft_time = min(timeit.repeat(
+        lambda: rotation._fft_convolve(flux[0], profile), number=3, repeat=3))
+    direct_time = min(timeit.repeat(
+        lambda: nd.convolve1d(flux[0], profile), number=3, repeat=3))
+    # ~20 times faster for a 4000 pixel kernel on a 40000 pixel spectrum
+    assert fft_time < direct_time
+
+
+def test_vrot_below_kernel_quantum():
+    rotation, flux = make_rotation(n_pix=2000)
+    quantum = rotation.velocity_per_pix / rotation.kernel_subpixel_steps
+    vrot = 40. + 0.3 * quantum
+    broadened_flux = rotation.evaluate(None, flux[0], vrot, 0.6)[1]
+
+    # the spectrum changes linearly within a quantum
+    half_quantum_difference = (rotation.evaluate(
+        None, flux[0], vrot + 0.5 * quantum, 0.6)[1] - broadened_flux)
+    assert np.any(half_quantum_difference != 0)
+    for step in [0.1 * quantum, 0.4 * quantum]:
+        difference = (rotation.evaluate(None, flux[0], vrot + step, 0.6)[1] -
+                      broadened_flux)
+        assert_allclose(difference, half_quantum_difference * step /
+                        (0.5 * quantum), rtol=1e-6, atol=1e-15)
+
+    # between the lattice points the kernels are blended
+    profile = rotation.rotational_profile(40. + 0.5 * quantum, 0.6)
+    lower_profile = rotation.rotational_profile(40., 0.6)
+    upper_profile = rotation.rotational_profile(40. + quantum, 0.6)
+    assert_allclose(profile, 0.5 * (lower_profile + upper_profile),
+                    rtol=1e-12)
+    assert_allclose(profile.sum(), 1., rtol=1e-12)
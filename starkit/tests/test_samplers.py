@@ -0,0 +1,50 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from starkit.fitkit.samplers.ensemble import EnsembleSampler
+from starkit.fitkit.samplers.priors import UniformPrior
+
+
+class Parameter(object):
+    def __init__(self, fixed=False):
+        self.fixed = fixed
+
+
+class GaussianLikelihood(object):
+    """
+    Log-likelihood of two independent gaussian parameters (and a fixed
+    one) that evaluates arrays of parameter values
+    """
+    param_names = ['a', 'b', 'c']
+    mean = np.array([1., -2.])
+    sigma = np.array([0.5, 0.1])
+
+    def __init__(self):
+        self.parameters = np.array([0., 0., 3.])
+        self.a = Parameter()
+        self.b = Parameter()
+        self.c = Parameter(fixed=True)
+
+    def evaluate(self, a, b, c):
+        return -0.5 * (((a - self.mean[0]) / self.sigma[0]) ** 2 +
+                       ((b - self.mean[1]) / self.sigma[1]) ** 2)
+
+
+def test_ensemble_sampler_sigmas():
+    likelihood = GaussianLikelihood()
+    sampler = EnsembleSampler(likelihood, [UniformPrior(-3, 5),
+                                           UniformPrior(-3, -1)],
+                              n_walkers=16, random_state=1)
+    result = sampler.run(n_steps=2000)
+
+    assert list(result.parameter_names) == ['a', 'b']
+    assert np.all((result.acceptance_fraction > 0.2) &
+                  (result.acceptance_fraction < 0.9))
+    assert_allclose(list(result.mean.values()), likelihood.mean, atol=0.05)
+
+    sigmas = result.calculate_sigmas(1)
+    for parameter_name, mean, sigma in zip(
+            ['a', 'b'], likelihood.mean, likelihood.sigma):
+        lower, upper = sigmas[parameter_name]
+        assert_allclose([lower, upper], [mean - sigma, mean + sigma],
+                        atol=0.2 * sigma)
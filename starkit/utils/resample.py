@@ -0,0 +1,118 @@
+import numpy as np
+
+from astropy import constants as const, units as u
+
+
+def same_array(a, b):
+    """
+    Check if two arrays are the same object or hold the same values
+
+    Arrays are assumed not to be modified in place.
+    """
+    if a is b:
+        return True
+    if a is None or b is None or np.shape(a) != np.shape(b):
+        return False
+    return np.array_equal(a, b)
+
+
+def linear_interpolation_weights(new_x, x):
+    """
+    Calculate the weights for linearly interpolating from x to new_x
+
+    The weights reproduce `np.interp` (including the constant extrapolation
+    beyond the ends of x) as
+    values[..., index] * (1 - weight) + values[..., index + 1] * weight
+
+    Parameters
+    ----------
+
+    new_x: ~np.ndarray
+        positions to interpolate to
+
+    x: ~np.ndarray
+        increasing positions of the values
+
+    Returns
+    -------
+        : ~np.ndarray
+        index of the left neighbour
+        : ~np.ndarray
+        weight of the right neighbour
+    """
+    index = np.clip(np.searchsorted(x, new_x, side='right') - 1,
+                    0, len(x) - 2)
+    weight = np.clip((new_x - x[index]) / (x[index + 1] - x[index]), 0., 1.)
+    return index, weight
+
+
+def apply_interpolation_weights(values, index, weight):
+    """
+    Interpolate (stacked) values with weights from
+    `linear_interpolation_weights`
+
+    Parameters
+    ----------
+
+    values: ~np.ndarray
+        values (..., n)
+
+    index: ~np.ndarray
+        index of the left neighbour
+
+    weight: ~np.ndarray
+        weight of the right neighbour
+    """
+    return (values[..., index] * (1. - weight) +
+            values[..., index + 1] * weight)
+
+
+class LogLambdaResampler(object):
+    """
+    Resample spectra between an arbitrary wavelength grid and a log-lambda
+    grid with the same (finest) sampling
+
+    The interpolation weights only depend on the wavelength grid up to a
+    constant factor, so a resampler can be reused for doppler-shifted
+    versions of the same grid.
+
+    Parameters
+    ----------
+
+    wavelength: ~np.ndarray
+        increasing wavelength grid of the spectra
+    """
+
+    def __init__(self, wavelength):
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
+        log_wavelength = np.log(self.wavelength)
+
+        log_step = np.min(np.diff(log_wavelength))
+        n_log = int(np.ceil((log_wavelength[-1] - log_wavelength[0])
+                            / log_step)) + 1
+        log_grid = np.linspace(log_wavelength[0], log_wavelength[-1], n_log)
+        log_step = log_grid[1] - log_grid[0]
+
+        self.velocity_per_pix = const.c.to(u.km / u.s).value * log_step
+        self._to_log = linear_interpolation_weights(log_grid, log_wavelength)
+        self._from_log = linear_interpolation_weights(log_wavelength,
+                                                      log_grid)
+
+    def matches(self, wavelength):
+        """
+        Check if a wavelength grid is (a scaled version of) the grid of this
+        resampler
+        """
+        if wavelength is self.wavelength:
+            return True
+        if np.shape(wavelength) != self.wavelength.shape:
+            return False
+        return np.allclose(wavelength * self.wavelength[0],
+                           self.wavelength * wavelength[0],
+                           rtol=1e-12, atol=0)
+
+    def to_log(self, flux):
+        return apply_interpolation_weights(flux, *self._to_log)
+
+    def from_log(self, flux):
+        return apply_interpolation_weights(flux, *self._from_log)